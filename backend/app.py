@@ -1,12 +1,27 @@
+import atexit
 import dataclasses
-from flask import Flask, jsonify, request
+import json
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from utils.logger import get_logger, setup_logger
 import traceback
 from services.aggregator import DatabaseAggregator
 from config.config import load_config
-from services.reporter import MetricsReporter
-from utils.cache import CachedData, CacheUpdateManager
+from services import reporter
+from services.reporter import MetricsReporter, merge_latest_metrics
+from utils.cache import CachedData
+from services.dimension_cache import DimensionCache
+from services.rollups import RollupMaintainer
+from services.latest_values import LatestValueIndex
+from services.generations import GenerationCounter
+from services.event_broker import EventBroker, SubscriberLimitError
+from services.shared_state import SingleFlightLoader, create_store
+from services.ingest_buffer import IngestBuffer
+from services import batch_dedup
+from services.batch_dedup import BatchDeduplicator
+from collector_agent.metrics_sdk import wire_format
+from utils.timestamp import epoch_ms_to_iso, get_utc_timestamp_ms
 
 # Initialize application with config
 app = Flask(__name__)
@@ -22,15 +37,87 @@ logger.info("Logger initialized with configuration & flask routes")
 
 # Initialize aggregator
 try:
-    db_aggregator = DatabaseAggregator(config.SQLALCHEMY_DATABASE_URI)
+    db_aggregator = DatabaseAggregator(
+        config.SQLALCHEMY_DATABASE_URI,
+        dimension_cache=DimensionCache(max_size=config.ingest.dimension_cache_size),
+        insert_chunk_size=config.ingest.insert_chunk_size,
+        rollups=RollupMaintainer(config.rollups.resolutions, chunk_size=config.ingest.insert_chunk_size)
+        if config.rollups.enabled else None
+    )
     logger.info("Database aggregator initialized successfully")
 except Exception as e:
     logger.critical(f"Failed to initialize database aggregator: {str(e)}")
     raise
 
+# State shared between workers: the latest metrics windows and values, ETag generations,
+# stream batches, upload batch windows and queued site commands
+shared_state = config.shared_state
+shared_store = create_store(shared_state.backend, redis_url=shared_state.redis_url, file_path=shared_state.file_path)
+# Without a shared backend each worker keeps this state in memory, which is only right for a single worker
+worker_store = shared_store if shared_store.shared else None
+SITE_QUEUE_KEY = f"{shared_state.key_prefix}site_commands"
+logger.info(f"Using the {shared_state.backend} shared state backend")
+
+# Newest value per device and metric name, updated by every stored batch
+latest_values = LatestValueIndex(
+    db_aggregator.engine if config.latest_values.persist else None,
+    flush_interval_seconds=config.latest_values.flush_interval_seconds,
+    store=worker_store,
+    key_prefix=shared_state.key_prefix
+)
+try:
+    latest_values.load()
+except Exception as e:
+    logger.error(f"Failed to load latest values, starting with an empty index: {str(e)}")
+latest_values.start()
+# atexit runs handlers in reverse, so this runs after the ingest buffer below has drained into the index
+atexit.register(latest_values.close)
+db_aggregator.add_ingest_listener(latest_values.update)
+
+# Bumped by ingest once the index and read caches are updated, see below
+generations = GenerationCounter(store=worker_store, key_prefix=shared_state.key_prefix)
+
+# Stored measurements are pushed to /api/metrics/stream subscribers
+event_broker = EventBroker(
+    max_batches=config.stream.max_batches,
+    max_subscribers=config.stream.max_subscribers,
+    store=worker_store,
+    key_prefix=shared_state.key_prefix,
+    ttl_seconds=shared_state.stream_ttl_seconds,
+    poll_seconds=shared_state.stream_poll_seconds
+)
+event_broker.start()
+atexit.register(event_broker.close)
+db_aggregator.add_ingest_listener(event_broker.publish)
+
+# Initialize write-behind ingest buffer
+ingest_buffer = None
+if config.ingest.buffer_enabled:
+    ingest_buffer = IngestBuffer(
+        db_aggregator.store_metrics,
+        max_rows=config.ingest.buffer_max_rows,
+        flush_rows=config.ingest.buffer_flush_rows,
+        flush_interval_seconds=config.ingest.buffer_flush_interval_seconds
+    )
+    ingest_buffer.start()
+    atexit.register(ingest_buffer.close)
+
+# Replayed upload batches are detected per agent and acknowledged without storing them again
+batch_deduplicator = BatchDeduplicator(
+    window=config.ingest.dedup_window,
+    max_agents=config.ingest.dedup_max_agents,
+    in_flight_timeout_seconds=config.ingest.dedup_in_flight_timeout_seconds,
+    store=worker_store,
+    key_prefix=shared_state.key_prefix,
+    agent_ttl_seconds=shared_state.dedup_agent_ttl_seconds
+)
+
 # Initialize metrics reporter
 try:
-    metrics_reporter = MetricsReporter(config.SQLALCHEMY_DATABASE_URI)
+    metrics_reporter = MetricsReporter(
+        config.SQLALCHEMY_DATABASE_URI,
+        rollup_resolutions=config.rollups.resolutions if config.rollups.enabled else None
+    )
     logger.info("Metrics reporter initialized successfully")
 except Exception as e:
     logger.critical(f"Failed to initialize Metrics reporter: {str(e)}")
@@ -38,22 +125,225 @@ except Exception as e:
 
 collector_types = config.collector_types
 collector_type_values = {field.name: getattr(collector_types, field.name) for field in dataclasses.fields(collector_types)}
-metrics_cache = {metric_type: CachedData(cache_duration_seconds=15) for metric_type in collector_type_values.values()}
-current_site = None
+
+
+# Largest part of a read cache's TTL during which reads already start its refresh
+REFRESH_AHEAD_MAX_FRACTION = 0.25
+
+# With a shared backend: the window in the store per metric type, and the ETag each worker
+# serves its own copy of it with, which is the generation read before that copy was loaded
+shared_windows = {}
+loading_etags = {}
+served_etags = {}
+
+def _make_metrics_cache(metric_type):
+    """
+    Stale-while-revalidate cache of the latest metrics window of one type, refreshed off the request path.
+    With a shared backend it is a short-lived copy of the window in the store, which one worker
+    at a time reloads from the database every read_cache.ttl_seconds.
+    """
+    loader = lambda: metrics_reporter.get_all_latest_metrics(metric_type=metric_type)
+    ttl_seconds = config.read_cache.ttl_seconds
+    # Bumped once a changed window is installed, so ETags never run ahead of the cache
+    on_refresh = lambda data: generations.bump_if_changed(metric_type, data)
+    if shared_store.shared:
+        shared_window = shared_windows[metric_type] = SingleFlightLoader(
+            shared_store, f"{shared_state.key_prefix}latest:{metric_type}", loader,
+            ttl_seconds=ttl_seconds,
+            lock_ttl_seconds=shared_state.lock_ttl_seconds,
+            wait_seconds=config.read_cache.cold_wait_seconds,
+            # Windows merged into by other workers during the load keep their rows
+            reconcile=lambda loaded, current: merge_latest_metrics(loaded, current[0]),
+            # Ingest bumps the shared generation for its own merges; this covers what a reload corrects
+            on_change=lambda: generations.bump(metric_type)
+        )
+        def loader():
+            # Read before the copy is loaded, so the tag it is served with is never newer than the copy
+            try:
+                loading_etags[metric_type] = generations.etag(metric_type)
+            except Exception as e:
+                logger.error(f"Shared generation of {metric_type} unavailable, serving it untagged: {str(e)}")
+                loading_etags[metric_type] = None
+            return shared_window()
+        on_refresh = lambda data: served_etags.__setitem__(metric_type, loading_etags[metric_type])
+        ttl_seconds = shared_state.local_ttl_seconds
+    return CachedData(
+        cache_duration_seconds=ttl_seconds,
+        loader=loader,
+        # Capped below the TTL, or every read of a short-lived copy would start a refresh
+        refresh_ahead_seconds=min(config.read_cache.refresh_ahead_seconds, ttl_seconds * REFRESH_AHEAD_MAX_FRACTION),
+        cold_wait_seconds=config.read_cache.cold_wait_seconds,
+        on_refresh=on_refresh,
+        name=f'{metric_type}-metrics'
+    )
+
+metrics_cache = {metric_type: _make_metrics_cache(metric_type) for metric_type in collector_type_values.values()}
+
+
+def _merge_into_read_cache(rows):
+    """
+    Ingest listener: write stored rows through to the read cache of their metric type,
+    so it stays current between loads and its TTL only bounds how long a missed merge can last.
+    """
+    rows_by_type = {}
+    for row in rows:
+        rows_by_type.setdefault(row['type'], []).append(row)
+    for metric_type, type_rows in rows_by_type.items():
+        cache = metrics_cache.get(metric_type)
+        if cache is None:
+            continue
+        merge = lambda data: merge_latest_metrics(data, type_rows)
+        shared_window = shared_windows.get(metric_type)
+        if shared_window is not None:
+            try:
+                shared_window.merge(merge)  # Reaches the other workers with their next read of the store
+            except Exception as e:
+                logger.error(f"Failed to merge into the shared {metric_type} window: {str(e)}")
+        cache.merge(merge)
+
+db_aggregator.add_ingest_listener(_merge_into_read_cache)
+# Registered last, so a generation never runs ahead of the data it tags
+db_aggregator.add_ingest_listener(generations.bump_rows)
+
+TIMESTAMP_ISO = 'iso'
+TIMESTAMP_EPOCH_MS = 'epoch_ms'
+
+HISTORY_DEFAULT_RANGE_MS = 24 * 60 * 60 * 1000
+HISTORY_MAX_POINTS_LIMIT = 5000
+
+PAGE_SIZE_LIMIT = 200
+
+# Fields every uploaded metric needs before it is accepted, as store_metrics cannot store a row without them
+UPLOAD_REQUIRED_FIELDS = ('name', 'value')
 
 @app.route('/api/metrics/upload-metrics', methods=['POST'])
 def handle_metrics():
     logger.debug(f"Handling {request.method} request to /api/metrics")
     try:
-            metrics_data = request.json
-            if not metrics_data:
-                return jsonify({'error': 'No metrics data received'}), 400
-
-            logger.info(f"metrics_data in upload enpoint  ☀️: {metrics_data}")
-            db_aggregator.store_metrics(metrics_data)
-            return jsonify({'status': 'success', 'count': len(metrics_data)}), 200
+            batch_key = _read_batch_key()
+            if batch_key is None:
+                return _ingest_upload()
+
+            # Replayed batches are acknowledged before the payload is even decoded
+            state = batch_deduplicator.reserve(*batch_key)
+            if state == batch_dedup.DUPLICATE:
+                logger.info(f"Acknowledging replayed batch {batch_key[1]} from agent {batch_key[0]}")
+                return jsonify({'status': 'duplicate', 'batch_seq': batch_key[1]}), 200
+            if state == batch_dedup.IN_FLIGHT:
+                response = jsonify({'error': 'Batch is already being processed'})
+                response.headers['Retry-After'] = '1'
+                return response, 409
+
+            # A buffered batch is only committed once the ingest buffer has stored it
+            stored, buffered = False, False
+            try:
+                response, status = _ingest_upload(on_stored=lambda ok: _settle_batch(batch_key, ok))
+                stored, buffered = status == 200, status == 202
+                return response, status
+            finally:
+                if not buffered:
+                    _settle_batch(batch_key, stored)
     except Exception as e:
         logger.error(f"Error in handle_metrics: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+
+def _settle_batch(batch_key, stored):
+    """Commit a reserved batch once it is stored, or release it so a retry is accepted."""
+    if stored:
+        batch_deduplicator.commit(*batch_key)
+    else:
+        batch_deduplicator.release(*batch_key)
+
+
+def _read_batch_key():
+    """
+    Extract the (agent id, batch sequence number) pair sent by idempotent agents.
+    Returns None for uploads without one, which are stored unconditionally.
+    """
+    agent_id = request.headers.get(wire_format.AGENT_ID_HEADER)
+    batch_seq = request.headers.get(wire_format.BATCH_SEQ_HEADER)
+    if not agent_id or batch_seq is None:
+        return None
+    try:
+        return agent_id, int(batch_seq)
+    except ValueError:
+        logger.warning(f"Ignoring invalid batch sequence number: {batch_seq}")
+        return None
+
+
+def _ingest_upload(on_stored=None):
+    """
+    Decode the upload and hand it to the ingest buffer, or store it directly.
+    on_stored is passed on to the ingest buffer, which calls it once a 202-accepted upload is stored or dropped.
+    """
+    try:
+        metrics_data = _read_upload_payload()
+    except RequestEntityTooLarge:
+        logger.warning(f"Rejected upload of {request.content_length} bytes, over MAX_CONTENT_LENGTH")
+        return jsonify({'error': f"Upload exceeds {config.ingest.max_upload_bytes} bytes"}), 413
+    except wire_format.WireFormatError as e:
+        logger.warning(f"Rejected upload payload: {str(e)}")
+        if isinstance(e, wire_format.PayloadTooLargeError):
+            return jsonify({'error': str(e)}), 413
+        status = 415 if isinstance(e, wire_format.UnsupportedEncodingError) else 400
+        return jsonify({'error': str(e), 'accepted_encodings': wire_format.supported_encodings()}), status
+
+    if not metrics_data:
+        return jsonify({'error': 'No metrics data received'}), 400
+    if not isinstance(metrics_data, list):
+        return jsonify({'error': 'Metrics data must be a list'}), 400
+    malformed = _find_malformed_metric(metrics_data)
+    if malformed is not None:
+        logger.warning(f"Rejected upload: {malformed}")
+        return jsonify({'error': malformed}), 400
+
+    logger.debug(f"Received {len(metrics_data)} metrics in upload endpoint")
+
+    if ingest_buffer is None:
+        db_aggregator.store_metrics(metrics_data)
+        return jsonify({'status': 'success', 'count': len(metrics_data)}), 200
+
+    if not ingest_buffer.offer(metrics_data, on_stored=on_stored):
+        logger.warning(f"Ingest buffer full, rejecting {len(metrics_data)} metrics")
+        response = jsonify({'error': 'Ingest buffer full, retry later'})
+        response.headers['Retry-After'] = str(config.ingest.buffer_retry_after_seconds)
+        return response, 429
+
+    return jsonify({'status': 'accepted', 'count': len(metrics_data)}), 202
+
+
+def _find_malformed_metric(metrics_data):
+    """
+    Describe the first metric that is not an object with the UPLOAD_REQUIRED_FIELDS, or return None.
+    Checked before an upload is buffered, where it would fail the batch it is merged into.
+    """
+    for index, metric in enumerate(metrics_data):
+        if not isinstance(metric, dict):
+            return f"Metric {index} is not an object"
+        missing = [field for field in UPLOAD_REQUIRED_FIELDS if metric.get(field) is None]
+        if missing:
+            return f"Metric {index} is missing {', '.join(missing)}"
+    return None
+
+
+def _read_upload_payload():
+    """
+    Decode an upload body into a list of metric dicts.
+    Accepts the compressed columnar wire format and falls back to plain JSON.
+    Compressed bodies may expand to at most config.ingest.max_decompressed_bytes.
+    """
+    encoding = request.headers.get('Content-Encoding', wire_format.IDENTITY).strip().lower()
+    max_size = config.ingest.max_decompressed_bytes
+    if request.mimetype == wire_format.CONTENT_TYPE:
+        return wire_format.decode_measurements(wire_format.decompress(request.get_data(), encoding, max_size))
+    if encoding != wire_format.IDENTITY:
+        body = wire_format.decompress(request.get_data(), encoding, max_size)
+        try:
+            return json.loads(body)
+        except ValueError as e:  # Includes JSONDecodeError and UnicodeDecodeError
+            raise wire_format.WireFormatError(f"Malformed JSON payload: {str(e)}") from e
+    return request.get_json(silent=True)
 
 
 @app.route('/api/metrics/get-latest-metrics', methods=['GET'])
@@ -63,6 +353,17 @@ def get_latest_batch():
     Query parameters:
     - metric_type: Type of metrics to retrieve
     - page_number: Page number for pagination (default: 1)
+    - timestamp_format: 'iso' for ISO timestamp_utc strings (default) or 'epoch_ms' for integer timestamp_ms
+    - since: Optional epoch millisecond cursor from an earlier response; only metrics newer
+      than it are returned, unpaginated, along with the cursor for the next poll
+
+    Responses carry an ETag derived from the metric type's generation. A request with a
+    matching If-None-Match gets a 304 without the page being built or serialized.
+
+    Passing page_size, before or after switches to keyset pagination over the whole history:
+    - page_size: Metrics per page (1 to PAGE_SIZE_LIMIT, default: 10)
+    - before: Cursor from next_cursor, for the page of older metrics
+    - after: Cursor from prev_cursor, for the page of newer metrics
     """
     logger.debug("Handling GET request to get-latest-metrics")
     try:
@@ -70,32 +371,115 @@ def get_latest_batch():
         metric_type, page_number = _validate_metrics_request_params()
         if not metric_type:
             return jsonify({'error': 'Invalid metric type'}), 400
+        timestamp_format = request.args.get('timestamp_format', TIMESTAMP_ISO)
+        if timestamp_format not in (TIMESTAMP_ISO, TIMESTAMP_EPOCH_MS):
+            return jsonify({'error': 'Invalid timestamp format'}), 400
+        if any(param in request.args for param in ('page_size', 'before', 'after')):
+            return _get_keyset_page(metric_type, timestamp_format)
+
+        try:
+            since = int(request.args['since']) if 'since' in request.args else None
+        except ValueError:
+            return jsonify({'error': 'since must be an integer'}), 400
 
         page_size = 10  # Fixed page size for pagination
         logger.debug(f"Processing request for metric_type: {metric_type}, page_number: {page_number}")
 
+        # Taken before the data is read, so the tag is at worst older than the response it is sent with
+        etag = _metrics_etag(metric_type)
+
         # Get metrics data (from cache or database)
         metrics_data = _get_metrics_data(metric_type)
+        if etag is not None and _metrics_etag(metric_type) == etag and request.if_none_match.contains(etag):
+            logger.debug(f"{metric_type} metrics unchanged since generation {etag}")
+            return _conditional_response(app.response_class(status=304), etag)
         if not metrics_data:
-            return _create_empty_response(), 200
+            return _conditional_response(_create_empty_response(), etag), 200
 
         # Process the metrics data
-        latest_metrics = _extract_latest_metrics(metrics_data)
+        latest_metrics = latest_values.get(metric_type)
+        if since is not None:
+            new_metrics = [metric for metric in metrics_data if metric['timestamp_ms'] > since]
+            logger.info(f"Serving {len(new_metrics)} {metric_type} metrics newer than {since}")
+            return _conditional_response(jsonify({
+                'latest_metric': _render_timestamps(latest_metrics, timestamp_format),
+                'metrics': _render_timestamps(new_metrics, timestamp_format),
+                'since': max((metric['timestamp_ms'] for metric in new_metrics), default=since)
+            }), etag), 200
+
         page_data, pagination_info = _paginate_metrics(metrics_data, page_number, page_size)
 
         logger.info(f"Serving page {pagination_info['current_page']} of {pagination_info['total_pages']} for {metric_type} metrics")
-        return jsonify({
-            'latest_metric': latest_metrics,
-            'metrics': page_data,
+        return _conditional_response(jsonify({
+            'latest_metric': _render_timestamps(latest_metrics, timestamp_format),
+            'metrics': _render_timestamps(page_data, timestamp_format),
             'total_pages': pagination_info['total_pages'],
-            'current_page': pagination_info['current_page']
-        }), 200
+            'current_page': pagination_info['current_page'],
+            'since': metrics_data[0]['timestamp_ms']
+        }), etag), 200
 
     except Exception as e:
         logger.error(f"Error in get_latest_batch: {str(e)}", exc_info=True)
         return jsonify({'error': 'Internal server error'}), 500
 
 
+def _metrics_etag(metric_type):
+    """
+    The ETag of the latest metrics of metric_type as this worker serves them. With a shared backend
+    that is the shared generation read before the worker's copy of the window was loaded, so a
+    worker whose copy lags behind never serves it with a newer tag; None until the first copy.
+    """
+    if shared_store.shared:
+        return served_etags.get(metric_type)
+    return generations.etag(metric_type)
+
+
+def _conditional_response(response, etag):
+    """
+    Tag a response with the generation it was built from.
+    no-cache lets browsers keep the body but makes them revalidate it with If-None-Match on every poll.
+    """
+    if etag is None:
+        return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _get_keyset_page(metric_type, timestamp_format):
+    """
+    Serve one page of metrics straight from the database, positioned by an opaque cursor.
+    Returns tuple: (response, status)
+    """
+    before, after = request.args.get('before'), request.args.get('after')
+    if before and after:
+        return jsonify({'error': 'Pass only one of before and after'}), 400
+    try:
+        page_size = min(PAGE_SIZE_LIMIT, max(1, int(request.args.get('page_size', 10))))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'page_size must be an integer'}), 400
+
+    try:
+        page_data, next_cursor, prev_cursor = metrics_reporter.get_metrics_page(
+            metric_type, page_size,
+            cursor=after or before,
+            direction=reporter.AFTER if after else reporter.BEFORE
+        )
+    except reporter.InvalidCursorError as e:
+        return jsonify({'error': str(e)}), 400
+
+    latest_metrics = latest_values.get(metric_type)
+
+    logger.info(f"Serving a keyset page of {len(page_data)} {metric_type} metrics")
+    return jsonify({
+        'latest_metric': _render_timestamps(latest_metrics, timestamp_format),
+        'metrics': _render_timestamps(page_data, timestamp_format),
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+        'page_size': page_size
+    }), 200
+
+
 def _validate_metrics_request_params():
     """
     Validate and extract request parameters.
@@ -116,55 +500,33 @@ def _validate_metrics_request_params():
 def _get_metrics_data(metric_type):
     """
     Get metrics data from cache or database.
-    Handles cache expiration and updates.
+    An expired cache is still served while it is refreshed in the background;
+    only a cache that was never loaded waits for the database.
     Returns the metrics data or None if no data is available.
     """
-    cache = metrics_cache[metric_type]
-
-    with cache:
-        if cache.is_expired():
-            _update_cache_if_needed(cache, metric_type)
-        else:
-            logger.info(f"Serving {metric_type} metrics from cache")
-
-        all_data = cache.get_data()
+    all_data = metrics_cache[metric_type].get_or_refresh()
 
     # Return flattened metrics or None if no data
     return all_data[0] if all_data and all_data[0] else None
 
 
-def _update_cache_if_needed(cache, metric_type):
+def _render_timestamps(metrics, timestamp_format):
     """
-    Update the cache if needed and not already being updated by another thread.
+    Render the epoch millisecond timestamps of the metrics being returned.
+    Cached metrics are left untouched; ISO rows are copies with timestamp_utc in place of timestamp_ms.
     """
-    with CacheUpdateManager(cache) as manager:
-        if not manager.update_started_elsewhere():
-            logger.info(f"Fetching new {metric_type} metrics data")
-            new_data = metrics_reporter.get_all_latest_metrics(metric_type=metric_type)
-            if new_data:
-                cache.update(new_data)
-                logger.info(f"Cache updated with {len(new_data)} {metric_type} metrics")
-        else:
-            logger.info(f"Waiting for another thread to update the {metric_type} cache")
-            manager.spin_wait_for_update_to_complete()
-
-
-def _extract_latest_metrics(metrics_data):
-    """
-    Extract the latest metrics for each device in a single pass.
-    Returns a list of the latest metrics for each device.
-    """
-    device_timestamps = {}
-    for metric in metrics_data:
-        device_name = metric['device_name']
-        timestamp = metric['timestamp_utc']
-        if device_name not in device_timestamps or timestamp > device_timestamps[device_name]:
-            device_timestamps[device_name] = timestamp
-
-    return [
-        metric for metric in metrics_data
-        if metric['timestamp_utc'] == device_timestamps[metric['device_name']]
-    ]
+    if timestamp_format == TIMESTAMP_EPOCH_MS:
+        return metrics
+    rendered = {}
+    rows = []
+    for metric in metrics:
+        row = dict(metric)
+        epoch_ms = row.pop('timestamp_ms')
+        if epoch_ms not in rendered:
+            rendered[epoch_ms] = epoch_ms_to_iso(epoch_ms)
+        row['timestamp_utc'] = rendered[epoch_ms]
+        rows.append(row)
+    return rows
 
 
 def _paginate_metrics(metrics_data, page_number, page_size):
@@ -196,6 +558,127 @@ def _create_empty_response():
         'current_page': 1
     })
 
+@app.route('/api/metrics/latest-values', methods=['GET'])
+def get_latest_values():
+    """
+    Get the newest value of every metric name of every device, however long ago it was reported.
+    Query parameters:
+    - metric_type: Optional, only return metrics of this type
+    - device_id: Optional, only return this device
+    - timestamp_format: 'iso' (default) or 'epoch_ms'
+    """
+    logger.debug("Handling GET request to latest-values")
+    try:
+        metric_type = request.args.get('metric_type')
+        if metric_type is not None and metric_type not in metrics_cache:
+            return jsonify({'error': 'Invalid metric type'}), 400
+        timestamp_format = request.args.get('timestamp_format', TIMESTAMP_ISO)
+        if timestamp_format not in (TIMESTAMP_ISO, TIMESTAMP_EPOCH_MS):
+            return jsonify({'error': 'Invalid timestamp format'}), 400
+
+        metrics = latest_values.get(metric_type, device_id=request.args.get('device_id'))
+        return jsonify({'metrics': _render_timestamps(metrics, timestamp_format)}), 200
+
+    except Exception as e:
+        logger.error(f"Error in get_latest_values: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/metrics/stream', methods=['GET'])
+def stream_metrics():
+    """
+    Stream newly stored metrics as Server-Sent Events.
+    Query parameters:
+    - metric_type: Optional, only stream metrics of this type
+    - device_id: Optional, only stream this device
+    - timestamp_format: 'iso' (default) or 'epoch_ms'
+
+    Each stored batch with matching metrics is sent as a 'metrics' event whose data is a
+    JSON list of metrics. A subscriber that falls too far behind gets a 'dropped' event and
+    the stream ends; EventSource clients reconnect after the advertised retry interval.
+    """
+    metric_type = request.args.get('metric_type')
+    if metric_type is not None and metric_type not in metrics_cache:
+        return jsonify({'error': 'Invalid metric type'}), 400
+    timestamp_format = request.args.get('timestamp_format', TIMESTAMP_ISO)
+    if timestamp_format not in (TIMESTAMP_ISO, TIMESTAMP_EPOCH_MS):
+        return jsonify({'error': 'Invalid timestamp format'}), 400
+    try:
+        subscription = event_broker.subscribe(metric_type, request.args.get('device_id'))
+    except SubscriberLimitError as e:
+        logger.warning(str(e))
+        response = jsonify({'error': 'Too many stream subscribers, retry later'})
+        response.headers['Retry-After'] = str(config.stream.retry_ms // 1000 or 1)
+        return response, 503
+
+    def events():
+        try:
+            yield f"retry: {config.stream.retry_ms}\n\n"
+            while True:
+                rows = subscription.get(timeout=config.stream.keepalive_seconds)
+                if subscription.dropped:
+                    yield "event: dropped\ndata: {}\n\n"
+                    return
+                if rows is None:
+                    yield ": keepalive\n\n"  # Also how a closed connection is noticed
+                    continue
+                yield f"event: metrics\ndata: {json.dumps(_render_timestamps(rows, timestamp_format))}\n\n"
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Keep reverse proxies from buffering the stream
+    return response
+
+@app.route('/api/metrics/history', methods=['GET'])
+def get_metric_history():
+    """
+    Get a time series over a range, downsampled to a resolution that suits its length.
+    Query parameters:
+    - metric_type: Type of metrics to retrieve
+    - start, end: Range in epoch milliseconds (default: the last 24 hours)
+    - max_points: Upper bound on points per device and metric name (default from config)
+    - device_id, name: Optional filters
+    - timestamp_format: 'iso' (default) or 'epoch_ms'
+    """
+    logger.debug("Handling GET request to metrics history")
+    try:
+        metric_type = request.args.get('metric_type')
+        if metric_type not in metrics_cache:
+            return jsonify({'error': 'Invalid metric type'}), 400
+        timestamp_format = request.args.get('timestamp_format', TIMESTAMP_ISO)
+        if timestamp_format not in (TIMESTAMP_ISO, TIMESTAMP_EPOCH_MS):
+            return jsonify({'error': 'Invalid timestamp format'}), 400
+        try:
+            end_ms = int(request.args.get('end', get_utc_timestamp_ms()))
+            start_ms = int(request.args.get('start', end_ms - HISTORY_DEFAULT_RANGE_MS))
+            max_points = min(HISTORY_MAX_POINTS_LIMIT,
+                             max(1, int(request.args.get('max_points', config.rollups.history_max_points))))
+        except (ValueError, TypeError):
+            return jsonify({'error': 'start, end and max_points must be integers'}), 400
+        if start_ms >= end_ms:
+            return jsonify({'error': 'start must be before end'}), 400
+
+        resolution, points = metrics_reporter.get_metric_history(
+            metric_type, start_ms, end_ms,
+            max_points=max_points,
+            device_id=request.args.get('device_id'),
+            name=request.args.get('name')
+        )
+        return jsonify({
+            'resolution_seconds': resolution,
+            'points': _render_timestamps(points, timestamp_format)
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error in get_metric_history: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/metrics/cache-stats', methods=['GET'])
+def get_cache_stats():
+    """Hit, miss, stale-served and refresh counters of the read cache of every metric type."""
+    return jsonify({metric_type: cache.stats() for metric_type, cache in metrics_cache.items()}), 200
+
 # Add a test route to verify the application is running
 @app.route('/', methods=['GET'])
 def health_check():
@@ -207,14 +690,12 @@ def health_check():
 
 @app.route('/api/poll-site', methods=['GET'])
 def poll_site():
-    global current_site  # We modify this global variable
     logger.debug("Received poll request for site opening")
 
     try:
-        if current_site is not None:
-            site_to_return = current_site  # Store the site URL temporarily
-            current_site = None  # Reset after serving it once
-            return jsonify({"status": "success", "site": site_to_return}), 200
+        site = shared_store.pop(SITE_QUEUE_KEY)  # Each site is served once, oldest first
+        if site is not None:
+            return jsonify({"status": "success", "site": site.decode()}), 200
 
         return jsonify({"status": "no_data"}), 200
 
@@ -223,16 +704,17 @@ def poll_site():
         return jsonify({"error": str(e)}), 500
 @app.route('/api/recieve-site', methods=['POST'])
 def receive_site():
-    global current_site  # Indicate that we are modifying the global variable
     try:
         data = request.get_json()
-        current_site = data.get('site_url')  # Update the global variable
+        site_url = data.get('site_url')
 
-        if not current_site:
+        if not site_url:
             logger.error("No trading site received")
             return jsonify({"error": "No site URL provided"}), 400
 
-        logger.info(f"{current_site} retrieved")
+        # Queued in the shared store, so whichever worker serves the next poll hands it out
+        shared_store.push(SITE_QUEUE_KEY, site_url.encode(), max_length=shared_state.site_queue_max)
+        logger.info(f"{site_url} retrieved")
 
         return jsonify({
             "status": "success",
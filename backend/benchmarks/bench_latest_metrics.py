@@ -0,0 +1,113 @@
+"""
+Compare the latency of the dashboard's latest-metrics read through the previous ORM
+query (joinedload plus a correlated EXISTS on the type, one lazy load per type and
+unit) against the column-projected Core select used by MetricsReporter.
+
+Run from the backend directory:
+    python -m benchmarks.bench_latest_metrics --rows 200000 --repeat 200
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.orm import joinedload
+
+from services.aggregator import DatabaseAggregator
+from services.db_models import Device, MetricMeasurement
+from services.query_plan import COVERING_INDEX, explain, uses_index
+from services.reporter import LATEST_METRICS_LIMIT, LATEST_METRICS_WINDOW, MetricsReporter
+from utils.timestamp import datetime_to_epoch_ms, get_utc_timestamp_ms
+
+
+def build_rows(count, devices=50):
+    """Rows of two metric types, one collection cycle per second, ending now."""
+    end_ms = get_utc_timestamp_ms()
+    per_cycle = devices * 3
+    rows = []
+    for i in range(count):
+        rows.append({
+            'device_id': f'device-{i % devices}',
+            'device_name': f'host-{i % devices}',
+            'name': ('CPU Load', 'RAM Usage', 'BTC-USD')[i % 3],
+            'value': float(i % 100),
+            'type': 'crypto' if i % 3 == 2 else 'system',
+            'unit': 'USD' if i % 3 == 2 else '%',
+            'timestamp_ms': end_ms - (count - i) // per_cycle * 1000,
+            'utc_offset': 0,
+        })
+    return rows
+
+
+def read_with_orm(reporter, metric_type):
+    """The previous read path, including the attribute access that triggered lazy loads."""
+    with reporter as session:
+        since_ms = datetime_to_epoch_ms(datetime.now(timezone.utc) - LATEST_METRICS_WINDOW)
+        metrics = (
+            session.query(MetricMeasurement)
+            .options(joinedload(MetricMeasurement.device).joinedload(Device.details))
+            .filter(MetricMeasurement.type.has(name=metric_type))
+            .filter(MetricMeasurement.timestamp_ms >= since_ms)
+            .order_by(MetricMeasurement.timestamp_ms.desc())
+            .limit(LATEST_METRICS_LIMIT)
+            .all()
+        )
+        return [
+            {
+                'device_id': str(metric.device.device_id),
+                'device_name': str(metric.device.details.device_name),
+                'name': str(metric.name),
+                'value': float(metric.value),
+                'type': str(metric.type.name),
+                'unit': str(metric.unit.unit_name),
+                'timestamp_ms': metric.timestamp_ms,
+                'utc_offset': metric.utc_offset,
+            }
+            for metric in metrics
+        ]
+
+
+def timed(label, func, repeat):
+    func()  # Warm up connections and caches
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<28} {elapsed * 1000:>8.3f} ms/read")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--database-url', default=None,
+                        help='Defaults to a throwaway SQLite file; point at a scratch MySQL schema for real numbers')
+    args = parser.parse_args()
+
+    tmp_dir = None
+    database_url = args.database_url
+    if database_url is None:
+        tmp_dir = tempfile.mkdtemp()
+        database_url = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+
+    aggregator = DatabaseAggregator(database_url, insert_chunk_size=5000)
+    aggregator.store_metrics(build_rows(args.rows))
+    reporter = MetricsReporter(database_url)
+
+    timed('ORM joinedload + EXISTS', lambda: read_with_orm(reporter, 'system'), args.repeat)
+    timed('Core select', lambda: reporter.get_all_latest_metrics('system'), args.repeat)
+
+    with reporter.engine.connect() as conn:
+        plan = explain(conn, reporter.build_latest_metrics_query(conn, 'system'))
+    print(f"Core select {'uses' if uses_index(plan, COVERING_INDEX) else 'does NOT use'} {COVERING_INDEX}")
+
+    if tmp_dir:
+        aggregator.engine.dispose()
+        reporter.engine.dispose()
+        os.remove(os.path.join(tmp_dir, 'bench.db'))
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
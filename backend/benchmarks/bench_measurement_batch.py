@@ -0,0 +1,84 @@
+"""
+Compare memory per queued measurement and upload serialization cost of a list of
+MeasurementDTO objects against a MeasurementBatch holding the same measurements.
+
+Run from the backend directory:
+    python -m benchmarks.bench_measurement_batch --rows 50000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from collector_agent.metrics_sdk import wire_format
+from collector_agent.metrics_sdk.dto import MeasurementDTO
+from collector_agent.metrics_sdk.measurement_batch import MeasurementBatch
+from utils.timestamp import iso_to_epoch_ms
+
+
+def build_dtos(count, devices=50):
+    """Measurements where each collection cycle shares one timestamp, as the formatter produces them."""
+    timestamp = datetime.now(timezone.utc).isoformat()
+    return [
+        MeasurementDTO(
+            device_id=f'device-{i % devices}',
+            device_name=f'host-{i % devices}',
+            name=('CPU Load', 'RAM Usage', 'Network Sent')[i % 3],
+            value=float(i % 100),
+            type='system',
+            unit='%',
+            timestamp_utc=timestamp,
+            utc_offset=0,
+        )
+        for i in range(count)
+    ]
+
+
+def build_batch(dtos):
+    batch = MeasurementBatch()
+    for dto in dtos:
+        batch.append(dto.device_id, dto.device_name, dto.name, dto.value, dto.type, dto.unit,
+                     iso_to_epoch_ms(dto.timestamp_utc), dto.utc_offset)
+    return batch
+
+
+def measure_memory(label, build, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{label:<28} {used / rows:>10.1f} bytes/measurement")
+    return kept
+
+
+def timed(label, func, rows, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<28} {elapsed * 1000:>10.2f} ms  {rows / elapsed:>12,.0f} measurements/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000)
+    args = parser.parse_args()
+
+    # Strings are shared by both representations, so only the per-row containers are measured
+    dtos = build_dtos(args.rows)
+    dtos = measure_memory('MeasurementDTO list', lambda: [MeasurementDTO(**vars(dto)) for dto in dtos], args.rows)
+    batch = measure_memory('MeasurementBatch', lambda: build_batch(dtos), args.rows)
+
+    timed('DTO list -> columnar', lambda: wire_format.encode_measurements(dtos), args.rows)
+    timed('Batch -> columnar', lambda: wire_format.encode_measurements(batch), args.rows)
+    timed('DTO list -> JSON rows', lambda: [dto.serialize() for dto in dtos], args.rows)
+    timed('Batch -> JSON rows', batch.serialize, args.rows)
+    # The request body as uploaded with the default JSON wire format
+    timed('DTO list -> JSON body', lambda: json.dumps([dto.serialize() for dto in dtos]).encode('utf-8'), args.rows)
+    timed('Batch -> JSON body', batch.to_json, args.rows)
+
+
+if __name__ == '__main__':
+    main()
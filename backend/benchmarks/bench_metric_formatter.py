@@ -0,0 +1,95 @@
+"""
+Compare MetricFormatter's compiled transform plans against the previous per-field
+rule walk, on collection cycles shaped like the system and crypto collectors' output.
+
+Run from the backend directory:
+    python -m benchmarks.bench_metric_formatter --cycles 2000 --pairs 10
+"""
+import argparse
+import logging
+import time
+
+from collector_agent.metrics_sdk.dto import MeasurementDTO
+from collector_agent.metrics_sdk.metric_formatter import MetricFormatter
+from config.config import load_config
+from utils.timestamp import get_utc_timestamp, get_utc_offset
+
+
+def build_cycle(pairs):
+    """One collection cycle: a system sample plus one ticker sample per pair."""
+    config = load_config()
+    cycle = [{
+        'collector_type': config.collector_types.system,
+        'device_id': 'device-0',
+        'device_name': 'host-0',
+        'cpu_load': 12.5,
+        'ram_usage': 48.1,
+        'network_sent': 1024.0,
+        'network_sent_rate': 0.25,
+        'network_recv_rate': 1.5,
+    }]
+    for i in range(pairs):
+        cycle.append({
+            'collector_type': config.collector_types.crypto,
+            'device_id': 'device-crypto',
+            'device_name': 'Coinbase Collector',
+            'currency_pair': f'PAIR{i}-USD',
+            'price': 100.0 + i,
+            'bid': 99.5 + i,
+            'ask': 100.5 + i,
+        })
+    return cycle
+
+
+def format_with_rule_walk(transform_rules, raw_metrics):
+    """The previous formatter: walk every rule per metric, render names and timestamps per measurement."""
+    formatted_metrics = []
+    for metric in raw_metrics:
+        collector_type = metric.get('collector_type')
+        rules = getattr(transform_rules, collector_type, None)
+        for field, rule in rules.__dict__.items():
+            if rule is not None and field in metric:
+                name = rule.name
+                if rule.format:
+                    name = name.format(**{k: metric[v] for k, v in rule.format.items()})
+                formatted_metrics.append(MeasurementDTO(
+                    device_id=metric['device_id'],
+                    device_name=metric['device_name'],
+                    name=name,
+                    value=float(metric[field]),
+                    type=collector_type,
+                    unit=rule.unit,
+                    timestamp_utc=get_utc_timestamp(),
+                    utc_offset=get_utc_offset()
+                ))
+    return formatted_metrics
+
+
+def timed(label, func, cycles):
+    measurements = 0
+    start = time.perf_counter()
+    for cycle in cycles:
+        measurements += len(func(cycle))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {measurements:>9} measurements  {elapsed:8.3f} s  "
+          f"{measurements / elapsed:>12,.0f} measurements/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cycles', type=int, default=2000)
+    parser.add_argument('--pairs', type=int, default=10)
+    args = parser.parse_args()
+
+    # Keep log output out of the timings
+    logging.disable(logging.INFO)
+
+    cycles = [build_cycle(args.pairs)] * args.cycles
+    formatter = MetricFormatter()
+
+    timed('Per-field rule walk', lambda cycle: format_with_rule_walk(formatter.transform_rules, cycle), cycles)
+    timed('Compiled plans', formatter.format, cycles)
+
+
+if __name__ == '__main__':
+    main()
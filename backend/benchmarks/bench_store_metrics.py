@@ -0,0 +1,93 @@
+"""
+Compare ingest throughput of the ORM bulk_save_objects path against the Core
+executemany path used by DatabaseAggregator.store_metrics.
+
+Run from the backend directory:
+    python -m benchmarks.bench_store_metrics --rows 20000 --chunk-size 1000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from services.aggregator import DatabaseAggregator
+from services.db_models import MetricMeasurement, MetricType, Unit
+
+
+def build_rows(count, devices=50):
+    """Build upload-shaped rows where each collection cycle shares one ISO timestamp."""
+    start = datetime.now(timezone.utc)
+    rows = []
+    for i in range(count):
+        rows.append({
+            'device_id': f'device-{i % devices}',
+            'device_name': f'host-{i % devices}',
+            'name': ('CPU Load', 'RAM Usage', 'Network Sent')[i % 3],
+            'value': float(i % 100),
+            'type': 'system',
+            'unit': '%',
+            'timestamp_utc': (start + timedelta(seconds=i // (devices * 3))).isoformat(),
+            'utc_offset': 0,
+        })
+    return rows
+
+
+def store_with_orm(aggregator, rows):
+    """The previous write path: one MetricMeasurement object per row, parsed per row."""
+    with aggregator as session:
+        type_id = session.query(MetricType).filter_by(name='system').one().id
+        unit_id = session.query(Unit).filter_by(unit_name='%').one().id
+        measurements = [
+            MetricMeasurement(
+                device_id=row['device_id'],
+                name=row['name'],
+                value=float(row['value']),
+                type_id=type_id,
+                unit_id=unit_id,
+                timestamp_utc=datetime.fromisoformat(row['timestamp_utc']),
+                utc_offset=row['utc_offset'],
+            )
+            for row in rows
+        ]
+        session.bulk_save_objects(measurements)
+
+
+def timed(label, func, rows):
+    start = time.perf_counter()
+    func(rows)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {len(rows):>8} rows  {elapsed:8.3f} s  {len(rows) / elapsed:>12,.0f} rows/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--database-url', default=None,
+                        help='Defaults to a throwaway SQLite file; point at a scratch MySQL schema for real numbers')
+    args = parser.parse_args()
+
+    tmp_dir = None
+    database_url = args.database_url
+    if database_url is None:
+        tmp_dir = tempfile.mkdtemp()
+        database_url = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+
+    aggregator = DatabaseAggregator(database_url, insert_chunk_size=args.chunk_size)
+    rows = build_rows(args.rows)
+
+    # Warm up dimensions so both paths only measure measurement inserts
+    aggregator.store_metrics(rows[:150])
+
+    timed('ORM bulk_save_objects', lambda batch: store_with_orm(aggregator, batch), rows)
+    timed(f'Core executemany ({args.chunk_size})', aggregator.store_metrics, rows)
+
+    if tmp_dir:
+        aggregator.engine.dispose()
+        os.remove(os.path.join(tmp_dir, 'bench.db'))
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
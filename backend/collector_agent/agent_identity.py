@@ -0,0 +1,79 @@
+import json
+import os
+import uuid
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+from utils.logger import get_logger
+
+logger = get_logger('AgentIdentity')
+
+_STATE_FILE = 'agent.json'
+
+
+class AgentIdentity:
+    """Id of one agent instance and the sequence numbers of its upload batches.
+
+    The server deduplicates batches per (agent id, sequence number), so the id must be
+    unique per running agent and its sequence numbers must only ever increase. Neither
+    depends on the host or the wall clock.
+
+    Without a directory the id is a fresh UUID per process and sequence numbers start at
+    zero: nothing is queued across a restart, so nothing needs to be recognised across one.
+    With a directory (the spool's, whose queue does survive restarts) the id and the
+    sequence counter are kept in agent.json there. The counter is persisted a block of
+    block_size numbers ahead, so a restart skips at most that many numbers and batches
+    only cost a file write once per block.
+    """
+
+    def __init__(self, directory: Optional[str] = None, block_size: int = 256):
+        self.directory = Path(directory) if directory else None
+        self.block_size = max(1, block_size)
+        self._lock = Lock()
+
+        if self.directory is None:
+            self.agent_id = uuid.uuid4().hex
+            self._next_seq = 0
+            self._reserved_until = None
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        state = self._load()
+        self.agent_id = state.get('agent_id') or uuid.uuid4().hex
+        self._next_seq = int(state.get('next_batch_seq', 0))
+        self._reserved_until = self._next_seq
+        self._reserve()
+        logger.info(f"Agent {self.agent_id} resuming at batch {self._next_seq}")
+
+    def next_seq(self) -> int:
+        """Return the next batch sequence number."""
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            if self._reserved_until is not None and self._next_seq > self._reserved_until:
+                self._reserve()
+            return seq
+
+    def _reserve(self) -> None:
+        self._reserved_until = self._next_seq + self.block_size
+        self._write({'agent_id': self.agent_id, 'next_batch_seq': self._reserved_until})
+
+    def _load(self) -> dict:
+        path = self.directory / _STATE_FILE
+        if not path.exists():
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            # A new id is safe: the server tracks it as a different agent
+            logger.warning(f"Unreadable agent state {path}, starting as a new agent: {str(e)}")
+            return {}
+
+    def _write(self, state: dict) -> None:
+        tmp_path = self.directory / (_STATE_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.directory / _STATE_FILE)
@@ -2,7 +2,11 @@ from abc import ABC, abstractmethod
 
 class BaseCollector(ABC):
     """Base interface for all collectors."""
-    
+
+    # Seconds one upstream request may take, for collectors that make them; the
+    # registry never gives such a collector a shorter deadline than this
+    request_timeout = None
+
     @abstractmethod
     def __init__(self):
         self.latest_metrics = {}
@@ -1,28 +1,87 @@
-from typing import Dict, List, Any
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, Any, Optional
 from .base_collector import BaseCollector
 from utils.logger import get_logger
 
 logger = get_logger('CollectorRegistry')
 
+# Headroom on top of a collector's request_timeout for the work around its requests
+REQUEST_TIMEOUT_MARGIN_SECONDS = 1.0
+
+
+@dataclass
+class CollectorStats:
+    """Timing counters for one collector."""
+    runs: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    skipped: int = 0
+    last_duration: float = 0.0
+    max_duration: float = 0.0
+    total_duration: float = 0.0
+
+    @property
+    def average_duration(self) -> float:
+        return self.total_duration / self.runs if self.runs else 0.0
+
+
+@dataclass
+class CollectorSchedule:
+    """How often a collector is sampled.
+
+    interval is in seconds, jitter adds a random delay of up to that many seconds to
+    each run, and align snaps runs to wall-clock multiples of the interval.
+    """
+    interval: Optional[float] = None
+    jitter: float = 0.0
+    align: bool = False
+
+
 class CollectorRegistry:
     """Registry for managing metric collectors."""
-    
-    def __init__(self):
+
+    def __init__(self, default_timeout: float = 5.0, max_workers: Optional[int] = None):
         self.collectors: Dict[str, BaseCollector] = {}
+        self.timeouts: Dict[str, float] = {}
+        self.schedules: Dict[str, CollectorSchedule] = {}
+        self.stats: Dict[str, CollectorStats] = {}
+        self.default_timeout = default_timeout
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._in_flight: Dict[str, Future] = {}
+        self._in_flight_lock = Lock()
+        self._stats_lock = Lock()
+        self._executor_lock = Lock()
 
-    def register(self, name: str, collector: BaseCollector) -> None:
-        """Register a new collector."""
+    def register(self, name: str, collector: BaseCollector, timeout: Optional[float] = None,
+                 schedule: Optional[CollectorSchedule] = None) -> None:
+        """
+        Register a new collector, optionally with its own collection deadline in seconds and schedule.
+        Without a deadline it gets default_timeout, raised to cover the collector's request_timeout.
+        """
         if not isinstance(collector, BaseCollector):
             logger.error(f"Collector must inherit from BaseCollector: {collector}")
             raise ValueError(f"Collector must inherit from BaseCollector: {collector}")
-        
+
         self.collectors[name] = collector
+        if timeout is None:
+            timeout = self.default_timeout
+            if collector.request_timeout:
+                timeout = max(timeout, collector.request_timeout + REQUEST_TIMEOUT_MARGIN_SECONDS)
+        self.timeouts[name] = timeout
+        self.schedules[name] = schedule or CollectorSchedule()
+        self.stats.setdefault(name, CollectorStats())
         logger.info(f"Registered collector: {name}")
 
     def unregister(self, name: str) -> None:
         """Remove a collector from registry."""
         if name in self.collectors:
             del self.collectors[name]
+            self.timeouts.pop(name, None)
+            self.schedules.pop(name, None)
             logger.info(f"Unregistered collector: {name}")
 
     def get_collector(self, name: str) -> BaseCollector:
@@ -33,15 +92,93 @@ class CollectorRegistry:
         """Get all registered collectors."""
         return self.collectors
 
+    def get_stats(self) -> Dict[str, CollectorStats]:
+        """Get a copy of the timing stats of every collector."""
+        with self._stats_lock:
+            return {name: CollectorStats(**vars(stats)) for name, stats in self.stats.items()}
+
     def collect_all(self) -> List[Dict[str, Any]]:
-        """Collect metrics from all registered collectors."""
+        """
+        Collect metrics from all registered collectors concurrently.
+
+        Each collector runs on the worker pool and gets its own deadline. A collector that
+        misses it is logged and its sample is dropped, without delaying the others. A
+        collector still running from a previous cycle is skipped instead of being started
+        a second time.
+        """
+        return self.collect(list(self.collectors))
+
+    def collect(self, names: List[str]) -> List[Dict[str, Any]]:
+        """Collect metrics from the named collectors concurrently, see collect_all."""
+        started = time.monotonic()
+        futures = {}
+        for name in names:
+            collector = self.collectors.get(name)
+            if collector is None:
+                continue
+            # Scheduler dispatch threads collect concurrently, so check and claim under the lock
+            with self._in_flight_lock:
+                previous = self._in_flight.get(name)
+                if previous is None or previous.done():
+                    futures[name] = self._in_flight[name] = self._get_executor().submit(
+                        self._run_collector, name, collector)
+            if name not in futures:
+                logger.warning(f"Collector {name} is still running from a previous cycle, skipping it")
+                self._record(name, skipped=True)
+
         raw_metrics = []
-        for name, collector in self.collectors.items():
+        for name, future in futures.items():
+            remaining = max(0.0, started + self.timeouts[name] - time.monotonic())
             try:
-                metrics = collector.collect_metrics()
-                if isinstance(metrics, dict):
-                    metrics = [metrics]  # Convert single dict to list
-                raw_metrics.extend(metrics)
+                metrics = future.result(timeout=remaining)
+            except TimeoutError:
+                logger.error(f"Collector {name} missed its {self.timeouts[name]}s deadline, dropping its sample")
+                self._record(name, timed_out=True)
+                continue
             except Exception as e:
                 logger.error(f"Error collecting from {name}: {str(e)}")
+                continue
+            if isinstance(metrics, dict):
+                metrics = [metrics]  # Convert single dict to list
+            raw_metrics.extend(metrics)
+
+        logger.debug(f"Collected {len(raw_metrics)} raw metrics in {time.monotonic() - started:.3f}s")
         return raw_metrics
+
+    def shutdown(self) -> None:
+        """Stop the worker pool without waiting for hung collectors."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                # Leave headroom for hung collectors that still hold a worker
+                workers = self.max_workers or max(2, 2 * len(self.collectors))
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Collector')
+            return self._executor
+
+    def _run_collector(self, name: str, collector: BaseCollector):
+        start = time.perf_counter()
+        try:
+            return collector.collect_metrics()
+        except Exception:
+            self._record(name, failed=True)
+            raise
+        finally:
+            self._record(name, duration=time.perf_counter() - start)
+
+    def _record(self, name: str, duration: Optional[float] = None, failed: bool = False,
+                timed_out: bool = False, skipped: bool = False) -> None:
+        with self._stats_lock:
+            stats = self.stats.setdefault(name, CollectorStats())
+            if duration is not None:
+                stats.runs += 1
+                stats.last_duration = duration
+                stats.total_duration += duration
+                stats.max_duration = max(stats.max_duration, duration)
+            stats.failures += failed
+            stats.timeouts += timed_out
+            stats.skipped += skipped
@@ -1,6 +1,13 @@
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 import requests
+from requests.adapters import HTTPAdapter
 from utils.logger import get_logger
+from utils.timestamp import get_utc_timestamp
 from .base_collector import BaseCollector
+from .tick_stream import BarAggregator, TickStream
 from config.config import load_config
 import machineid
 
@@ -8,27 +15,101 @@ import machineid
 logger = get_logger('CryptoCollector')
 config = load_config()
 
+
+class _TickerCacheEntry:
+    """Last good ticker response for a pair and the validators to revalidate it.
+
+    fetched_at is monotonic, for age checks; fetched_at_utc is the ISO time the value
+    was last confirmed upstream, which a stale value is reported with. stale_reported
+    is set once it has been, so an outage does not report the same row every cycle.
+    """
+    __slots__ = ('metric', 'etag', 'last_modified', 'fetched_at', 'fetched_at_utc', 'stale_reported')
+
+    def __init__(self, metric, etag, last_modified, fetched_at, fetched_at_utc):
+        self.metric = metric
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.fetched_at_utc = fetched_at_utc
+        self.stale_reported = False
+
+
 class CryptoCollector(BaseCollector):
-    """Collects cryptocurrency metrics from Coinbase API."""
+    """Collects cryptocurrency metrics from Coinbase API.
+
+    Pairs are fetched concurrently on a bounded pool. Each pair's last response is kept
+    for cache_ttl_seconds and revalidated with If-None-Match / If-Modified-Since after
+    that. If the upstream fails, the cached value is reused for up to
+    stale_max_age_seconds before the pair is dropped from the cycle. A reused value
+    keeps the timestamp of its fetch, so it is never stored as a current price, and is
+    only reported once: later cycles of the same outage skip the pair.
+
+    In stream mode the collector instead consumes the push ticker feed at stream_url,
+    folds ticks into bar_interval_seconds OHLC bars per pair, and each collection
+    returns only the bars that have closed since the previous one.
+    """
 
     def __init__(self):
         super().__init__()
-        self.currency_pairs = config.crypto_collector.currency_pairs
-        self.base_url = config.crypto_collector.base_url
+        crypto_config = config.crypto_collector
+        self.currency_pairs = crypto_config.currency_pairs
+        self.base_url = crypto_config.base_url
         self.collector_type = config.collector_types.crypto
-        self.device_id = machineid.hashed_id(config.crypto_collector.device_id)
+        self.device_id = machineid.hashed_id(crypto_config.device_id)
     
-        self.ticker_endpoint = config.crypto_collector.ticker_endpoint
-        self.device_name = config.crypto_collector.device_name
+        self.ticker_endpoint = crypto_config.ticker_endpoint
+        self.device_name = crypto_config.device_name
+        self.request_timeout = crypto_config.request_timeout
+        self.cache_ttl_seconds = crypto_config.cache_ttl_seconds
+        self.stale_max_age_seconds = crypto_config.stale_max_age_seconds
         self.latest_metrics = []
-        self.session = requests.Session()  # Initialize session here
+
+        workers = max(1, min(crypto_config.max_workers, len(self.currency_pairs)))
+        self.session = requests.Session()
+        # One pooled connection per worker so concurrent fetches do not queue for a socket
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='CryptoFetch')
+
+        self._cache = {}  # pair -> _TickerCacheEntry
+        self._cache_lock = Lock()
+
+        self.stream = None
+        self.bars = None
+        if crypto_config.mode == 'stream':
+            self.bars = BarAggregator(crypto_config.bar_interval_seconds)
+            self.stream = TickStream(
+                crypto_config.stream_url,
+                self.currency_pairs,
+                self.bars.add_tick,
+                reconnect_seconds=crypto_config.stream_reconnect_seconds
+            )
+            self.stream.start()
 
     def _fetch_single_pair(self, pair):
-        """Fetch metrics for a single currency pair."""
+        """Fetch metrics for a single currency pair, using the cache where possible."""
+        with self._cache_lock:
+            cached = self._cache.get(pair)
+        now = time.monotonic()
+        if cached and now - cached.fetched_at < self.cache_ttl_seconds:
+            logger.debug(f"Using cached ticker for {pair}")
+            return cached.metric
+
         logger.info(f"Fetching metrics for currency pair: {pair}")
         try:
             url = f'{self.base_url}/{pair}/{self.ticker_endpoint}'
-            response = self.session.get(url, timeout=5)  # Use the session here
+            headers = {}
+            if cached and cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached and cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+
+            response = self.session.get(url, headers=headers, timeout=self.request_timeout)
+            if response.status_code == 304 and cached:
+                logger.debug(f"Ticker for {pair} not modified")
+                self._store(pair, cached.metric, cached.etag, cached.last_modified)
+                return cached.metric
             response.raise_for_status()
             data = response.json()
 
@@ -41,21 +122,62 @@ class CryptoCollector(BaseCollector):
                 'bid': round(float(data['bid']), 2),
                 'ask': round(float(data['ask']), 2)
             }
+            self._store(pair, crypto_metric, response.headers.get('ETag'), response.headers.get('Last-Modified'))
 
             logger.info(f"Fetched metrics for {pair}: {crypto_metric}")
             return crypto_metric
         except Exception as e:
+            if cached and time.monotonic() - cached.fetched_at < self.stale_max_age_seconds:
+                with self._cache_lock:
+                    already_reported, cached.stale_reported = cached.stale_reported, True
+                if already_reported:
+                    logger.warning(f"Error fetching {pair}, its value from {cached.fetched_at_utc} "
+                                   f"was already reported: {str(e)}")
+                    return None
+                logger.warning(f"Error fetching {pair}, reusing value from "
+                               f"{time.monotonic() - cached.fetched_at:.1f}s ago: {str(e)}")
+                return dict(cached.metric, timestamp_utc=cached.fetched_at_utc)
             logger.error(f"Error fetching {pair}: {str(e)}")
             return None
 
+    def _store(self, pair, metric, etag, last_modified):
+        with self._cache_lock:
+            self._cache[pair] = _TickerCacheEntry(metric, etag, last_modified, time.monotonic(), get_utc_timestamp())
+
+    def _collect_bars(self):
+        """Closed OHLC bars as raw metrics, timestamped with the start of their interval."""
+        if not self.stream.connected:
+            logger.warning(f"Ticker feed {self.stream.url} is not connected")
+        metrics = [
+            {
+                'collector_type': self.collector_type,
+                'device_id': self.device_id,
+                'device_name': self.device_name,
+                'currency_pair': bar.pair,
+                'timestamp_utc': datetime.fromtimestamp(bar.start, timezone.utc).isoformat(),
+                'open': bar.open,
+                'high': bar.high,
+                'low': bar.low,
+                'close': bar.close,
+                'volume': round(bar.volume, 8)
+            }
+            for bar in self.bars.drain_closed()
+            if bar.pair in self.currency_pairs
+        ]
+        logger.info(f"Collected {len(metrics)} closed crypto bars")
+        return metrics
+
     def collect_metrics(self):
         """Collects current crypto metrics for all pairs."""
+        if self.stream is not None:
+            metrics = self._collect_bars()
+            if metrics:
+                self.latest_metrics = metrics
+            return metrics
+
         logger.info("Starting to collect crypto metrics for all pairs.")
-        metrics = []
-        for pair in self.currency_pairs:
-            pair_data = self._fetch_single_pair(pair)
-            if pair_data:
-                metrics.append(pair_data)
+        metrics = [pair_data for pair_data in self.executor.map(self._fetch_single_pair, self.currency_pairs)
+                   if pair_data]
 
         self.latest_metrics = metrics
         logger.info(f"Collected crypto metrics: {metrics}")
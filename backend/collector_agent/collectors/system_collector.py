@@ -1,4 +1,5 @@
 import socket
+import time
 import psutil
 from config.config import load_config
 from utils.logger import get_logger
@@ -9,45 +10,109 @@ import machineid
 logger = get_logger('SystemCollector')
 config = load_config()
 
+BYTES_PER_MB = 1024 * 1024
+
+
+class SystemSnapshot:
+    """Raw psutil counters read in a single pass, used as the baseline for the next cycle."""
+    __slots__ = ('taken_at', 'cpu_times', 'per_core_times', 'memory', 'network', 'disk')
+
+    def __init__(self, per_core: bool):
+        self.taken_at = time.monotonic()
+        self.cpu_times = psutil.cpu_times()
+        self.per_core_times = psutil.cpu_times(percpu=True) if per_core else None
+        self.memory = psutil.virtual_memory()
+        self.network = psutil.net_io_counters()
+        self.disk = psutil.disk_io_counters()
+
+
+def _cpu_total(times) -> float:
+    # On Linux guest time is already included in user and nice time
+    return sum(times) - getattr(times, 'guest', 0) - getattr(times, 'guest_nice', 0)
+
+
+def _busy_percent(previous, current) -> float:
+    """CPU utilisation between two cpu_times readings, without sleeping."""
+    total = _cpu_total(current) - _cpu_total(previous)
+    idle = (current.idle - previous.idle) + (getattr(current, 'iowait', 0) - getattr(previous, 'iowait', 0))
+    if total <= 0:
+        return 0.0
+    return max(0.0, min(100.0, 100.0 * (total - idle) / total))
+
+
+def _rate(previous, current, elapsed: float) -> float:
+    """Counter delta per second in MB, treating counter resets as zero."""
+    if elapsed <= 0:
+        return 0.0
+    return max(0, current - previous) / BYTES_PER_MB / elapsed
+
 
 class SystemCollector(BaseCollector):
-    """Collects system metrics including CPU, RAM, and network usage."""
+    """Collects system metrics including CPU, RAM, network and disk throughput.
+
+    CPU utilisation and throughput rates are computed as deltas against the snapshot
+    kept from the previous cycle, so collection never blocks.
+    """
 
     def __init__(self):
         super().__init__()
         self.device_id = machineid.hashed_id()
         self.device_name = socket.gethostname()
         self.collector_type = config.collector_types.system
+        self.per_core_cpu = config.system_collector.per_core_cpu
         self.latest_metrics = {}
+        # Baseline for the first cycle's deltas
+        self.previous_snapshot = SystemSnapshot(self.per_core_cpu)
 
     def collect_metrics(self):
         """Gathers system performance metrics."""
         logger.info("Starting to collect system metrics.")
         try:
-            network = psutil.net_io_counters()
+            previous, current = self.previous_snapshot, SystemSnapshot(self.per_core_cpu)
+            elapsed = current.taken_at - previous.taken_at
 
             metrics = {
                 'collector_type': self.collector_type,
                 'device_id': self.device_id,
                 'device_name': self.device_name,
-                'cpu_load': round(psutil.cpu_percent(interval=1), 2),
-                'ram_usage': round(psutil.virtual_memory().percent, 2),
-                'network_sent': round(network.bytes_sent / (1024 * 1024), 2)
+                'cpu_load': round(_busy_percent(previous.cpu_times, current.cpu_times), 2),
+                'ram_usage': round(current.memory.percent, 2),
+                'network_sent': round(current.network.bytes_sent / BYTES_PER_MB, 2),
+                'network_sent_rate': round(_rate(previous.network.bytes_sent, current.network.bytes_sent, elapsed), 4),
+                'network_recv_rate': round(_rate(previous.network.bytes_recv, current.network.bytes_recv, elapsed), 4),
             }
+            if previous.disk is not None and current.disk is not None:
+                metrics['disk_read_rate'] = round(_rate(previous.disk.read_bytes, current.disk.read_bytes, elapsed), 4)
+                metrics['disk_write_rate'] = round(_rate(previous.disk.write_bytes, current.disk.write_bytes, elapsed), 4)
+
+            self.previous_snapshot = current
+
+            if self.per_core_cpu:
+                metrics = [metrics] + self._per_core_metrics(previous, current)
 
             self.latest_metrics = metrics
             logger.info(f"Collected system metrics: {metrics}")
             return metrics
-            
+
         except Exception as e:
             logger.error(f"Error collecting system metrics: {str(e)}")
             return {}
 
+    def _per_core_metrics(self, previous: SystemSnapshot, current: SystemSnapshot):
+        return [
+            {
+                'collector_type': self.collector_type,
+                'device_id': self.device_id,
+                'device_name': self.device_name,
+                'core': core,
+                'cpu_core_load': round(_busy_percent(before, after), 2),
+            }
+            for core, (before, after) in enumerate(zip(previous.per_core_times, current.per_core_times))
+        ]
+
     def get_latest_metrics(self):
         """Gets the latest collected system metrics."""
         logger.info("Fetching the latest collected system metrics.")
         latest_metrics = self.latest_metrics if self.latest_metrics else self.collect_metrics()
         logger.info(f"Latest system metrics: {latest_metrics}")
         return latest_metrics
-
-
@@ -0,0 +1,178 @@
+import json
+import math
+import time
+from datetime import datetime, timezone
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+import requests
+from utils.logger import get_logger
+
+try:
+    import websocket  # websocket-client, only needed for ws:// and wss:// feeds
+except ImportError:
+    websocket = None
+
+logger = get_logger('TickStream')
+
+MAX_RECONNECT_BACKOFF_SECONDS = 60
+
+
+class OhlcBar:
+    """Open/high/low/close/volume of one pair over one bar interval."""
+    __slots__ = ('pair', 'start', 'open', 'high', 'low', 'close', 'volume', 'ticks')
+
+    def __init__(self, pair: str, start: float, price: float, size: float):
+        self.pair = pair
+        self.start = start
+        self.open = self.high = self.low = self.close = price
+        self.volume = size
+        self.ticks = 1
+
+    def add(self, price: float, size: float) -> None:
+        if price > self.high:
+            self.high = price
+        if price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += size
+        self.ticks += 1
+
+
+class BarAggregator:
+    """Folds ticks into per-pair bars aligned to multiples of interval seconds.
+
+    A bar closes when a tick for a later interval arrives, or once the wall clock has
+    passed its end so quiet pairs are still flushed. Ticks for an interval that has
+    already closed are dropped and counted in late_ticks.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._open: Dict[str, OhlcBar] = {}
+        self._last_closed_start: Dict[str, float] = {}
+        self._closed: List[OhlcBar] = []
+        self._lock = Lock()
+        self.late_ticks = 0
+
+    def add_tick(self, pair: str, price: float, size: float, timestamp: float) -> None:
+        start = math.floor(timestamp / self.interval) * self.interval
+        with self._lock:
+            bar = self._open.get(pair)
+            if bar is not None and bar.start == start:
+                bar.add(price, size)
+                return
+            if (bar is not None and start < bar.start) or start <= self._last_closed_start.get(pair, -math.inf):
+                self.late_ticks += 1
+                return
+            if bar is not None:
+                self._close(bar)
+            self._open[pair] = OhlcBar(pair, start, price, size)
+
+    def drain_closed(self, now: Optional[float] = None) -> List[OhlcBar]:
+        """Return and forget every bar that has closed by now (epoch seconds)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            for pair, bar in list(self._open.items()):
+                if bar.start + self.interval <= now:
+                    self._close(self._open.pop(pair))
+            closed, self._closed = self._closed, []
+        return closed
+
+    def _close(self, bar: OhlcBar) -> None:
+        self._closed.append(bar)
+        self._last_closed_start[bar.pair] = bar.start
+
+
+def parse_ticker(message: dict) -> Optional[Tuple[str, float, float, float]]:
+    """Extract (pair, price, size, epoch seconds) from a Coinbase-style ticker message."""
+    if message.get('type') != 'ticker' or 'price' not in message:
+        return None
+    timestamp = message.get('time')
+    if timestamp:
+        parsed = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        epoch = parsed.timestamp()
+    else:
+        epoch = time.time()
+    return message['product_id'], float(message['price']), float(message.get('last_size') or 0.0), epoch
+
+
+class TickStream:
+    """Consumes a push ticker feed on a background thread and hands each tick to on_tick.
+
+    ws:// and wss:// URLs are read with websocket-client, sending a Coinbase subscribe
+    message for the ticker channel. Any other URL is read as newline-delimited JSON
+    over a streaming HTTP response, which is also what a local stand-in feed serves.
+    The connection is re-established with exponential backoff when it drops.
+    """
+
+    def __init__(self, url: str, pairs: List[str], on_tick: Callable[[str, float, float, float], None],
+                 reconnect_seconds: float = 5.0, timeout: float = 30.0):
+        self.url = url
+        self.pairs = list(pairs)
+        self.on_tick = on_tick
+        self.reconnect_seconds = reconnect_seconds
+        self.timeout = timeout
+        self.connected = False
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def start(self) -> None:
+        if self.url.startswith(('ws://', 'wss://')) and websocket is None:
+            raise ValueError("websocket-client is required for ws:// ticker feeds")
+        self._thread = Thread(target=self._run, name='TickStream', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        backoff = self.reconnect_seconds
+        while not self._stop.is_set():
+            try:
+                if self.url.startswith(('ws://', 'wss://')):
+                    self._consume_websocket()
+                else:
+                    self._consume_http()
+                backoff = self.reconnect_seconds
+            except Exception as e:
+                logger.error(f"Ticker feed {self.url} failed: {str(e)}")
+            finally:
+                self.connected = False
+            if self._stop.wait(backoff):
+                break
+            logger.info(f"Reconnecting to ticker feed {self.url}")
+            backoff = min(backoff * 2, MAX_RECONNECT_BACKOFF_SECONDS)
+
+    def _consume_http(self) -> None:
+        params = {'product_ids': ','.join(self.pairs)}
+        with requests.get(self.url, params=params, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            self.connected = True
+            logger.info(f"Connected to ticker feed {self.url}")
+            for line in response.iter_lines():
+                if self._stop.is_set():
+                    return
+                if line:
+                    self._handle(line)
+
+    def _consume_websocket(self) -> None:
+        connection = websocket.create_connection(self.url, timeout=self.timeout)
+        try:
+            connection.send(json.dumps({'type': 'subscribe', 'product_ids': self.pairs, 'channels': ['ticker']}))
+            self.connected = True
+            logger.info(f"Connected to ticker feed {self.url}")
+            while not self._stop.is_set():
+                self._handle(connection.recv())
+        finally:
+            connection.close()
+
+    def _handle(self, raw) -> None:
+        try:
+            tick = parse_ticker(json.loads(raw))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Skipping malformed ticker message: {str(e)}")
+            return
+        if tick is not None:
+            self.on_tick(*tick)
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Optional
 
 @dataclass
 class MeasurementDTO:
@@ -12,10 +13,11 @@ class MeasurementDTO:
     unit: str       
     timestamp_utc: datetime  
     utc_offset: int
+    timestamp_ms: Optional[int] = None  # The same instant as integer epoch milliseconds, when known
 
     def serialize(self) -> dict:
         """Serialize measurement for JSON transmission"""
-        return {
+        serialized = {
             'device_id': str(self.device_id),
             'device_name': str(self.device_name),
             'name': str(self.name),
@@ -24,4 +26,7 @@ class MeasurementDTO:
             'unit': str(self.unit),
             'timestamp_utc': self.timestamp_utc,
             'utc_offset': self.utc_offset
-        }
\ No newline at end of file
+        }
+        if self.timestamp_ms is not None:
+            serialized['timestamp_ms'] = int(self.timestamp_ms)
+        return serialized
\ No newline at end of file
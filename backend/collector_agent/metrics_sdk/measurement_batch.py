@@ -0,0 +1,284 @@
+import json
+import math
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+from utils.timestamp import epoch_ms_to_datetime, iso_to_epoch_ms
+from .dto import MeasurementDTO
+
+ISO = 'iso'
+EPOCH_MS = 'epoch_ms'
+
+# Columns holding indexes into the batch's interned string table, in wire format order
+STRING_COLUMNS = ('device_id', 'device_name', 'name', 'type', 'unit')
+INDEX_TYPECODE = 'I'
+VALUE_TYPECODE = 'd'
+TIMESTAMP_TYPECODE = 'q'
+OFFSET_TYPECODE = 'i'  # UTC offsets in whole minutes, as get_utc_offset() returns them
+
+
+class MeasurementBatch:
+    """Column-oriented container for measurements.
+
+    Values, epoch millisecond timestamps and UTC offsets are kept in parallel typed
+    arrays, and the string fields as indexes into one interned string table, so a
+    queued measurement costs a few dozen bytes instead of a dataclass and its dict.
+
+    Slicing returns a view that shares the columns of the batch it was cut from, so
+    taking part of a batch copies nothing. Only the batch that owns its columns can be
+    appended to. view() exposes a column of the batch's rows without copying it, while
+    the values / timestamps_ms / utc_offsets properties return copies. Iterating or
+    indexing still yields MeasurementDTO objects for callers that want one row at a time.
+    """
+    __slots__ = ('strings', '_string_ids', '_indexes', '_values', '_timestamps', '_offsets', '_start', '_stop')
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        self._indexes: Dict[str, array] = {column: array(INDEX_TYPECODE) for column in STRING_COLUMNS}
+        self._values = array(VALUE_TYPECODE)
+        self._timestamps = array(TIMESTAMP_TYPECODE)
+        self._offsets = array(OFFSET_TYPECODE)
+        self._start = 0
+        self._stop: Optional[int] = None  # None while the batch owns its columns and can still grow
+
+    @classmethod
+    def from_measurements(cls, measurements: Iterable[MeasurementDTO]) -> 'MeasurementBatch':
+        """Build a batch from MeasurementDTO objects, using timestamp_ms when set and the ISO timestamp otherwise."""
+        batch = cls()
+        epoch_cache: Dict[str, int] = {}
+        for measurement in measurements:
+            epoch_ms = measurement.timestamp_ms
+            if epoch_ms is None:
+                timestamp = measurement.timestamp_utc
+                epoch_ms = epoch_cache.get(timestamp)
+                if epoch_ms is None:
+                    epoch_ms = epoch_cache[timestamp] = iso_to_epoch_ms(timestamp)
+            batch.append(measurement.device_id, measurement.device_name, measurement.name, measurement.value,
+                         measurement.type, measurement.unit, epoch_ms, measurement.utc_offset)
+        return batch
+
+    @classmethod
+    def from_columns(cls, strings: List[str], indexes: Dict[str, array], values: array,
+                     timestamps: array, offsets: array) -> 'MeasurementBatch':
+        """Wrap already decoded columns without copying them."""
+        batch = cls()
+        batch.strings = strings
+        batch._string_ids = {string: index for index, string in enumerate(strings)}
+        batch._indexes = indexes
+        batch._values = values
+        batch._timestamps = timestamps
+        batch._offsets = offsets
+        return batch
+
+    @classmethod
+    def concat(cls, batches: List['MeasurementBatch']) -> 'MeasurementBatch':
+        """Join batches into one new batch with a merged string table."""
+        batches = [batch for batch in batches if len(batch)]
+        if len(batches) == 1:
+            return batches[0]
+        result = cls()
+        for batch in batches:
+            remap = [result.intern(string) for string in batch.strings]
+            for column in STRING_COLUMNS:
+                result._indexes[column].extend(map(remap.__getitem__, batch.view(column)))
+            result._values.frombytes(batch.view('value').cast('B'))
+            result._timestamps.frombytes(batch.view('timestamp_ms').cast('B'))
+            result._offsets.frombytes(batch.view('utc_offset').cast('B'))
+        return result
+
+    def intern(self, string: str) -> int:
+        """Index of string in this batch's string table, adding it if needed."""
+        index = self._string_ids.get(string)
+        if index is None:
+            index = self._string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+    def append(self, device_id: str, device_name: str, name: str, value: float, type: str, unit: str,
+               timestamp_ms: int, utc_offset: int) -> None:
+        if self._stop is not None:
+            raise ValueError("Cannot append to a slice of a MeasurementBatch")
+        # Convert before touching any column so a bad value cannot leave the columns misaligned
+        value, timestamp_ms, utc_offset = float(value), int(timestamp_ms), round(float(utc_offset))
+        intern = self.intern
+        indexes = self._indexes
+        indexes['device_id'].append(intern(str(device_id)))
+        indexes['device_name'].append(intern(str(device_name)))
+        indexes['name'].append(intern(str(name)))
+        indexes['type'].append(intern(str(type)))
+        indexes['unit'].append(intern(str(unit)))
+        self._values.append(value)
+        self._timestamps.append(timestamp_ms)
+        self._offsets.append(utc_offset)
+
+    def _bounds(self):
+        stop = len(self._values) if self._stop is None else self._stop
+        return self._start, stop
+
+    def __len__(self) -> int:
+        start, stop = self._bounds()
+        return stop - start
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[MeasurementDTO, 'MeasurementBatch']:
+        start, stop = self._bounds()
+        if isinstance(key, slice):
+            first, last, step = key.indices(stop - start)
+            if step != 1:
+                raise ValueError("MeasurementBatch slices must be contiguous")
+            view = MeasurementBatch.__new__(MeasurementBatch)
+            view.strings = self.strings
+            view._string_ids = self._string_ids
+            view._indexes = self._indexes
+            view._values = self._values
+            view._timestamps = self._timestamps
+            view._offsets = self._offsets
+            view._start = start + first
+            view._stop = start + max(first, last)
+            return view
+
+        if key < 0:
+            key += stop - start
+        if not 0 <= key < stop - start:
+            raise IndexError("MeasurementBatch index out of range")
+        return self._row(start + key)
+
+    def __iter__(self) -> Iterator[MeasurementDTO]:
+        start, stop = self._bounds()
+        return (self._row(i) for i in range(start, stop))
+
+    def _row(self, i: int) -> MeasurementDTO:
+        strings, indexes = self.strings, self._indexes
+        return MeasurementDTO(
+            device_id=strings[indexes['device_id'][i]],
+            device_name=strings[indexes['device_name'][i]],
+            name=strings[indexes['name'][i]],
+            value=self._values[i],
+            type=strings[indexes['type'][i]],
+            unit=strings[indexes['unit'][i]],
+            timestamp_utc=epoch_ms_to_datetime(self._timestamps[i]).isoformat(),
+            utc_offset=self._offsets[i],
+            timestamp_ms=self._timestamps[i],
+        )
+
+    def view(self, column: str) -> memoryview:
+        """
+        Zero-copy view of one column for this batch's rows: 'value', 'timestamp_ms',
+        'utc_offset', or the string table indexes of a string column.
+
+        The view pins the underlying array, which cannot grow while the view is alive,
+        so release it (or let it go out of scope) before appending to the owning batch.
+        """
+        start, stop = self._bounds()
+        columns = {'value': self._values, 'timestamp_ms': self._timestamps, 'utc_offset': self._offsets}
+        return memoryview(columns[column] if column in columns else self._indexes[column])[start:stop]
+
+    def index_column(self, column: str) -> array:
+        """Copy of the string table indexes of one string column, for this batch's rows."""
+        start, stop = self._bounds()
+        return self._indexes[column][start:stop]
+
+    def string_column(self, column: str) -> List[str]:
+        strings = self.strings
+        return [strings[index] for index in self.view(column)]
+
+    # The column properties return copies that callers may keep or modify; use view() to avoid the copy
+
+    @property
+    def values(self) -> array:
+        """Copy of the value column."""
+        start, stop = self._bounds()
+        return self._values[start:stop]
+
+    @property
+    def timestamps_ms(self) -> array:
+        """Copy of the epoch millisecond timestamp column."""
+        start, stop = self._bounds()
+        return self._timestamps[start:stop]
+
+    @property
+    def utc_offsets(self) -> array:
+        """Copy of the UTC offset column."""
+        start, stop = self._bounds()
+        return self._offsets[start:stop]
+
+    def to_rows(self) -> List[Dict[str, Any]]:
+        """
+        Row dicts as DatabaseAggregator.store_metrics expects them, with an aware UTC
+        datetime in timestamp_utc and the same instant as epoch milliseconds in timestamp_ms.
+        """
+        rows = self._rows('timestamp_utc', epoch_ms_to_datetime)
+        for row, epoch_ms in zip(rows, self.view('timestamp_ms')):
+            row['timestamp_ms'] = epoch_ms
+        return rows
+
+    def serialize(self, timestamp_format: str = ISO) -> List[Dict[str, Any]]:
+        """
+        JSON-ready row dicts in the same shape as MeasurementDTO.serialize().
+
+        With timestamp_format EPOCH_MS rows carry an integer timestamp_ms instead of an
+        ISO timestamp_utc, so nothing is formatted or parsed on either side.
+        """
+        if timestamp_format == EPOCH_MS:
+            return self._rows('timestamp_ms', None)
+        return self._rows('timestamp_utc', lambda epoch_ms: epoch_ms_to_datetime(epoch_ms).isoformat())
+
+    def to_json(self, timestamp_format: str = ISO) -> bytes:
+        """
+        The serialize() rows as a UTF-8 JSON array, ready to be sent as a request body.
+
+        The text is written straight from the columns: each interned string and each distinct
+        timestamp is JSON encoded once, so no row dicts are built for json.dumps to walk.
+        """
+        strings = [json.dumps(string) for string in self.strings]
+        timestamps = self.view('timestamp_ms')
+        if timestamp_format == EPOCH_MS:
+            timestamp_key, rendered = 'timestamp_ms', timestamps
+        else:
+            rendered_once = {epoch_ms: json.dumps(epoch_ms_to_datetime(epoch_ms).isoformat())
+                             for epoch_ms in set(timestamps)}
+            timestamp_key, rendered = 'timestamp_utc', map(rendered_once.__getitem__, timestamps)
+        lookup = strings.__getitem__
+        device_ids, device_names, names, types, units = (
+            map(lookup, self.view(column)) for column in STRING_COLUMNS
+        )
+        row = ('{"device_id":%s,"device_name":%s,"name":%s,"value":%s,"type":%s,"unit":%s,'
+               '"' + timestamp_key + '":%s,"utc_offset":%d}')
+        rows = [
+            row % fields
+            for fields in zip(device_ids, device_names, names, map(_json_float, self.view('value')), types, units,
+                              rendered, self.view('utc_offset'))
+        ]
+        return ('[' + ','.join(rows) + ']').encode('utf-8')
+
+    def _rows(self, timestamp_key: str, render_timestamp) -> List[Dict[str, Any]]:
+        # Each distinct timestamp, usually one per collection cycle, is rendered once
+        timestamps = self.view('timestamp_ms')
+        rendered = timestamps
+        if render_timestamp is not None:
+            rendered_once = {epoch_ms: render_timestamp(epoch_ms) for epoch_ms in set(timestamps)}
+            rendered = map(rendered_once.__getitem__, timestamps)
+        lookup = self.strings.__getitem__
+        device_ids, device_names, names, types, units = (
+            map(lookup, self.view(column)) for column in STRING_COLUMNS
+        )
+        return [
+            {
+                'device_id': device_id,
+                'device_name': device_name,
+                'name': name,
+                'value': value,
+                'type': type_name,
+                'unit': unit,
+                timestamp_key: timestamp,
+                'utc_offset': utc_offset,
+            }
+            for device_id, device_name, name, value, type_name, unit, timestamp, utc_offset in zip(
+                device_ids, device_names, names, self.view('value'), types, units,
+                rendered, self.view('utc_offset'))
+        ]
+
+
+def _json_float(value: float) -> str:
+    # repr() matches json.dumps for finite floats; NaN and infinities use json's spelling
+    return repr(value) if math.isfinite(value) else json.dumps(value)
@@ -1,29 +1,76 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 
 from config.config import load_config, MetricConfig
-from utils.timestamp import get_utc_timestamp, get_utc_offset
+from utils.timestamp import get_utc_timestamp_ms, get_utc_offset, iso_to_epoch_ms
 from utils.logger import get_logger
-from collector_agent.metrics_sdk.dto import MeasurementDTO  
+from collector_agent.metrics_sdk.measurement_batch import MeasurementBatch
 
 logger = get_logger('MetricFormatter')
 config = load_config()
 
+# Rendered names kept per rule before the cache is reset, bounds memory if a format key is unbounded
+MAX_CACHED_NAMES = 4096
+
+
+class _FieldPlan:
+    """A transform rule compiled for one raw metric field."""
+    __slots__ = ('field', 'name', 'unit', 'placeholders', 'sources', 'names')
+
+    def __init__(self, field: str, rule: MetricConfig):
+        self.field = field
+        self.name = rule.name
+        self.unit = rule.unit
+        format_spec = rule.format or {}
+        self.placeholders: Tuple[str, ...] = tuple(format_spec)
+        self.sources: Tuple[str, ...] = tuple(format_spec.values())
+        self.names: Dict[tuple, str] = {}  # source values -> rendered name
+
+    def render_name(self, metric: Dict[str, Any]) -> str:
+        if not self.sources:
+            return self.name
+        key = tuple(metric[source] for source in self.sources)
+        name = self.names.get(key)
+        if name is None:
+            if len(self.names) >= MAX_CACHED_NAMES:
+                self.names.clear()
+            name = self.names[key] = self.name.format(**dict(zip(self.placeholders, key)))
+        return name
+
+
 class MetricFormatter:
     def __init__(self):
         self.transform_rules = config.transform_rules
         self.crypto = config.collector_types.crypto
+        # collector type -> field plans, compiled once from the transform rules
+        self.plans: Dict[str, Tuple[_FieldPlan, ...]] = {
+            collector_type: tuple(
+                _FieldPlan(field, rule) for field, rule in vars(rules).items() if rule is not None
+            )
+            for collector_type, rules in vars(self.transform_rules).items()
+        }
 
-    def format(self, raw_metrics: List[Dict[str, Any]]) -> List[MeasurementDTO]:
+    def format(self, raw_metrics: List[Dict[str, Any]], timestamp_utc: Optional[str] = None,
+               utc_offset: Optional[float] = None) -> MeasurementBatch:
         """
-        Formats raw metrics into a list of MeasurementDTO objects based on the transform rules.
+        Formats raw metrics into a MeasurementBatch based on the transform rules.
+
+        Every measurement of the call shares one timestamp and UTC offset, taken once per
+        collection cycle unless given, except for raw metrics that carry their own
+        timestamp_utc.
 
         Args:
             raw_metrics (List[Dict[str, Any]]): A list of raw metric dictionaries to be formatted.
+            timestamp_utc (Optional[str]): ISO timestamp to stamp the measurements with.
+            utc_offset (Optional[float]): UTC offset in minutes to record with the measurements.
 
         Returns:
-            List[MeasurementDTO]: A list of formatted MeasurementDTO objects.
+            MeasurementBatch: The formatted measurements.
         """
-        formatted_metrics = []
+        formatted_metrics = MeasurementBatch()
+        cycle_timestamp_ms = iso_to_epoch_ms(timestamp_utc) if timestamp_utc else get_utc_timestamp_ms()
+        if utc_offset is None:
+            utc_offset = get_utc_offset()
+        sample_timestamps = {}  # ISO timestamps carried by raw metrics -> epoch ms
         
         for metric in raw_metrics:
             try:
@@ -32,35 +79,38 @@ class MetricFormatter:
                     logger.warning(f"Missing collector type in metric: {metric}")
                     continue
 
-                # Get the corresponding transform rules for this collector type
-                rules = getattr(self.transform_rules, collector_type, None)
-                if not rules:
+                # Get the compiled transform rules for this collector type
+                plans = self.plans.get(collector_type)
+                if not plans:
                     logger.warning(f"No transform rules found for collector: {collector_type}")
                     continue
 
-                # Format each metric field according to its rules
-                for field, rule in rules.__dict__.items():
-                    if field in metric:
-                        try:
-                            name = rule.name
-                            # Apply special formatting if specified in the rule
-                            if rule.format:
-                                name = name.format(**{k: metric[v] for k, v in rule.format.items()})
-                            
-                            measurement = MeasurementDTO(
-                                device_id=metric['device_id'],
-                                device_name=metric['device_name'],
-                                name=name,
-                                value=float(metric[field]),
-                                type=collector_type,
-                                unit=rule.unit,
-                                timestamp_utc=get_utc_timestamp(),
-                                utc_offset=get_utc_offset()
-                            )
-
-                            formatted_metrics.append(measurement)
-                        except Exception as e:
-                            logger.error(f"Error formatting field {field}: {str(e)}")
+                device_id = metric['device_id']
+                device_name = metric['device_name']
+                # Collectors that aggregate over an interval stamp their own samples
+                timestamp_ms = cycle_timestamp_ms
+                if metric.get('timestamp_utc'):
+                    timestamp_ms = sample_timestamps.get(metric['timestamp_utc'])
+                    if timestamp_ms is None:
+                        timestamp_ms = sample_timestamps[metric['timestamp_utc']] = iso_to_epoch_ms(metric['timestamp_utc'])
+
+                for plan in plans:
+                    value = metric.get(plan.field)
+                    if value is None:
+                        continue
+                    try:
+                        formatted_metrics.append(
+                            device_id=device_id,
+                            device_name=device_name,
+                            name=plan.render_name(metric),
+                            value=float(value),
+                            type=collector_type,
+                            unit=plan.unit,
+                            timestamp_ms=timestamp_ms,
+                            utc_offset=utc_offset
+                        )
+                    except Exception as e:
+                        logger.error(f"Error formatting field {plan.field}: {str(e)}")
 
             except Exception as e:
                 logger.error(f"Error processing metric {metric}: {str(e)}")
@@ -1,48 +1,176 @@
 import requests
+from threading import Lock
 from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from urllib3.util.retry import Retry
-from typing import List
+from typing import Dict, List, Optional, Union
+from utils.logger import get_logger
+from . import wire_format as codec
 from .dto import MeasurementDTO
+from .measurement_batch import ISO, MeasurementBatch
+
+logger = get_logger('MetricsAPI')
+
+COLUMNAR = 'columnar'
+JSON = 'json'
+
+
+class ConnectionStats:
+    """Thread-safe counters of HTTP requests and the connections opened to serve them."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.requests = 0
+        self.connections_opened = 0
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def record_new_connection(self) -> None:
+        with self._lock:
+            self.connections_opened += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'connections_reused': max(0, self.requests - self.connections_opened),
+            }
+
+
+def _counting_pool(base_pool, stats: ConnectionStats):
+    """Subclass a urllib3 connection pool so every attempt and every new connection is counted."""
+    class CountingConnectionPool(base_pool):
+        def _new_conn(self):
+            stats.record_new_connection()
+            return super()._new_conn()
+
+        def urlopen(self, *args, **kwargs):
+            stats.record_request()
+            return super().urlopen(*args, **kwargs)
+
+    return CountingConnectionPool
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools report connection reuse to a ConnectionStats instance."""
+
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        # Set before HTTPAdapter.__init__, which builds the pool manager
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool(HTTPConnectionPool, self.stats),
+            'https': _counting_pool(HTTPSConnectionPool, self.stats),
+        }
+
 
 class MetricsAPI:
-    def __init__(self, server_url: str, api_metrics_endpoint: str, timeout: int):
+    def __init__(self, server_url: str, api_metrics_endpoint: str, timeout: int,
+                 wire_format: str = JSON, compression: str = codec.GZIP, agent_id: str = None,
+                 max_retries: int = 3, pool_maxsize: int = 4, timestamp_format: str = ISO):
         self.server_url = server_url
+        self.agent_id = agent_id
         self.api_metrics_endpoint = api_metrics_endpoint
         self.timeout = timeout
+        self.wire_format = wire_format
+        # Timestamp representation of JSON uploads; the columnar format always sends epoch milliseconds
+        self.timestamp_format = timestamp_format
+        self.compression = self._supported_compression(compression)
+        self.connection_stats = ConnectionStats()
+        # One long-lived session, so uploads reuse pooled keep-alive connections
         self.session = requests.Session()
         retry_strategy = Retry(
-            total=3,
+            total=max_retries,
             backoff_factor=1,
-            status_forcelist=[500, 502, 503, 504],
+            status_forcelist=[409, 429, 500, 502, 503, 504],
             allowed_methods=["POST"]
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        adapter = CountingHTTPAdapter(
+            self.connection_stats,
+            max_retries=retry_strategy,
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+            pool_block=True
+        )
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
-        
-    def post_metrics(self, data_snapshots: List[MeasurementDTO]) -> None:
+
+    @staticmethod
+    def _supported_compression(compression: str) -> str:
+        if compression not in codec.supported_encodings():
+            logger.warning(f"Compression '{compression}' is not available, falling back to gzip")
+            return codec.GZIP
+        return compression
+
+    def post_metrics(self, data_snapshots: Union[MeasurementBatch, List[MeasurementDTO]],
+                     batch_seq: Optional[int] = None) -> None:
         """
-        Sends a list of MeasurementDTO objects to the server as a POST request.
+        Sends a MeasurementBatch or a list of MeasurementDTO objects to the server as a POST request.
 
-        This method serializes the provided MeasurementDTO objects and sends them
+        This method serializes the provided measurements and sends them
         to the specified API endpoint using a POST request. It includes a retry
         strategy to handle transient errors and ensures the request is retried
-        up to 3 times for specific HTTP status codes.
+        up to max_retries times for specific HTTP status codes. A 429 from a full server-side
+        ingest buffer is retried after the server's Retry-After delay.
+
+        With the columnar wire format the batch is sent as a compressed, dictionary
+        encoded payload. If the server answers 415 Unsupported Media Type, the API
+        switches to plain JSON for this and all later uploads. JSON rows carry ISO
+        timestamps, or integer epoch milliseconds with timestamp_format 'epoch_ms'.
+
+        When an agent id and batch_seq are given they are sent as idempotency headers,
+        so the server stores a batch once no matter how often it is retried. Callers
+        must reuse the same batch_seq when re-sending the same batch.
 
         Args:
-            data_snapshots (List[MeasurementDTO]): A list of MeasurementDTO objects to be sent to the server.
+            data_snapshots (Union[MeasurementBatch, List[MeasurementDTO]]): The measurements to be sent to the server.
+            batch_seq (int, optional): Monotonically increasing sequence number of this batch.
 
         Raises:
             requests.exceptions.HTTPError: If the response contains an HTTP error status code.
         """
         url = f"{self.server_url}/{self.api_metrics_endpoint}"
-        serialized_data = [snapshot.serialize() for snapshot in data_snapshots]
-        
-        with self.session as session:
-            response = session.post(
-                url,
-                json=serialized_data,
-                headers={'Content-Type': 'application/json'},
-                timeout=self.timeout
-            )
-            response.raise_for_status()
+        batch_headers = {}
+        if self.agent_id and batch_seq is not None:
+            batch_headers = {codec.AGENT_ID_HEADER: self.agent_id, codec.BATCH_SEQ_HEADER: str(batch_seq)}
+
+        if self.wire_format == COLUMNAR:
+            response = self._post_columnar(url, data_snapshots, batch_headers)
+            if response.status_code != 415:
+                response.raise_for_status()
+                return
+            logger.warning("Server does not accept the columnar wire format, falling back to JSON")
+            self.wire_format = JSON
+
+        # A batch writes its JSON body straight from its columns, without row dicts in between
+        if not isinstance(data_snapshots, MeasurementBatch):
+            data_snapshots = MeasurementBatch.from_measurements(data_snapshots)
+        response = self.session.post(
+            url,
+            data=data_snapshots.to_json(self.timestamp_format),
+            headers={'Content-Type': codec.JSON_CONTENT_TYPE, **batch_headers},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+
+    def get_connection_stats(self) -> Dict[str, int]:
+        """Return request and connection counters, including how many requests reused a connection."""
+        return self.connection_stats.snapshot()
+
+    def close(self) -> None:
+        """Close the session and its pooled connections."""
+        self.session.close()
+
+    def _post_columnar(self, url: str, data_snapshots: Union[MeasurementBatch, List[MeasurementDTO]],
+                       batch_headers: Dict[str, str]) -> requests.Response:
+        payload = codec.compress(codec.encode_measurements(data_snapshots), self.compression)
+        headers = {'Content-Type': codec.CONTENT_TYPE, **batch_headers}
+        if self.compression != codec.IDENTITY:
+            headers['Content-Encoding'] = self.compression
+        return self.session.post(url, data=payload, headers=headers, timeout=self.timeout)
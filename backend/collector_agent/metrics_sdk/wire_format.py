@@ -0,0 +1,193 @@
+import gzip
+import io
+import json
+import struct
+import sys
+from array import array
+from typing import Any, Dict, List, Optional, Union
+
+from .dto import MeasurementDTO
+from .measurement_batch import INDEX_TYPECODE, OFFSET_TYPECODE, STRING_COLUMNS, TIMESTAMP_TYPECODE, \
+    VALUE_TYPECODE, MeasurementBatch
+
+try:
+    import zstandard
+except ImportError:  # Optional dependency, gzip is always available
+    zstandard = None
+
+CONTENT_TYPE = 'application/x-metrics-columnar'
+JSON_CONTENT_TYPE = 'application/json'
+GZIP = 'gzip'
+ZSTD = 'zstd'
+IDENTITY = 'identity'
+
+# Idempotency headers: replays of the same (agent, sequence) pair are stored once
+AGENT_ID_HEADER = 'X-Agent-Id'
+BATCH_SEQ_HEADER = 'X-Batch-Seq'
+
+_DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+# magic, row count, string table length
+_HEADER = struct.Struct('<4sII')
+_MAGIC = b'MCB1'
+# MCB2 payloads, e.g. in spools, carry UTC offsets as float64 minutes; they are still decoded and rounded
+_MAGIC_FLOAT_OFFSETS = b'MCB2'
+_OFFSET_TYPECODE_FLOAT = 'd'
+
+# Dictionary-encoded string columns (STRING_COLUMNS) are followed by the numeric columns, in payload order
+_NUMERIC_COLUMNS = (('value', VALUE_TYPECODE), ('timestamp_ms', TIMESTAMP_TYPECODE), ('utc_offset', OFFSET_TYPECODE))
+_NUMERIC_COLUMNS_FLOAT_OFFSETS = _NUMERIC_COLUMNS[:2] + (('utc_offset', _OFFSET_TYPECODE_FLOAT),)
+
+
+class WireFormatError(ValueError):
+    """Raised when an upload payload cannot be decoded."""
+
+
+class UnsupportedEncodingError(WireFormatError):
+    """Raised for a Content-Encoding this process cannot handle."""
+
+
+class PayloadTooLargeError(WireFormatError):
+    """Raised when a payload decompresses to more than the allowed size."""
+
+
+def supported_encodings() -> List[str]:
+    """Content-Encodings this process can compress and decompress."""
+    return [GZIP, ZSTD, IDENTITY] if zstandard else [GZIP, IDENTITY]
+
+
+def compress(payload: bytes, encoding: str) -> bytes:
+    if encoding == GZIP:
+        return gzip.compress(payload, compresslevel=6)
+    if encoding == ZSTD and zstandard:
+        return zstandard.ZstdCompressor().compress(payload)
+    if encoding in (None, '', IDENTITY):
+        return payload
+    raise UnsupportedEncodingError(f"Unsupported content encoding: {encoding}")
+
+
+def decompress(body: bytes, encoding: str, max_size: Optional[int] = None) -> bytes:
+    """
+    Decompress an upload body.
+
+    The body is decompressed in chunks of _DECOMPRESS_CHUNK_SIZE bytes, so a small payload that
+    expands to more than max_size bytes raises PayloadTooLargeError before it is held in memory.
+    """
+    try:
+        if encoding == GZIP:
+            return _read_limited(gzip.GzipFile(fileobj=io.BytesIO(body)), max_size)
+        if encoding == ZSTD and zstandard:
+            return _read_limited(zstandard.ZstdDecompressor().stream_reader(body), max_size)
+    except PayloadTooLargeError:
+        raise
+    except Exception as e:
+        raise WireFormatError(f"Could not decompress {encoding} payload: {str(e)}") from e
+    if encoding in (None, '', IDENTITY):
+        return body
+    raise UnsupportedEncodingError(f"Unsupported content encoding: {encoding}")
+
+
+def _read_limited(stream, max_size: Optional[int]) -> bytes:
+    chunks, size = [], 0
+    with stream:
+        while True:
+            chunk = stream.read(_DECOMPRESS_CHUNK_SIZE)
+            if not chunk:
+                return b''.join(chunks)
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise PayloadTooLargeError(f"Payload decompresses to more than {max_size} bytes")
+            chunks.append(chunk)
+
+
+def _little_endian_bytes(column: memoryview) -> bytes:
+    if sys.byteorder == 'big':
+        column = array(column.format, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def encode_measurements(measurements: Union[MeasurementBatch, List[MeasurementDTO]]) -> bytes:
+    """
+    Encode measurements into the column-oriented binary upload format.
+
+    Repeated strings are written once to a per-batch string table and referenced by
+    index, and timestamps are sent as integer epoch milliseconds. A MeasurementBatch
+    already holds that layout, so its columns are written out as they are.
+
+    Args:
+        measurements (Union[MeasurementBatch, List[MeasurementDTO]]): The measurements to encode.
+
+    Returns:
+        bytes: The uncompressed payload.
+    """
+    batch = measurements
+    if not isinstance(batch, MeasurementBatch):
+        batch = MeasurementBatch.from_measurements(measurements)
+
+    string_table = json.dumps(batch.strings, separators=(',', ':')).encode('utf-8')
+    parts = [_HEADER.pack(_MAGIC, len(batch), len(string_table)), string_table]
+    parts.extend(_little_endian_bytes(batch.view(column)) for column in STRING_COLUMNS)
+    parts.extend(_little_endian_bytes(batch.view(column)) for column, _ in _NUMERIC_COLUMNS)
+    return b''.join(parts)
+
+
+def decode_batch(payload: bytes) -> MeasurementBatch:
+    """
+    Decode a column-oriented payload into a MeasurementBatch that wraps the decoded columns.
+
+    Raises:
+        WireFormatError: If the payload is truncated or not in the expected format.
+    """
+    try:
+        magic, row_count, string_table_length = _HEADER.unpack_from(payload, 0)
+        if magic not in (_MAGIC, _MAGIC_FLOAT_OFFSETS):
+            raise WireFormatError(f"Unexpected payload magic: {magic!r}")
+        numeric_columns = _NUMERIC_COLUMNS if magic == _MAGIC else _NUMERIC_COLUMNS_FLOAT_OFFSETS
+
+        offset = _HEADER.size
+        strings = json.loads(payload[offset:offset + string_table_length].decode('utf-8'))
+        offset += string_table_length
+
+        columns = {}
+        layout = [(column, INDEX_TYPECODE) for column in STRING_COLUMNS] + list(numeric_columns)
+        for column, typecode in layout:
+            values = array(typecode)
+            size = values.itemsize * row_count
+            chunk = payload[offset:offset + size]
+            if len(chunk) != size:
+                raise WireFormatError(f"Columnar payload truncated in column {column}")
+            values.frombytes(chunk)
+            if sys.byteorder == 'big':
+                values.byteswap()
+            offset += size
+            columns[column] = values
+
+        if offset != len(payload):
+            raise WireFormatError("Columnar payload length does not match its header")
+        if row_count and max(max(columns[column]) for column in STRING_COLUMNS) >= len(strings):
+            raise WireFormatError("Columnar payload references a string outside its string table")
+    except WireFormatError:
+        raise
+    except (struct.error, ValueError) as e:
+        raise WireFormatError(f"Malformed columnar payload: {str(e)}") from e
+
+    return MeasurementBatch.from_columns(
+        strings,
+        {column: columns[column] for column in STRING_COLUMNS},
+        columns['value'],
+        columns['timestamp_ms'],
+        columns['utc_offset'] if magic == _MAGIC else array(OFFSET_TYPECODE, map(round, columns['utc_offset']))
+    )
+
+
+def decode_measurements(payload: bytes) -> List[Dict[str, Any]]:
+    """
+    Decode a column-oriented payload straight into the row dicts store_metrics expects.
+
+    Timestamps are returned as aware UTC datetimes so the server does not re-parse strings.
+
+    Raises:
+        WireFormatError: If the payload is truncated or not in the expected format.
+    """
+    return decode_batch(payload).to_rows()
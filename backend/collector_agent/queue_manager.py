@@ -1,19 +1,27 @@
 import time
 import requests
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
 from typing import Dict, Any, List
 from utils.timestamp import get_utc_timestamp, get_utc_offset
 from utils.logger import get_logger
-from .collectors.collector_registry import CollectorRegistry
+from .collectors.collector_registry import CollectorRegistry, CollectorSchedule
 from .collectors.system_collector import SystemCollector
 from .collectors.crypto_collector import CryptoCollector
 from config.config import load_config
 import traceback
+from .metrics_sdk.measurement_batch import MeasurementBatch
 from .metrics_sdk.metric_formatter import MetricFormatter
 from .metrics_sdk.metrics_api import MetricsAPI
+from .spool import DiskSpool
+from .agent_identity import AgentIdentity
+from .scheduler import CollectorScheduler
 
 logger = get_logger('QueueManager')
 
+MAX_RETRY_BACKOFF_SECONDS = 60
+
 class UploaderQueue:
     """Client-side collector and uploader"""
     def __init__(self):
@@ -28,64 +36,224 @@ class UploaderQueue:
         self.batch_size = config.server.batch_size
         self.timeout = config.server.timeout
         self.max_queue_size = config.server.max_queue_size
-        self.registry = CollectorRegistry()
+        self.max_batch_age_seconds = config.server.max_batch_age_seconds
+        self.registry = CollectorRegistry(default_timeout=config.server.collector_timeout_seconds)
         
-        # Register collectors
-        self.registry.register(self.system, SystemCollector())
-        self.registry.register(self.crypto, CryptoCollector())
+        # Register collectors, each on its own schedule
+        self.registry.register(self.system, SystemCollector(), schedule=self._schedule_for(config, self.system))
+        self.registry.register(self.crypto, CryptoCollector(), schedule=self._schedule_for(config, self.crypto))
+        self.scheduler = CollectorScheduler(self.registry, self._handle_collected, self.collect_upload_interval)
 
-        self.queue = deque(maxlen=self.max_queue_size)
+        # The queue is bounded by _enqueue; it holds [enqueued_at, MeasurementBatch] per collection cycle
+        self.queue = deque()
+        self.queued_rows = 0
+        # With a spool directory configured, measurements are queued on disk instead of in self.queue
+        self.spool = None
+        if config.server.spool_dir:
+            self.spool = DiskSpool(
+                config.server.spool_dir,
+                max_bytes=config.server.spool_max_bytes,
+                segment_bytes=config.server.spool_segment_bytes,
+                fsync=config.server.spool_fsync
+            )
+        # Per-instance id and batch sequence numbers, kept next to the spool when there is one
+        self.identity = AgentIdentity(config.server.spool_dir)
+        self.queue_condition = Condition()
         self.running = True
         self.metric_formatter = MetricFormatter()  
-        self.metrics_api = MetricsAPI(self.server_url, self.api_metrics_endpoint, self.timeout)  # New instance
+        self.metrics_api = MetricsAPI(
+            self.server_url,
+            self.api_metrics_endpoint,
+            self.timeout,
+            wire_format=config.server.wire_format,
+            compression=config.server.compression,
+            agent_id=self.identity.agent_id,
+            max_retries=config.server.max_retries,
+            pool_maxsize=config.server.pool_maxsize,
+            timestamp_format=config.server.timestamp_format
+        )
+        self.max_in_flight = max(1, config.server.max_in_flight)
+        self.upload_executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='Uploader')
+
+        # Batches keep their sequence number until the server acknowledges them
+        self.pending_batches = deque()
+        self.consecutive_failures = 0
+        self.retry_at = 0.0
 
-    def format_metrics(self, raw_metrics: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def format_metrics(self, raw_metrics: List[Dict[str, Any]]) -> MeasurementBatch:
         """Format raw metrics using transform rules based on collector type"""
         return self.metric_formatter.format(raw_metrics)  
 
+    @staticmethod
+    def _schedule_for(config, collector_type: str) -> CollectorSchedule:
+        """Build a collector's schedule from config, falling back to collect_upload_interval"""
+        schedule = config.collector_schedules.get(collector_type)
+        if schedule is None:
+            return CollectorSchedule(interval=config.server.collect_upload_interval)
+        return CollectorSchedule(interval=schedule.interval, jitter=schedule.jitter, align=schedule.align)
+
     def collect_and_enqueue(self) -> None:
-        """Continuously collects metrics and adds them to the queue at collection_interval"""
-        while self.running:
-            try:
-                raw_metrics = self.registry.collect_all()
-                formatted_metrics = self.format_metrics(raw_metrics)
+        """Runs every collector on its own schedule and adds the collected metrics to the queue"""
+        self.scheduler.run()
+        self.registry.shutdown()
 
-                for metric in formatted_metrics:
-                    if len(self.queue) >= self.max_queue_size:
-                        logger.warning("Queue is full, dropping oldest metric.")
-                    self.queue.append(metric)
+    def _handle_collected(self, raw_metrics: List[Dict[str, Any]]) -> None:
+        try:
+            formatted_metrics = self.format_metrics(raw_metrics)
+            self._enqueue(formatted_metrics)
+            logger.info(f"Collected and queued {len(formatted_metrics)} metrics (Queue size: {self._queued_count()})")
+        except Exception as e:
+            logger.error(f"Error in collection cycle: {str(e)}")
+            logger.error(traceback.format_exc())
 
-                logger.info(f"Collected and queued {len(formatted_metrics)} metrics (Queue size: {len(self.queue)})")
+    def stop(self) -> None:
+        """Stop the collection and upload loops and wake the uploader if it is waiting."""
+        self.scheduler.stop()
+        with self.queue_condition:
+            self.running = False
+            self.queue_condition.notify_all()
+
+    def _enqueue(self, measurements: MeasurementBatch) -> None:
+        """Append one collection cycle to the queue, dropping the oldest measurements when it is full."""
+        if not measurements:
+            return
+        if self.spool is not None:
+            self.spool.append(measurements)
+            with self.queue_condition:
+                self.queue_condition.notify()
+            return
+        with self.queue_condition:
+            measurements = measurements[-self.max_queue_size:]
+            overflow = self.queued_rows + len(measurements) - self.max_queue_size
+            if overflow > 0:
+                self._take(overflow)
+                logger.warning(f"Queue is full, dropped {overflow} oldest metrics.")
+            self.queue.append([time.monotonic(), measurements])
+            self.queued_rows += len(measurements)
+            self.queue_condition.notify()
+
+    def _take(self, count: int) -> MeasurementBatch:
+        """Pop count measurements off the front of the queue. Caller must hold queue_condition."""
+        parts = []
+        while count:
+            entry = self.queue[0]
+            cycle = entry[1]
+            if len(cycle) <= count:
+                self.queue.popleft()
+                parts.append(cycle)
+                used = len(cycle)
+            else:
+                # Split the cycle with views over its columns instead of copying it
+                parts.append(cycle[:count])
+                entry[1] = cycle[count:]
+                used = count
+            count -= used
+            self.queued_rows -= used
+        return MeasurementBatch.concat(parts)
 
-            except Exception as e:
-                logger.error(f"Error in collection cycle: {str(e)}")
-                logger.error(traceback.format_exc())
+    def _queued_count(self) -> int:
+        return len(self.spool) if self.spool is not None else self.queued_rows
 
-            time.sleep(self.collect_upload_interval)
+    def _oldest_age(self) -> float:
+        if self.spool is not None:
+            return self.spool.oldest_age()
+        return time.monotonic() - self.queue[0][0] if self.queue else 0.0
+
+    def _batch_ready(self) -> bool:
+        """A batch is ready when one is full, the oldest measurement is too old, or a retry is due."""
+        if time.monotonic() < self.retry_at:
+            return False
+        queued = self._queued_count()
+        if self.pending_batches or queued >= self.batch_size:
+            return True
+        return queued > 0 and self._oldest_age() >= self.max_batch_age_seconds
+
+    def _seconds_until_ready(self):
+        now = time.monotonic()
+        if now < self.retry_at:
+            return self.retry_at - now
+        if self._queued_count():
+            return max(0.0, self.max_batch_age_seconds - self._oldest_age())
+        return None  # Nothing to do until _enqueue or stop notifies
 
     def upload_from_queue(self) -> None:
-        """Continuously uploads metrics from the queue at upload_interval"""
-        while self.running:
-            if len(self.queue) < self.batch_size:
-                logger.info(f"Queue size ({len(self.queue)}) is less than {self.batch_size}, waiting for a full batch.")
-            else:
-                try:
-                    data_to_upload = list(self.queue)[:self.batch_size]
+        """
+        Uploads metrics as soon as a full batch exists or the oldest queued metric reaches
+        max_batch_age_seconds.
 
-                    logger.debug(f"Uploading to {self.server_url}/{self.api_metrics_endpoint} with {len(data_to_upload)} metrics")
+        The uploader sleeps on a condition variable instead of polling. Up to max_in_flight
+        batches are posted concurrently, and a backlog is drained in consecutive rounds.
+        Failed batches keep their sequence numbers and are retried first with an
+        exponential backoff.
+        """
+        while True:
+            with self.queue_condition:
+                while self.running and not self._batch_ready():
+                    self.queue_condition.wait(self._seconds_until_ready())
+                if not self.running:
+                    break
+                batches = self._next_batches(self.max_in_flight)
 
-                    self.metrics_api.post_metrics(data_to_upload)
+            if len(batches) == 1:
+                results = [self._upload_batch(batches[0])]
+            else:
+                results = list(self.upload_executor.map(self._upload_batch, batches))
 
-                    # Remove uploaded metrics from queue
-                    for _ in range(len(data_to_upload)):
-                        self.queue.popleft()
+            with self.queue_condition:
+                # Failed batches are retried first, in sequence order, on the next round
+                failed = [batch for batch, uploaded in zip(batches, results) if not uploaded]
+                self.pending_batches.extendleft(reversed(failed))
+                if failed:
+                    self.consecutive_failures += 1
+                    backoff = min(MAX_RETRY_BACKOFF_SECONDS, self.collect_upload_interval * 2 ** (self.consecutive_failures - 1))
+                    self.retry_at = time.monotonic() + backoff
+                    logger.warning(f"{len(failed)} batches failed, retrying in {backoff}s")
+                else:
+                    self.consecutive_failures = 0
+                    self.retry_at = 0.0
+                queue_size = self._queued_count()
 
-                    logger.info(f"Successfully uploaded {len(data_to_upload)} metrics (Queue size: {len(self.queue)})")
+            logger.info(f"Uploaded {results.count(True)}/{len(batches)} batches (Queue size: {queue_size}, "
+                        f"connections: {self.metrics_api.get_connection_stats()})")
 
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"Failed to upload metrics: {str(e)}")
-                    if hasattr(e.response, 'text'):
-                        logger.error(f"Server response: {e.response.text}")
+        self.upload_executor.shutdown(wait=True)
+        self.metrics_api.close()
+        if self.spool is not None:
+            self.spool.close()
 
-            time.sleep(self.collect_upload_interval)
+    def _next_batches(self, count: int) -> List[tuple]:
+        """
+        Take up to count batches, retrying pending ones before cutting new ones from the queue.
+        A partial batch is only cut once its oldest measurement is max_batch_age_seconds old.
+        Caller must hold queue_condition.
+        """
+        batches = []
+        while self.pending_batches and len(batches) < count:
+            batches.append(self.pending_batches.popleft())
+        while len(batches) < count and self._queued_count() and (
+                self._queued_count() >= self.batch_size or self._oldest_age() >= self.max_batch_age_seconds):
+            if self.spool is not None:
+                data, token = self.spool.read_batch(self.batch_size)
+            else:
+                data, token = self._take(min(self.batch_size, self.queued_rows)), None
+            batches.append((self.identity.next_seq(), data, token))
+        return batches
 
+    def _upload_batch(self, batch: tuple) -> bool:
+        batch_seq, data_to_upload, spool_token = batch
+        try:
+            logger.debug(f"Uploading batch {batch_seq} to {self.server_url}/{self.api_metrics_endpoint} with {len(data_to_upload)} metrics")
+            self.metrics_api.post_metrics(data_to_upload, batch_seq=batch_seq)
+            if self.spool is not None:
+                self.spool.ack(spool_token)
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to upload batch {batch_seq}: {str(e)}")
+            if hasattr(e.response, 'text'):
+                logger.error(f"Server response: {e.response.text}")
+            return False
+        except Exception as e:
+            # e.g. an encoding or spool error; the batch is retried instead of killing the uploader
+            logger.error(f"Unexpected error uploading batch {batch_seq}: {str(e)}")
+            logger.error(traceback.format_exc())
+            return False
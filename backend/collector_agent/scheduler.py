@@ -0,0 +1,107 @@
+import heapq
+import math
+import random
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from typing import Any, Callable, Dict, List
+from utils.logger import get_logger
+from .collectors.collector_registry import CollectorRegistry
+
+logger = get_logger('CollectorScheduler')
+
+
+class CollectorScheduler:
+    """Runs each registered collector on its own schedule from a single timer heap.
+
+    Collectors due at the same time are collected together through the registry, on a
+    dispatch pool so a slow collector never delays the timer loop. Runs are scheduled
+    from the previous due time rather than from completion, so intervals do not drift,
+    and ticks missed while a collector was late are skipped instead of bunched up.
+    Jitter only delays the dispatch of a run; the next run is due an exact interval
+    after the unjittered due time, so jitter does not accumulate either.
+    """
+
+    def __init__(self, registry: CollectorRegistry, on_metrics: Callable[[List[Dict[str, Any]]], None],
+                 default_interval: float):
+        self.registry = registry
+        self.on_metrics = on_metrics
+        self.default_interval = default_interval
+        self._heap = []  # (dispatch monotonic time, unjittered due time, collector name)
+        self._stop = Event()
+        self._dispatch = None
+
+    def run(self) -> None:
+        """Run the scheduling loop until stop() is called."""
+        self._dispatch = ThreadPoolExecutor(max_workers=max(1, len(self.registry.collectors)),
+                                            thread_name_prefix='CollectorDispatch')
+        now = time.monotonic()
+        for name in self.registry.collectors:
+            self._schedule(name, self._next_due(name, now, first=True))
+            logger.info(f"Scheduled collector {name} every {self._interval(name)}s")
+
+        while not self._stop.is_set() and self._heap:
+            dispatch_at = self._heap[0][0]
+            delay = dispatch_at - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+                continue
+
+            now = time.monotonic()
+            due_names = []
+            while self._heap and self._heap[0][0] <= now:
+                _, due, name = heapq.heappop(self._heap)
+                if name not in self.registry.collectors:
+                    continue  # Unregistered since it was scheduled
+                due_names.append(name)
+                self._schedule(name, self._next_due(name, due))
+
+            if due_names:
+                self._dispatch.submit(self._collect, due_names)
+
+        self._dispatch.shutdown(wait=True)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _interval(self, name: str) -> float:
+        return self.registry.schedules[name].interval or self.default_interval
+
+    def _schedule(self, name: str, due: float) -> None:
+        jitter = self.registry.schedules[name].jitter
+        dispatch_at = due + random.uniform(0, jitter) if jitter else due
+        heapq.heappush(self._heap, (dispatch_at, due, name))
+
+    def _next_due(self, name: str, previous_due: float, first: bool = False) -> float:
+        """The unjittered due time of the run after the one due at previous_due."""
+        schedule = self.registry.schedules[name]
+        interval = self._interval(name)
+        now = time.monotonic()
+
+        if schedule.align:
+            # Snap to the next wall-clock multiple of the interval, e.g. :00, :10, :20 for 10s.
+            # After a run, look half an interval ahead so a run that fired a little early
+            # against the wall clock does not land on the same boundary again.
+            wall_now = time.time()
+            base = wall_now if first else wall_now + interval / 2
+            next_wall = math.floor(base / interval) * interval + interval
+            due = now + (next_wall - wall_now)
+        elif first:
+            due = now
+        else:
+            due = previous_due + interval
+            if due < now:
+                missed = math.ceil((now - due) / interval)
+                logger.warning(f"Collector {name} is behind schedule, skipping {missed} runs")
+                due += missed * interval
+        return due
+
+    def _collect(self, names: List[str]) -> None:
+        try:
+            raw_metrics = self.registry.collect(names)
+            if raw_metrics:
+                self.on_metrics(raw_metrics)
+        except Exception as e:
+            logger.error(f"Error in collection run for {names}: {str(e)}")
+            logger.error(traceback.format_exc())
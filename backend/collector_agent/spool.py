@@ -0,0 +1,228 @@
+import json
+import mmap
+import os
+import struct
+import time
+from collections import deque
+from pathlib import Path
+from threading import Lock
+from typing import Optional, Tuple
+from utils.logger import get_logger
+from .metrics_sdk import wire_format
+from .metrics_sdk.measurement_batch import MeasurementBatch
+
+logger = get_logger('DiskSpool')
+
+# payload length, row count, enqueued at (epoch seconds)
+_RECORD_HEADER = struct.Struct('<IId')
+_SEGMENT_SUFFIX = '.seg'
+_CHECKPOINT_FILE = 'checkpoint.json'
+
+# A position in the spool: (segment id, byte offset)
+Position = Tuple[int, int]
+
+
+class DiskSpool:
+    """Append-only, segment-file spool for queued measurements.
+
+    Every append writes one record holding a collection cycle in the compact columnar
+    wire format. Records are read back through mmap, so the queue lives on disk instead
+    of in the agent's memory. The read position handed out to the uploader runs ahead
+    of the durable checkpoint, which only advances once every earlier batch has been
+    acknowledged, so unacknowledged data is re-read after a restart. When the spool
+    grows past max_bytes the oldest segments are evicted, even if unread.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024,
+                 segment_bytes: int = 8 * 1024 * 1024, fsync: bool = False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = Lock()
+
+        self._segment_sizes = {}       # segment id -> bytes on disk
+        self._segment_records = {}     # segment id -> deque of (offset, rows, enqueued_at) not yet read
+        self._checkpoint: Position = (0, 0)
+        self._outstanding = deque()    # [end position, acked] for batches handed out, in read order
+        self.pending_rows = 0
+        self._writer = None
+        self._writer_segment = None
+
+        self._load()
+
+    def __len__(self) -> int:
+        return self.pending_rows
+
+    def append(self, measurements: MeasurementBatch) -> None:
+        """Append one record holding the given measurements, evicting old segments if over max_bytes."""
+        if not measurements:
+            return
+        payload = wire_format.encode_measurements(measurements)
+        enqueued_at = time.time()
+        record = _RECORD_HEADER.pack(len(payload), len(measurements), enqueued_at) + payload
+
+        with self._lock:
+            segment = self._active_segment(len(record))
+            offset = self._segment_sizes[segment]
+            self._writer.write(record)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._segment_sizes[segment] = offset + len(record)
+            self._segment_records[segment].append((offset, len(measurements), enqueued_at))
+            self.pending_rows += len(measurements)
+            self._evict_if_needed()
+
+    def oldest_age(self) -> float:
+        """Seconds since the oldest unread record was appended."""
+        with self._lock:
+            for segment in sorted(self._segment_records):
+                if self._segment_records[segment]:
+                    return max(0.0, time.time() - self._segment_records[segment][0][2])
+        return 0.0
+
+    def read_batch(self, min_rows: int) -> Tuple[MeasurementBatch, Optional[Position]]:
+        """
+        Read whole records until at least min_rows measurements are collected or the spool is empty.
+
+        Returns:
+            tuple: The measurements and a token to pass to ack() once they are uploaded.
+        """
+        records_read, rows_read, end = [], 0, None
+        with self._lock:
+            for segment in sorted(self._segment_records):
+                records = self._segment_records[segment]
+                if not records:
+                    continue
+                with open(self._segment_path(segment), 'rb') as f, \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    while records and rows_read < min_rows:
+                        offset, rows, _ = records.popleft()
+                        length = _RECORD_HEADER.unpack_from(mapped, offset)[0]
+                        start = offset + _RECORD_HEADER.size
+                        records_read.append(wire_format.decode_batch(mapped[start:start + length]))
+                        rows_read += rows
+                        self.pending_rows -= rows
+                        end = (segment, start + length)
+                if rows_read >= min_rows:
+                    break
+            if end is not None:
+                self._outstanding.append([end, False])
+        return MeasurementBatch.concat(records_read), end
+
+    def ack(self, token: Optional[Position]) -> None:
+        """Mark a batch as uploaded and advance the durable checkpoint over every acknowledged prefix."""
+        if token is None:
+            return
+        with self._lock:
+            for entry in self._outstanding:
+                if entry[0] == token:
+                    entry[1] = True
+                    break
+            checkpoint = None
+            while self._outstanding and self._outstanding[0][1]:
+                checkpoint = self._outstanding.popleft()[0]
+            if checkpoint is not None and checkpoint > self._checkpoint:
+                self._checkpoint = checkpoint
+                self._write_checkpoint()
+                self._delete_consumed_segments()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.directory / f"{segment:012d}{_SEGMENT_SUFFIX}"
+
+    def _active_segment(self, record_size: int) -> int:
+        """Return the segment to append to, rolling to a new one once segment_bytes is reached."""
+        segment = max(self._segment_sizes) if self._segment_sizes else self._checkpoint[0] + 1
+        size = self._segment_sizes.get(segment, 0)
+        if size > 0 and size + record_size > self.segment_bytes:
+            segment += 1
+        if self._writer is None or self._writer_segment != segment:
+            if self._writer is not None:
+                self._writer.close()
+            self._writer = open(self._segment_path(segment), 'ab')
+            self._writer_segment = segment
+            self._segment_sizes.setdefault(segment, 0)
+            self._segment_records.setdefault(segment, deque())
+        return segment
+
+    def _evict_if_needed(self) -> None:
+        active = max(self._segment_sizes)
+        while sum(self._segment_sizes.values()) > self.max_bytes and len(self._segment_sizes) > 1:
+            oldest = min(self._segment_sizes)
+            if oldest == active:
+                break
+            dropped = sum(rows for _, rows, _ in self._segment_records.pop(oldest))
+            self.pending_rows -= dropped
+            del self._segment_sizes[oldest]
+            self._segment_path(oldest).unlink(missing_ok=True)
+            if self._checkpoint < (oldest + 1, 0):
+                self._checkpoint = (oldest + 1, 0)
+                self._write_checkpoint()
+            logger.warning(f"Spool over {self.max_bytes} bytes, evicted segment {oldest} with {dropped} unsent metrics")
+
+    def _delete_consumed_segments(self) -> None:
+        """Remove segments that lie entirely before the checkpoint."""
+        for segment in sorted(self._segment_sizes):
+            if segment >= self._checkpoint[0]:
+                break
+            del self._segment_sizes[segment]
+            self._segment_records.pop(segment, None)
+            self._segment_path(segment).unlink(missing_ok=True)
+
+    def _write_checkpoint(self) -> None:
+        tmp_path = self.directory / (_CHECKPOINT_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'segment': self._checkpoint[0], 'offset': self._checkpoint[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.directory / _CHECKPOINT_FILE)
+
+    def _load(self) -> None:
+        """Rebuild the unread record index from the checkpoint and the segment files on disk."""
+        checkpoint_path = self.directory / _CHECKPOINT_FILE
+        if checkpoint_path.exists():
+            with open(checkpoint_path) as f:
+                data = json.load(f)
+            self._checkpoint = (data['segment'], data['offset'])
+
+        for path in sorted(self.directory.glob(f"*{_SEGMENT_SUFFIX}")):
+            segment = int(path.stem)
+            if segment < self._checkpoint[0]:
+                path.unlink()
+                continue
+            start = self._checkpoint[1] if segment == self._checkpoint[0] else 0
+            self._segment_sizes[segment] = self._scan_segment(path, segment, start)
+
+        if self.pending_rows:
+            logger.info(f"Recovered {self.pending_rows} unsent metrics from spool {self.directory}")
+
+    def _scan_segment(self, path: Path, segment: int, start: int) -> int:
+        """Index the records of a segment from start, truncating a torn write at the end."""
+        records = self._segment_records[segment] = deque()
+        size = path.stat().st_size
+        if size == 0:
+            return 0
+        offset = 0
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            while offset + _RECORD_HEADER.size <= size:
+                length, rows, enqueued_at = _RECORD_HEADER.unpack_from(mapped, offset)
+                end = offset + _RECORD_HEADER.size + length
+                if end > size:
+                    break
+                if offset >= start:
+                    records.append((offset, rows, enqueued_at))
+                    self.pending_rows += rows
+                offset = end
+        if offset < size:
+            logger.warning(f"Truncating torn record at {path}:{offset}")
+            os.truncate(path, offset)
+        return offset
+
@@ -55,12 +55,22 @@ class SystemMetricsConfig:
     cpu_load: MetricConfig
     ram_usage: MetricConfig
     network_sent: MetricConfig
+    network_sent_rate: Optional[MetricConfig] = None
+    network_recv_rate: Optional[MetricConfig] = None
+    disk_read_rate: Optional[MetricConfig] = None
+    disk_write_rate: Optional[MetricConfig] = None
+    cpu_core_load: Optional[MetricConfig] = None
 
 @dataclass
 class CryptoMetricsConfig:
     price: MetricConfig
     bid: MetricConfig
     ask: MetricConfig
+    open: Optional[MetricConfig] = None
+    high: Optional[MetricConfig] = None
+    low: Optional[MetricConfig] = None
+    close: Optional[MetricConfig] = None
+    volume: Optional[MetricConfig] = None
 
 @dataclass
 class TransformRulesConfig:
@@ -87,6 +97,74 @@ class ServerConfig:
     polling_endpoint: str
     polling_interval: int
     api_metrics_endpoint: str
+    wire_format: str = 'json'
+    max_retries: int = 3
+    max_in_flight: int = 1
+    max_batch_age_seconds: float = 10.0
+    collector_timeout_seconds: float = 4.0
+    spool_dir: Optional[str] = None
+    spool_max_bytes: int = 256 * 1024 * 1024
+    spool_segment_bytes: int = 8 * 1024 * 1024
+    spool_fsync: bool = False
+    pool_maxsize: int = 4
+    timestamp_format: str = 'iso'  # 'iso' or 'epoch_ms' timestamps in JSON uploads
+    compression: str = 'gzip'
+
+@dataclass
+class IngestConfig:
+    dimension_cache_size: int = 10000
+    insert_chunk_size: int = 1000
+    buffer_enabled: bool = True
+    buffer_max_rows: int = 50000
+    buffer_flush_rows: int = 2000
+    buffer_flush_interval_seconds: float = 1.0
+    buffer_retry_after_seconds: int = 2
+    dedup_window: int = 1024
+    dedup_max_agents: int = 10000
+    dedup_in_flight_timeout_seconds: float = 300.0  # After which a batch reserved by a dead worker is accepted again
+    max_upload_bytes: int = 16 * 1024 * 1024  # Request bodies as sent, larger uploads get a 413
+    max_decompressed_bytes: int = 64 * 1024 * 1024  # Compressed uploads that expand beyond this get a 413
+
+@dataclass
+class RollupConfig:
+    enabled: bool = True
+    resolutions: list = field(default_factory=lambda: [60, 300, 3600])
+    history_max_points: int = 500
+
+@dataclass
+class LatestValuesConfig:
+    persist: bool = True
+    flush_interval_seconds: float = 1.0
+
+@dataclass
+class ReadCacheConfig:
+    ttl_seconds: float = 60.0  # A safety net: ingest writes new rows through to the cache
+    refresh_ahead_seconds: float = 3.0  # Reads this close to expiry start the background refresh
+    cold_wait_seconds: float = 5.0
+
+@dataclass
+class SharedStateConfig:
+    backend: str = 'local'  # 'local' (one worker), 'file' (workers on one host) or 'redis'
+    redis_url: str = 'redis://localhost:6379/0'
+    file_path: Optional[str] = None  # SQLite file for the 'file' backend, defaults to the temp directory
+    key_prefix: str = 'metrics:'
+    local_ttl_seconds: float = 2.0  # Per-worker cache TTL in front of a shared backend
+    lock_ttl_seconds: float = 10.0
+    site_queue_max: int = 100
+    dedup_agent_ttl_seconds: float = 86400.0  # How long an agent's batch window is kept after its last batch
+    stream_ttl_seconds: float = 60.0  # How long a stored batch stays readable for the stream pollers
+    stream_poll_seconds: float = 0.1
+
+@dataclass
+class StreamConfig:
+    max_subscribers: int = 100
+    max_batches: int = 256  # Pending batches per subscriber before it is dropped as too slow
+    keepalive_seconds: float = 15.0
+    retry_ms: int = 3000
+
+@dataclass
+class SystemCollectorConfig:
+    per_core_cpu: bool = False
 
 @dataclass
 class CryptoCollectorConfig:
@@ -96,6 +174,20 @@ class CryptoCollectorConfig:
     device_id: str
     ticker_endpoint: str
     device_name: str
+    max_workers: int = 8
+    request_timeout: float = 5.0
+    cache_ttl_seconds: float = 2.0
+    stale_max_age_seconds: float = 60.0
+    mode: str = 'poll'  # 'poll' the REST ticker or 'stream' a push feed into OHLC bars
+    stream_url: Optional[str] = None
+    bar_interval_seconds: float = 60.0
+    stream_reconnect_seconds: float = 5.0
+
+@dataclass
+class CollectorScheduleConfig:
+    interval: Optional[float] = None
+    jitter: float = 0.0
+    align: bool = False
 
 @dataclass
 class CollectorTypesConfig:
@@ -112,11 +204,23 @@ class Config:
     server: ServerConfig
     crypto_collector: CryptoCollectorConfig
     collector_types: CollectorTypesConfig
+    ingest: IngestConfig = field(default_factory=IngestConfig)
+    system_collector: SystemCollectorConfig = field(default_factory=SystemCollectorConfig)
+    rollups: RollupConfig = field(default_factory=RollupConfig)
+    latest_values: LatestValuesConfig = field(default_factory=LatestValuesConfig)
+    stream: StreamConfig = field(default_factory=StreamConfig)
+    read_cache: ReadCacheConfig = field(default_factory=ReadCacheConfig)
+    shared_state: SharedStateConfig = field(default_factory=SharedStateConfig)
+    collector_schedules: Dict[str, CollectorScheduleConfig] = field(default_factory=dict)
 
     @property
     def SQLALCHEMY_DATABASE_URI(self) -> str:
         return self.database.get_database_url()
 
+    @property
+    def MAX_CONTENT_LENGTH(self) -> int:
+        return self.ingest.max_upload_bytes
+
 def load_config():
     config_path = Path(__file__).parent / 'config.json'
     if not config_path.exists():
@@ -146,6 +250,17 @@ def load_config():
             server=ServerConfig(**config_data['server']),
             crypto_collector=CryptoCollectorConfig(**config_data['crypto_collector']),
             collector_types=CollectorTypesConfig(**config_data['collector_types']),
+            ingest=IngestConfig(**config_data.get('ingest', {})),
+            system_collector=SystemCollectorConfig(**config_data.get('system_collector', {})),
+            rollups=RollupConfig(**config_data.get('rollups', {})),
+            latest_values=LatestValuesConfig(**config_data.get('latest_values', {})),
+            stream=StreamConfig(**config_data.get('stream', {})),
+            read_cache=ReadCacheConfig(**config_data.get('read_cache', {})),
+            shared_state=SharedStateConfig(**config_data.get('shared_state', {})),
+            collector_schedules={
+                name: CollectorScheduleConfig(**schedule)
+                for name, schedule in config_data.get('collector_schedules', {}).items()
+            },
         )
     except Exception as e:
         logging.error(f"Failed to load configuration: {str(e)}")
@@ -6,6 +6,9 @@ from utils.logger import get_logger  # Import logger
 
 logger = get_logger('RunApp')  # Initialize logger
 
+# How long shutdown waits for an in-progress collection or upload to finish
+SHUTDOWN_TIMEOUT_SECONDS = 30
+
 def run_app() -> None:
     """Initializes and runs the collector, uploader, and site poller threads"""
     uploader_queue = UploaderQueue()
@@ -23,9 +26,14 @@ def run_app() -> None:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        uploader_queue.running = False
+        uploader_queue.stop()
         site_poller.running = False
         logger.info("Shutting down application...")  # Use logger instead of print
+        # The uploader closes the spool once it has stopped, so wait for it before exiting
+        for thread in (collector_thread, uploader_thread):
+            thread.join(SHUTDOWN_TIMEOUT_SECONDS)
+            if thread.is_alive():
+                logger.warning(f"{thread.name} did not stop within {SHUTDOWN_TIMEOUT_SECONDS}s")
 
 if __name__ == "__main__":
     run_app()
@@ -1,26 +1,38 @@
-from sqlalchemy import create_engine, inspect
+from datetime import datetime, timezone
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.exc import SQLAlchemyError
-from .db_models import Base, Device, MetricType, Unit, MetricMeasurement, DeviceDetails
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from .db_models import Device, MetricType, Unit, MetricMeasurement, DeviceDetails
 from utils.logger import get_logger
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from utils.timer import Timer  # Import Timer utility
+from .dimension_cache import DimensionCache
+from .schema import ensure_schema
+from utils.timestamp import datetime_to_epoch_ms, epoch_ms_to_datetime
 
 logger = get_logger(__name__)
 
 class DatabaseAggregator:
-    def __init__(self, connection_string):
+    def __init__(self, connection_string, dimension_cache=None, insert_chunk_size=1000, rollups=None):
+        self.insert_chunk_size = max(1, insert_chunk_size)
+        # Called with the rows of every committed batch, see add_ingest_listener
+        self._ingest_listeners = []
+        # Resolved dimension ids are shared by every request this aggregator serves
+        self.dimension_cache = dimension_cache or DimensionCache()
         try:
             logger.info("Initializing database connection...")
             self.engine = create_engine(connection_string, pool_recycle=280)
             self.Session = scoped_session(sessionmaker(bind=self.engine))
 
-            inspector = inspect(self.engine)
-            if not inspector.get_table_names():
-                Base.metadata.create_all(self.engine)
-                logger.info("Database tables created successfully")
-            else:
-                logger.info("Database tables already exist")
+            ensure_schema(self.engine)
+            logger.info("Database schema is up to date")
+
+            # Rollups are updated in the same transaction as the measurements they summarize
+            self.rollups = rollups
+            if rollups is not None and not rollups.supports(self.engine.dialect.name):
+                logger.warning(f"Rollups are not supported on {self.engine.dialect.name}, disabling them")
+                self.rollups = None
 
             logger.info("Database connection established successfully")
         except SQLAlchemyError as e:
@@ -43,54 +55,21 @@ class DatabaseAggregator:
     def get_session(self):
         return self.Session()
 
-    def cleanup_session(self, session):
-        try:
-            self.Session.remove()
-        except Exception as e:
-            logger.error(f"Error cleaning up session: {str(e)}")
-
-    def get_or_create(self, session, model, filter_by, defaults=None, cache=None):
+    def add_ingest_listener(self, listener):
         """
-        Retrieve an existing database record that matches the given filter criteria, or create a new one if it does not exist.
-
-        Args:
-            session (Session): The SQLAlchemy session to use for database operations.
-            model (Base): The SQLAlchemy model class representing the database table.
-            filter_by (dict): A dictionary of field names and values to filter the query by.
-            defaults (dict, optional): A dictionary of default values to use when creating a new record. Defaults to None.
-            cache (dict, optional): An optional cache dictionary to store and retrieve instances. Defaults to None.
+        Register a callable that receives the rows of every batch once it is committed.
 
-        Returns:
-            instance (Base): The retrieved or newly created instance of the model.
-
-        Raises:
-            SQLAlchemyError: If there is an error during the database operation.
+        Each row has device_id, device_name, name, value, type, unit, type_id, unit_id,
+        timestamp_utc, timestamp_ms and utc_offset. Listeners run on the storing thread,
+        so they should only do cheap in-memory work; their errors are logged, never raised.
         """
-        defaults = defaults or {}
-
-        cache_key = tuple(sorted(filter_by.items())) if cache is not None else None
-
-        # Check cache first
-        if cache and cache_key in cache:
-            return cache[cache_key]
+        self._ingest_listeners.append(listener)
 
+    def cleanup_session(self, session):
         try:
-            # Try fetching from the database
-            instance = session.query(model).filter_by(**filter_by).first()
-            if not instance:
-                instance = model(**filter_by, **defaults)
-                session.add(instance)
-                session.flush() 
-
-            # Store in cache if applicable
-            if cache is not None:
-                cache[cache_key] = instance
-
-            return instance
-
-        except SQLAlchemyError as e:
-            logger.error(f"Error in get_or_create for {model.__name__}: {str(e)}")
-            raise
+            self.Session.remove()
+        except Exception as e:
+            logger.error(f"Error cleaning up session: {str(e)}")
 
     def store_metrics(self, metrics_data):
         """Store a list of metrics in the database. The input is a list of dictionaries
@@ -102,6 +81,7 @@ class DatabaseAggregator:
             - name: The name of the metric.
             - value: The value of the metric.
             - timestamp_utc: The UTC timestamp of the metric.
+            - timestamp_ms: Optionally the timestamp as integer epoch milliseconds, used instead of timestamp_utc.
             - utc_offset: The UTC offset of the metric.
 
         The method will validate the input and store the metrics in the database.
@@ -114,48 +94,70 @@ class DatabaseAggregator:
         Returns:
             bool: True if the operation was successful, False otherwise.
         """
-        with Timer("store_metrics"), self as session:
+        with Timer("store_metrics"):
+            try:
+                return self._store_metrics_once(metrics_data)
+            except IntegrityError as e:
+                # A cached id can outlive its row (e.g. after a manual cleanup), so drop the
+                # batch's keys from the dimension cache and resolve them again from the database.
+                logger.warning(f"Conflict while storing metrics, refreshing dimension cache: {str(e)}")
+                self._invalidate_dimensions(metrics_data)
+                return self._store_metrics_once(metrics_data)
+
+    def _store_metrics_once(self, metrics_data):
+        with self as session:
             try:
                 logger.info(f"Processing {len(metrics_data)} metrics")
 
-                # Using dict for caching fetched objects
-                metric_type_cache, unit_cache, device_cache, device_details_cache = {}, {}, {}, {}
-
-                measurements = []
+                valid_metrics = []
                 for metric in metrics_data:
                     metric_value = self._validate_metric_value(metric)
                     if metric_value is None:
                         continue  # Skip invalid metrics
+                    valid_metrics.append((metric, metric_value))
+
+                timestamps = self._parse_timestamps(valid_metrics)
+                valid_metrics = [
+                    (metric, metric_value) for metric, metric_value in valid_metrics
+                    if timestamps[self._timestamp_key(metric)] is not None  # Skip invalid timestamps
+                ]
 
-                    metric_type = self._get_or_create_cached(session, MetricType, 
-                                                            {"name": str(metric.get("type", "system"))}, 
-                                                            metric_type_cache)
-                    unit = self._get_or_create_cached(session, Unit, 
-                                                    {"unit_name": str(metric.get("unit", "unknown"))}, 
-                                                    unit_cache)
-                    device = self._get_or_create_cached(session, Device, 
-                                                        {"device_id": str(metric.get("device_id", "unknown"))}, 
-                                                        device_cache)
-
-                    # Avoid unnecessary object creation if device already exists
-                    if device.device_id not in device_details_cache:
-                        self._get_or_create_cached(session, DeviceDetails, 
-                                                {"device_id": device.device_id}, 
-                                                device_details_cache,
-                                                defaults={"device_name": str(metric.get("device_name", "unknown"))})
-
-                    measurements.append(self._prepare_measurement(metric, device, metric_type, unit, metric_value))
+                dimensions = self._resolve_dimensions(session, valid_metrics)
+
+                measurements = []
+                stored_metrics = []
+                for metric, metric_value in valid_metrics:
+                    measurements.append(self._prepare_measurement(metric, dimensions, metric_value, timestamps))
+                    stored_metrics.append(metric)
 
                 if measurements:
                     self._bulk_insert_measurements(session, measurements)
 
-                return True
-
             except Exception as e:
                 session.rollback()
                 logger.error(f"Error storing metrics: {str(e)}")
                 raise
 
+        # Only publish ids to the shared cache once they are committed
+        for table, resolved in dimensions.items():
+            self.dimension_cache.put_many(table, resolved)
+        if self._ingest_listeners and measurements:
+            self._notify_ingest_listeners(stored_metrics, measurements)
+        return True
+
+    def _notify_ingest_listeners(self, metrics, measurements):
+        rows = [
+            dict(measurement,
+                 device_name=str(metric.get("device_name", "unknown")),
+                 type=self._type_key(metric),
+                 unit=self._unit_key(metric))
+            for metric, measurement in zip(metrics, measurements)
+        ]
+        for listener in self._ingest_listeners:
+            try:
+                listener(rows)
+            except Exception as e:
+                logger.error(f"Ingest listener {listener} failed: {str(e)}")
 
     def _validate_metric_value(self, metric):
         try:
@@ -164,26 +166,197 @@ class DatabaseAggregator:
             logger.warning(f"Invalid metric value: {metric.get('value')}. Skipping.")
             return None
 
-    def _get_or_create_cached(self, session, model, filter_by, cache, defaults={}):
-        return self.get_or_create(session, model, filter_by, defaults, cache)
+    @staticmethod
+    def _type_key(metric):
+        return str(metric.get("type", "system"))
 
-    def _prepare_measurement(self, metric, device, metric_type, unit, metric_value):
-        return MetricMeasurement(
-            device_id=device.device_id,
-            name=str(metric["name"]),
-            value=metric_value,
-            type_id=metric_type.id,
-            unit_id=unit.id,
-            timestamp_utc=metric.get("timestamp_utc"),
-            utc_offset=metric.get("utc_offset")
-        )
+    @staticmethod
+    def _unit_key(metric):
+        return str(metric.get("unit", "unknown"))
+
+    @staticmethod
+    def _device_key(metric):
+        return str(metric.get("device_id", "unknown"))
+
+    def _resolve_dimensions(self, session, valid_metrics):
+        """
+        Resolve the distinct dimension keys of a batch to their ids.
+
+        Each table costs at most one SELECT for the keys missing from the dimension cache
+        and one bulk insert for the keys that do not exist yet.
+
+        Returns:
+            dict: A mapping of table name to a dict of natural key -> id.
+        """
+        type_names, unit_names, device_names = set(), set(), {}
+        for metric, _ in valid_metrics:
+            type_names.add(self._type_key(metric))
+            unit_names.add(self._unit_key(metric))
+            device_names.setdefault(self._device_key(metric), str(metric.get("device_name", "unknown")))
+
+        # Devices must exist before their details because of the foreign key
+        dimensions = {
+            MetricType.__tablename__: self._resolve_dimension(session, MetricType, MetricType.name, type_names),
+            Unit.__tablename__: self._resolve_dimension(session, Unit, Unit.unit_name, unit_names),
+            Device.__tablename__: self._resolve_dimension(session, Device, Device.device_id, device_names),
+            DeviceDetails.__tablename__: self._resolve_dimension(
+                session, DeviceDetails, DeviceDetails.device_id, device_names,
+                defaults={device_id: {"device_name": name} for device_id, name in device_names.items()}
+            ),
+        }
+        required = {MetricType.__tablename__: type_names, Unit.__tablename__: unit_names, Device.__tablename__: device_names}
+        for table, keys in required.items():
+            unresolved = [key for key in keys if key not in dimensions[table]]
+            if unresolved:
+                # Measurements reference these ids, so the batch cannot be stored without them
+                raise SQLAlchemyError(f"Could not create {table} rows for keys: {unresolved}")
+
+        details = dimensions[DeviceDetails.__tablename__]
+        unresolved = {device_id: name for device_id, name in device_names.items() if device_id not in details}
+        if unresolved:
+            self._report_device_name_conflicts(session, unresolved)
+        return dimensions
+
+    def _report_device_name_conflicts(self, session, device_names):
+        """
+        Log devices whose details row could not be created because device_name is unique and
+        another device already has the name. Their measurements are stored all the same, as
+        they only reference the devices table; the details have to be renamed by hand.
+        """
+        owners = dict(session.execute(
+            sa.select(DeviceDetails.device_name, DeviceDetails.device_id)
+            .where(DeviceDetails.device_name.in_(set(device_names.values())))
+        ).all())
+        for device_id, name in device_names.items():
+            if name in owners:
+                logger.error(f"Device {device_id} reports the name '{name}', which device {owners[name]} "
+                             f"already has; storing its measurements without device details")
+            else:
+                logger.error(f"Could not create device details for {device_id}; storing its measurements without them")
+
+    def _resolve_dimension(self, session, model, key_column, keys, defaults=None):
+        resolved, missing = self.dimension_cache.get_many(model.__tablename__, keys)
+        if not missing:
+            return resolved
+
+        existing = self._select_ids(session, model, key_column, missing)
+        new_keys = [key for key in missing if key not in existing]
+        if new_keys:
+            defaults = defaults or {}
+            session.execute(
+                self._insert_missing(model),
+                [{key_column.key: key, **defaults.get(key, {})} for key in new_keys]
+            )
+            # Re-select so rows inserted concurrently by another worker are picked up too
+            existing.update(self._select_ids(session, model, key_column, new_keys))
+
+        resolved.update(existing)
+        return resolved
+
+    def _select_ids(self, session, model, key_column, keys):
+        rows = session.execute(sa.select(key_column, model.id).where(key_column.in_(keys)))
+        return {key: row_id for key, row_id in rows}
+
+    def _insert_missing(self, model):
+        """
+        Insert that skips rows conflicting with a unique key, e.g. ones another worker inserted
+        concurrently. Unlike INSERT IGNORE it still raises on truncation and other errors.
+        """
+        table = model.__table__
+        dialect_name = self.engine.dialect.name
+        if dialect_name == 'mysql':
+            # Assigning id to itself leaves the existing row untouched
+            return mysql.insert(table).on_duplicate_key_update(id=table.c.id)
+        if dialect_name in ('sqlite', 'postgresql'):
+            return (sqlite if dialect_name == 'sqlite' else postgresql).insert(table).on_conflict_do_nothing()
+        return sa.insert(table)  # A concurrent insert surfaces as IntegrityError and is retried
+
+    def _invalidate_dimensions(self, metrics_data):
+        device_keys = {self._device_key(metric) for metric in metrics_data}
+        self.dimension_cache.invalidate(MetricType.__tablename__, {self._type_key(metric) for metric in metrics_data})
+        self.dimension_cache.invalidate(Unit.__tablename__, {self._unit_key(metric) for metric in metrics_data})
+        self.dimension_cache.invalidate(Device.__tablename__, device_keys)
+        self.dimension_cache.invalidate(DeviceDetails.__tablename__, device_keys)
+
+    @staticmethod
+    def _timestamp_key(metric):
+        return metric.get("timestamp_ms"), metric.get("timestamp_utc")
+
+    def _parse_timestamps(self, valid_metrics):
+        """
+        Resolve the distinct timestamps of a batch once, to (datetime, epoch ms) pairs.
+
+        Integer timestamp_ms values are used as they are. Otherwise timestamp_utc is
+        taken as a datetime or parsed from ISO. Measurements from one collection cycle
+        share a timestamp, so this is typically a handful of conversions per batch
+        instead of one per row.
+
+        A missing timestamp is stamped with the current time, as the column default did
+        before, and logged. An invalid one maps to None, and its measurements are skipped.
+        """
+        parsed = {}
+        for metric, _ in valid_metrics:
+            key = self._timestamp_key(metric)
+            if key in parsed:
+                continue
+            epoch_ms, raw = key
+            if epoch_ms is not None:
+                try:
+                    parsed[key] = (epoch_ms_to_datetime(int(epoch_ms)), int(epoch_ms))
+                    continue
+                except (ValueError, TypeError, OverflowError):
+                    logger.warning(f"Invalid timestamp_ms: {epoch_ms}. Falling back to timestamp_utc.")
+
+            if isinstance(raw, datetime):
+                value = raw
+            elif raw is None:
+                logger.warning("Metric without a timestamp. Using current time.")
+                value = datetime.now(timezone.utc)
+            else:
+                try:
+                    value = datetime.fromisoformat(str(raw))
+                except ValueError:
+                    logger.warning(f"Invalid timestamp: {raw}. Skipping.")
+                    parsed[key] = None
+                    continue
+            parsed[key] = (value, datetime_to_epoch_ms(value))
+        return parsed
+
+    def _prepare_measurement(self, metric, dimensions, metric_value, timestamps):
+        """Build a plain row for the Core insert, skipping ORM object construction."""
+        timestamp_utc, timestamp_ms = timestamps[self._timestamp_key(metric)]
+        return {
+            "device_id": self._device_key(metric),
+            "name": str(metric["name"]),
+            "value": metric_value,
+            "type_id": dimensions[MetricType.__tablename__][self._type_key(metric)],
+            "unit_id": dimensions[Unit.__tablename__][self._unit_key(metric)],
+            "timestamp_utc": timestamp_utc,
+            "timestamp_ms": timestamp_ms,
+            "utc_offset": self._utc_offset(metric),
+        }
+
+    @staticmethod
+    def _utc_offset(metric):
+        """The UTC offset in whole minutes, as the Integer column stores it; fractional values are rounded."""
+        offset = metric.get("utc_offset") or 0
+        try:
+            return round(float(offset))
+        except (ValueError, TypeError, OverflowError):
+            logger.warning(f"Invalid utc_offset: {offset}. Using 0.")
+            return 0
 
     def _bulk_insert_measurements(self, session, measurements):
+        """Insert measurement rows with Core executemany in chunks of insert_chunk_size."""
         if measurements:
             try:
-                session.bulk_save_objects(measurements)
+                insert = sa.insert(MetricMeasurement.__table__)
+                for start in range(0, len(measurements), self.insert_chunk_size):
+                    session.execute(insert, measurements[start:start + self.insert_chunk_size])
+                if self.rollups is not None:
+                    self.rollups.apply(session, measurements)
                 session.commit()
-                logger.info("Successfully stored all metrics")
+                logger.info(f"Successfully stored {len(measurements)} metrics")
             except SQLAlchemyError as e:
                 session.rollback()
                 logger.error(f"Bulk insert failed: {str(e)}")
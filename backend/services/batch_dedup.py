@@ -0,0 +1,145 @@
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Optional
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+NEW = 'new'
+DUPLICATE = 'duplicate'
+IN_FLIGHT = 'in_flight'
+
+
+class _AgentWindow:
+    __slots__ = ('high_water', 'seen')
+
+    def __init__(self, high_water: int = -1, seen: Optional[dict] = None):
+        self.high_water = high_water
+        # seq -> True once stored, or the time it was reserved while the first delivery is still being processed
+        self.seen = seen if seen is not None else {}
+
+    def reserve(self, seq: int, window: int, in_flight_timeout_seconds: float) -> str:
+        if seq in self.seen:
+            reserved = self.seen[seq]
+            if reserved is True:
+                return DUPLICATE
+            if time.time() - reserved < in_flight_timeout_seconds:
+                return IN_FLIGHT
+            logger.warning(f"Reservation of batch {seq} was never settled, accepting it again")
+        elif seq <= self.high_water - window:
+            return DUPLICATE
+
+        self.seen[seq] = time.time()
+        if seq > self.high_water:
+            self.high_water = seq
+            if len(self.seen) > 2 * window:
+                floor = self.high_water - window
+                self.seen = {seq: done for seq, done in self.seen.items() if seq > floor}
+        return NEW
+
+    def commit(self, seq: int) -> bool:
+        if seq not in self.seen:
+            return False
+        self.seen[seq] = True
+        return True
+
+    def release(self, seq: int) -> bool:
+        if seq not in self.seen or self.seen[seq] is True:
+            return False
+        del self.seen[seq]
+        return True
+
+    def to_json(self) -> bytes:
+        return json.dumps({'high_water': self.high_water, 'seen': self.seen}).encode()
+
+    @classmethod
+    def from_json(cls, payload: Optional[bytes]) -> '_AgentWindow':
+        if payload is None:
+            return cls()
+        state = json.loads(payload)
+        return cls(state['high_water'], {int(seq): done for seq, done in state['seen'].items()})
+
+
+class BatchDeduplicator:
+    """Detects replayed upload batches from their (agent id, sequence number) pair.
+
+    Each agent keeps a high-water mark and the sequence numbers seen within the last
+    `window` values below it, so batches arriving slightly out of order are still
+    accepted once. Anything older than the window is treated as a replay. The number
+    of tracked agents is bounded with LRU eviction.
+
+    A reservation that is neither committed nor released within in_flight_timeout_seconds,
+    e.g. because its worker died, no longer blocks the batch.
+
+    With a shared store each agent's window is kept in the store instead, under one key
+    per agent that expires agent_ttl_seconds after its last batch, so a replay that lands
+    on another worker is still recognised.
+    """
+
+    def __init__(self, window: int = 1024, max_agents: int = 10000, in_flight_timeout_seconds: float = 300.0,
+                 store=None, key_prefix: str = '', agent_ttl_seconds: float = 86400.0):
+        self.window = window
+        self.max_agents = max_agents
+        self.in_flight_timeout_seconds = in_flight_timeout_seconds
+        self.store = store
+        self.key_prefix = key_prefix
+        self.agent_ttl_seconds = agent_ttl_seconds
+        self._agents: "OrderedDict[str, _AgentWindow]" = OrderedDict()
+        self._lock = Lock()
+
+    def reserve(self, agent_id: str, seq: int) -> str:
+        """
+        Claim a batch before it is processed.
+
+        Returns:
+            str: NEW if the caller should process the batch, DUPLICATE if it was already
+            stored, or IN_FLIGHT if another request is still processing it.
+        """
+        if self.store is not None:
+            return self._update_shared(
+                agent_id, lambda agent: agent.reserve(seq, self.window, self.in_flight_timeout_seconds)
+            )
+        with self._lock:
+            agent = self._agents.get(agent_id)
+            if agent is None:
+                agent = self._agents[agent_id] = _AgentWindow()
+                if len(self._agents) > self.max_agents:
+                    self._agents.popitem(last=False)
+            else:
+                self._agents.move_to_end(agent_id)
+            return agent.reserve(seq, self.window, self.in_flight_timeout_seconds)
+
+    def commit(self, agent_id: str, seq: int) -> None:
+        """Mark a reserved batch as stored so later replays are acknowledged."""
+        if self.store is not None:
+            self._update_shared(agent_id, lambda agent: agent.commit(seq))
+            return
+        with self._lock:
+            agent = self._agents.get(agent_id)
+            if agent is not None:
+                agent.commit(seq)
+
+    def release(self, agent_id: str, seq: int) -> None:
+        """Forget a reserved batch whose processing failed, so a retry is accepted."""
+        if self.store is not None:
+            self._update_shared(agent_id, lambda agent: agent.release(seq))
+            return
+        with self._lock:
+            agent = self._agents.get(agent_id)
+            if agent is not None:
+                agent.release(seq)
+
+    def _update_shared(self, agent_id: str, func: Callable[[_AgentWindow], object]):
+        result = []
+
+        def apply(payload):
+            del result[:]  # Applied again when another worker changed the window meanwhile
+            agent = _AgentWindow.from_json(payload)
+            result.append(func(agent))
+            return agent.to_json()
+
+        if not self.store.update(f"{self.key_prefix}batches:{agent_id}", apply, ttl_seconds=self.agent_ttl_seconds):
+            raise RuntimeError(f"Could not update the batch window of agent {agent_id}")
+        return result[0]
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Index
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -45,6 +45,10 @@ class MetricMeasurement(Base):
     __tablename__ = 'metric_measurements'
     __table_args__ = (
         Index("idx_type_timestamp", "type_id", "timestamp_utc"),  
+        # Covers the latest-metrics and keyset page reads: the (timestamp_ms, id) prefix
+        # matches their order and the trailing columns save a row lookup per result
+        Index("idx_type_timestamp_ms_covering", "type_id", "timestamp_ms", "id",
+              "device_id", "name", "unit_id", "value", "utc_offset"),
     )
     
     id = Column(Integer, primary_key=True)
@@ -55,7 +59,47 @@ class MetricMeasurement(Base):
     unit_id = Column(Integer, ForeignKey('units.id'), nullable=False)  
     timestamp_utc = Column(DateTime(timezone=True), nullable=False, server_default=func.now())  
     utc_offset = Column(Integer, nullable=False)  
+    # timestamp_utc as epoch milliseconds; nullable only so it can be added to existing tables
+    timestamp_ms = Column(BigInteger, nullable=True)
 
     type = relationship("MetricType", back_populates="metric_measurements")
     unit = relationship("Unit", back_populates="metric_measurements")
     device = relationship("Device", back_populates="metric_measurements")
+
+class MetricRollup(Base):
+    """Downsampled measurements: one row per resolution, device, metric name and time bucket."""
+    __tablename__ = 'metric_rollups'
+    __table_args__ = (
+        UniqueConstraint("resolution_seconds", "device_id", "name", "bucket_start_ms", name="uq_rollup_bucket"),
+        Index("idx_rollup_type_bucket", "resolution_seconds", "type_id", "bucket_start_ms"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    resolution_seconds = Column(Integer, nullable=False)
+    bucket_start_ms = Column(BigInteger, nullable=False)
+    device_id = Column(String(100), ForeignKey('devices.device_id'), nullable=False)
+    name = Column(String(100), nullable=False)
+    type_id = Column(Integer, ForeignKey('metric_types.id'), nullable=False)
+    unit_id = Column(Integer, ForeignKey('units.id'), nullable=False)
+    min_value = Column(Float, nullable=False)
+    max_value = Column(Float, nullable=False)
+    sum_value = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+    last_value = Column(Float, nullable=False)
+    last_timestamp_ms = Column(BigInteger, nullable=False)
+
+class LatestValue(Base):
+    """Newest measurement per device and metric name, persisted from LatestValueIndex."""
+    __tablename__ = 'latest_values'
+    __table_args__ = (
+        UniqueConstraint("device_id", "name", name="uq_latest_device_name"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    device_id = Column(String(100), ForeignKey('devices.device_id'), nullable=False)
+    name = Column(String(100), nullable=False)
+    type_id = Column(Integer, ForeignKey('metric_types.id'), nullable=False)
+    unit_id = Column(Integer, ForeignKey('units.id'), nullable=False)
+    value = Column(Float, nullable=False)
+    timestamp_ms = Column(BigInteger, nullable=False)
+    utc_offset = Column(Integer, nullable=False)
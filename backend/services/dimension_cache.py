@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, Iterable, List, Tuple
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class DimensionCache:
+    """Bounded, thread-safe LRU cache of resolved dimension ids.
+
+    Entries are keyed by (table name, natural key) so a single instance can hold
+    metric types, units and devices side by side. One instance is meant to live
+    for the whole process so lookups survive across upload requests.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[str, Hashable], Any]" = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get_many(self, table: str, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, Any], List[Hashable]]:
+        """Look up several keys of one table.
+
+        Returns:
+            tuple: A dict of the keys that were found mapped to their ids, and a list of the missing keys.
+        """
+        found, missing = {}, []
+        with self._lock:
+            for key in keys:
+                cache_key = (table, key)
+                if cache_key in self._entries:
+                    self._entries.move_to_end(cache_key)
+                    found[key] = self._entries[cache_key]
+                else:
+                    missing.append(key)
+        return found, missing
+
+    def put_many(self, table: str, mapping: Dict[Hashable, Any]) -> None:
+        """Store resolved ids, evicting the least recently used entries when full."""
+        with self._lock:
+            for key, value in mapping.items():
+                cache_key = (table, key)
+                self._entries[cache_key] = value
+                self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, table: str, keys: Iterable[Hashable]) -> None:
+        """Drop the given keys, e.g. after a conflict showed the cached ids are stale."""
+        with self._lock:
+            for key in keys:
+                self._entries.pop((table, key), None)
+        logger.debug(f"Invalidated dimension cache entries for {table}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        logger.debug("Dimension cache cleared")
@@ -0,0 +1,187 @@
+import json
+import queue
+import time
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Iterable, List, Optional
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Fields of a stored row sent to subscribers
+_PUBLISHED_FIELDS = ('device_id', 'device_name', 'name', 'value', 'type', 'unit', 'timestamp_ms', 'utc_offset')
+# How long a poller waits for a numbered batch that is not in the store yet before skipping it
+_MISSING_BATCH_GRACE_SECONDS = 2.0
+
+
+class SubscriberLimitError(Exception):
+    """Raised when a subscription would exceed the broker's max_subscribers."""
+
+
+class Subscription:
+    """One subscriber's filter and bounded queue of pending batches."""
+    __slots__ = ('metric_type', 'device_id', 'dropped', '_queue')
+
+    def __init__(self, metric_type: Optional[str], device_id: Optional[str], max_batches: int):
+        self.metric_type = metric_type
+        self.device_id = device_id
+        self.dropped = False
+        self._queue = queue.Queue(maxsize=max_batches)
+
+    def matches(self, row: Dict[str, Any]) -> bool:
+        return ((self.metric_type is None or row['type'] == self.metric_type)
+                and (self.device_id is None or row['device_id'] == self.device_id))
+
+    def get(self, timeout: float) -> Optional[List[Dict[str, Any]]]:
+        """
+        The next pending batch, or None if none arrived within timeout.
+        Returns None at once when the subscriber has been dropped.
+        """
+        if self.dropped:
+            return None
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _offer(self, rows: List[Dict[str, Any]]) -> bool:
+        try:
+            self._queue.put_nowait(rows)
+            return True
+        except queue.Full:
+            return False
+
+
+class EventBroker:
+    """Fans stored measurements out to streaming subscribers.
+
+    publish() is an ingest listener. Per subscriber it only filters the batch and
+    puts the matching rows on a bounded queue without blocking; encoding happens on
+    the subscriber's own thread. A subscriber whose queue is full has fallen
+    max_batches batches behind and is dropped rather than slowing ingest down or
+    growing without bound. It is told so and can reconnect for a fresh start.
+
+    With a shared store publish() writes each batch to the store under the next number
+    of a shared counter, where it is kept for ttl_seconds, and a poller started by start()
+    reads the new batches every poll_seconds and queues them for this process's
+    subscribers. Subscribers then get the batches stored by every worker, in one order.
+    """
+
+    def __init__(self, max_batches: int = 256, max_subscribers: int = 100, store=None, key_prefix: str = '',
+                 ttl_seconds: float = 60.0, poll_seconds: float = 0.1):
+        self.max_batches = max(1, max_batches)
+        self.max_subscribers = max_subscribers
+        self.store = store
+        self.key_prefix = key_prefix
+        self.ttl_seconds = ttl_seconds
+        self.poll_seconds = poll_seconds
+        self._subscriptions: List[Subscription] = []
+        self._lock = Lock()
+        self._next_seq = None  # Next shared batch to read, while there are subscribers
+        self._missing_since = None
+        self._closed = Event()
+        self._thread = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._subscriptions)
+
+    def subscribe(self, metric_type: Optional[str] = None, device_id: Optional[str] = None) -> Subscription:
+        """
+        Register a subscriber for the measurements of one metric type and/or device.
+
+        Raises:
+            SubscriberLimitError: If max_subscribers are already connected.
+        """
+        subscription = Subscription(metric_type, device_id, self.max_batches)
+        with self._lock:
+            if len(self._subscriptions) >= self.max_subscribers:
+                raise SubscriberLimitError(f"Subscriber limit of {self.max_subscribers} reached")
+            if self.store is not None and self._next_seq is None:
+                self._next_seq = self._latest_seq() + 1
+            # Copy on write, so publish() can iterate without holding the lock
+            self._subscriptions = self._subscriptions + [subscription]
+        logger.info(f"Stream subscriber added (metric_type={metric_type}, device_id={device_id})")
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions = [s for s in self._subscriptions if s is not subscription]
+
+    def publish(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """Ingest listener: queue the rows of a stored batch for every subscriber they match."""
+        if self.store is not None:
+            rows = [{field: row[field] for field in _PUBLISHED_FIELDS} for row in rows]
+            seq = self.store.increment(self._seq_key())
+            self.store.set(self._batch_key(seq), json.dumps(rows).encode(), ttl_seconds=self.ttl_seconds)
+            return
+        if not self._subscriptions:
+            return
+        self._dispatch([{field: row[field] for field in _PUBLISHED_FIELDS} for row in rows])
+
+    def start(self) -> None:
+        """Start the poller of the shared store; a no-op without one."""
+        if self.store is None:
+            return
+        self._thread = Thread(target=self._run, name='EventBrokerPoller', daemon=True)
+        self._thread.start()
+        logger.info(f"Event broker poller started (poll_interval={self.poll_seconds}s)")
+
+    def close(self, timeout: float = 5.0) -> None:
+        self._closed.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._closed.wait(self.poll_seconds):
+            try:
+                self._poll()
+            except Exception as e:
+                logger.error(f"Error polling stream batches: {str(e)}")
+
+    def _poll(self) -> None:
+        """Queue the shared batches published since the last poll, while anyone is subscribed."""
+        with self._lock:
+            if not self._subscriptions:
+                self._next_seq = None
+                return
+            next_seq = self._next_seq
+        latest = self._latest_seq()
+        while next_seq <= latest:
+            payload = self.store.get(self._batch_key(next_seq))
+            if payload is None:
+                # Numbered but not written yet, or expired while this worker was behind
+                if self._missing_since is None:
+                    self._missing_since = time.monotonic()
+                if time.monotonic() - self._missing_since < _MISSING_BATCH_GRACE_SECONDS:
+                    break
+                logger.warning(f"Skipping stream batch {next_seq}, which is not in the shared store")
+            else:
+                self._missing_since = None
+                self._dispatch(json.loads(payload))
+            next_seq += 1
+        with self._lock:
+            if self._next_seq is not None:
+                self._next_seq = next_seq
+
+    def _latest_seq(self) -> int:
+        return int(self.store.get(self._seq_key()) or 0)
+
+    def _seq_key(self) -> str:
+        return f"{self.key_prefix}stream:seq"
+
+    def _batch_key(self, seq: int) -> str:
+        return f"{self.key_prefix}stream:{seq}"
+
+    def _dispatch(self, rows: List[Dict[str, Any]]) -> None:
+        subscriptions = self._subscriptions
+        slow = []
+        for subscription in subscriptions:
+            matching = [row for row in rows if subscription.matches(row)]
+            if matching and not subscription._offer(matching):
+                subscription.dropped = True
+                slow.append(subscription)
+        for subscription in slow:
+            self.unsubscribe(subscription)
+            logger.warning(f"Dropped stream subscriber (metric_type={subscription.metric_type}, "
+                           f"device_id={subscription.device_id}) after falling {self.max_batches} batches behind")
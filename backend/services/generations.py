@@ -0,0 +1,82 @@
+import hashlib
+import json
+import secrets
+from threading import Lock
+from typing import Any, Dict, Iterable, Optional
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class GenerationCounter:
+    """Per metric type counter of changes to the data served for that type.
+
+    Ingest bumps the types of every batch it stores, and so does anything else that
+    changes what is served, such as a cache refresh. A response built at one generation
+    is therefore unchanged for as long as the generation is, which makes the pair a
+    cheap ETag. The tag includes a token drawn per process, so a tag issued by one
+    worker never matches the independent counter of another.
+
+    With a shared store the counters and the token live in the store instead, so every
+    worker issues the same tag for the same generation. The token is drawn again if the
+    store loses it, e.g. when Redis is flushed, and the counters restart with it.
+    """
+
+    def __init__(self, store=None, key_prefix: str = ''):
+        self.store = store
+        self.key_prefix = key_prefix
+        self.token = secrets.token_hex(4)
+        self._generations: Dict[str, int] = {}
+        self._digests: Dict[str, bytes] = {}
+        self._lock = Lock()
+
+    def get(self, metric_type: str) -> int:
+        if self.store is not None:
+            return int(self.store.get(self._key(metric_type)) or 0)
+        return self._generations.get(metric_type, 0)
+
+    def bump(self, metric_type: str) -> int:
+        if self.store is not None:
+            return self.store.increment(self._key(metric_type))
+        with self._lock:
+            generation = self._generations[metric_type] = self._generations.get(metric_type, 0) + 1
+            return generation
+
+    def bump_if_changed(self, metric_type: str, data: Any) -> bool:
+        """
+        Bump metric_type unless data is the same as at the previous call for it, so a cache
+        reload that found nothing new leaves ETags valid. data is compared by a digest of its JSON.
+
+        Returns:
+            bool: True if the generation was bumped.
+        """
+        digest = hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).digest()
+        with self._lock:
+            if self._digests.get(metric_type) == digest:
+                return False
+            self._digests[metric_type] = digest
+        self.bump(metric_type)
+        return True
+
+    def bump_rows(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """Ingest listener: bump each metric type present in a stored batch once."""
+        for metric_type in {row['type'] for row in rows}:
+            self.bump(metric_type)
+
+    def etag(self, metric_type: str) -> str:
+        """Unquoted entity tag for the current generation of metric_type."""
+        return f"{self._token()}-{metric_type}-{self.get(metric_type)}"
+
+    def _key(self, metric_type: str) -> str:
+        return f"{self.key_prefix}generation:{self._token()}:{metric_type}"
+
+    def _token(self) -> str:
+        if self.store is None:
+            return self.token
+        key = f"{self.key_prefix}generation:token"
+        token: Optional[bytes] = self.store.get(key)
+        if token is None:
+            # The first worker to get here draws the token; the others keep it
+            self.store.update(key, lambda current: current or self.token.encode())
+            token = self.store.get(key)
+        return token.decode()
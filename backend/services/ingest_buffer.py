@@ -0,0 +1,156 @@
+import time
+import traceback
+from collections import deque
+from threading import Condition, Thread
+from typing import Any, Callable, Dict, List, Optional
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class IngestBuffer:
+    """Bounded in-process write-behind buffer for uploaded metrics.
+
+    Upload requests only append to the buffer. A single background flusher merges
+    the pending rows into large store_metrics transactions, flushing once
+    flush_rows rows are waiting or the oldest row is flush_interval_seconds old.
+    Batches are cut at offer boundaries, so each offer is stored in one transaction
+    and its on_stored callback learns whether it was. A batch that still fails after
+    max_flush_attempts is split in halves, each tried once, down to single offers, so
+    an offer the store rejects only drops itself.
+    """
+
+    def __init__(self, store_func: Callable[[List[Dict[str, Any]]], Any], max_rows: int = 50000,
+                 flush_rows: int = 2000, flush_interval_seconds: float = 1.0, max_flush_attempts: int = 3,
+                 retry_backoff_seconds: float = 1.0):
+        self.store_func = store_func
+        self.max_rows = max_rows
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_flush_attempts = max_flush_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+
+        self._offers = deque()  # (rows, on_stored, enqueued_at) per offer, in buffer order
+        self._row_count = 0
+        self._condition = Condition()
+        self._closed = False
+        self._thread = Thread(target=self._run, name='IngestBufferFlusher', daemon=True)
+
+    def __len__(self) -> int:
+        with self._condition:
+            return self._row_count
+
+    def start(self) -> None:
+        self._thread.start()
+        logger.info(f"Ingest buffer started (max_rows={self.max_rows}, flush_rows={self.flush_rows}, "
+                    f"flush_interval={self.flush_interval_seconds}s)")
+
+    def offer(self, rows: List[Dict[str, Any]], on_stored: Optional[Callable[[bool], None]] = None) -> bool:
+        """
+        Buffer rows for a later flush.
+
+        Args:
+            rows (list): The metric dicts to store.
+            on_stored (callable, optional): Called on the flusher thread with True once the
+                rows are stored, or False if they were dropped after max_flush_attempts.
+
+        Returns:
+            bool: True if the rows were accepted, False if the buffer is full or shutting down.
+        """
+        with self._condition:
+            if self._closed or self._row_count + len(rows) > self.max_rows:
+                return False
+            was_empty = not self._offers
+            self._offers.append((list(rows), on_stored, time.monotonic()))
+            self._row_count += len(rows)
+            # Waking the flusher on the first offer lets it time the age flush of a small batch
+            if was_empty or self._row_count >= self.flush_rows:
+                self._condition.notify()
+            return True
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Stop accepting rows and wait for the flusher to drain what is already buffered."""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        logger.info("Draining ingest buffer before shutdown...")
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Ingest buffer did not drain within {timeout}s, {len(self)} rows lost")
+        else:
+            logger.info("Ingest buffer drained")
+
+    def _age(self) -> float:
+        # Leftover offers keep the time they were enqueued, so they are not held back another interval
+        return time.monotonic() - self._offers[0][2]
+
+    def _flush_due(self) -> bool:
+        if self._row_count >= self.flush_rows:
+            return True
+        return bool(self._offers) and self._age() >= self.flush_interval_seconds
+
+    def _take_batch(self) -> list:
+        """Take whole offers until at least flush_rows rows, or everything buffered, are taken."""
+        offers, count = [], 0
+        while self._offers and (count < self.flush_rows or not offers):
+            rows, on_stored, _ = self._offers.popleft()
+            offers.append((rows, on_stored))
+            count += len(rows)
+        self._row_count -= count
+        return offers
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed and not self._flush_due():
+                    if self._offers:
+                        self._condition.wait(max(0.0, self.flush_interval_seconds - self._age()))
+                    else:
+                        self._condition.wait()
+                if not self._offers:
+                    return  # Closed and fully drained
+                offers = self._take_batch()
+            stored = self._flush(offers, self.max_flush_attempts)
+            if not stored and len(offers) > 1:
+                self._flush_halves(offers)
+                continue
+            self._report(offers, stored)
+
+    def _flush_halves(self, offers: list) -> None:
+        """Store the offers of a failed batch in halves, once each, until the failing offers are isolated."""
+        middle = len(offers) // 2
+        for half in (offers[:middle], offers[middle:]):
+            stored = self._flush(half, 1)
+            if not stored and len(half) > 1:
+                self._flush_halves(half)
+            else:
+                self._report(half, stored)
+
+    def _flush(self, offers: list, max_attempts: int) -> bool:
+        batch = [row for rows, _ in offers for row in rows]
+        for attempt in range(1, max_attempts + 1):
+            try:
+                self.store_func(batch)
+                logger.info(f"Flushed {len(batch)} buffered metrics")
+                return True
+            except Exception as e:
+                logger.error(f"Flush attempt {attempt}/{max_attempts} of {len(batch)} metrics failed: {str(e)}")
+                logger.debug(traceback.format_exc())
+                if attempt < max_attempts:
+                    time.sleep(self.retry_backoff_seconds * attempt)
+        if len(offers) == 1:
+            logger.error(f"Dropping {len(batch)} buffered metrics after {max_attempts} failed flushes")
+        return False
+
+    @staticmethod
+    def _report(offers: list, stored: bool) -> None:
+        for _, on_stored in offers:
+            if on_stored is None:
+                continue
+            try:
+                on_stored(stored)
+            except Exception as e:
+                logger.error(f"on_stored callback failed: {str(e)}")
@@ -0,0 +1,251 @@
+import json
+import time
+import traceback
+from threading import Condition, Thread
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from utils.logger import get_logger
+from .db_models import DeviceDetails, LatestValue, MetricType, Unit
+
+logger = get_logger(__name__)
+
+_UPSERT_DIALECTS = ('mysql', 'sqlite', 'postgresql')
+# Fields of a stored row that are served; the rest (type_id, unit_id) are only kept for persisting
+_SERVED_FIELDS = ('device_id', 'device_name', 'name', 'value', 'type', 'unit', 'timestamp_ms', 'utc_offset')
+_PERSISTED_FIELDS = ('device_id', 'name', 'type_id', 'unit_id', 'value', 'timestamp_ms', 'utc_offset')
+
+
+class LatestValueIndex:
+    """Newest measurement per (device id, metric name), kept in memory.
+
+    DatabaseAggregator calls update() with every batch it stores, which costs one dict
+    lookup per measurement, so serving the current state of the fleet never touches the
+    measurements table and a device stays in the index however long it has been quiet.
+
+    With an engine the index is persisted to latest_values: entries changed since the
+    last flush are upserted by a background flusher every flush_interval_seconds, and
+    load() restores the index from the table at startup. Each process keeps its own
+    index, fed by the ingests it handles.
+
+    With a shared store every process also folds its rows into a copy of the index in
+    the store, one key per metric type, and get() reads from there, so every worker
+    serves the rows stored by all of them. The local index then only feeds persistence.
+    """
+
+    def __init__(self, engine=None, flush_interval_seconds: float = 1.0, store=None, key_prefix: str = ''):
+        self.engine = engine
+        if engine is not None and engine.dialect.name not in _UPSERT_DIALECTS:
+            logger.warning(f"Persisting latest values is not supported on {engine.dialect.name}, keeping them in memory only")
+            self.engine = None
+        self.flush_interval_seconds = flush_interval_seconds
+        self.store = store
+        self.key_prefix = key_prefix
+        self._shared_types = set()
+
+        self._values: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._dirty = set()
+        self._condition = Condition()
+        self._closed = False
+        self._thread = None
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._values)
+
+    def update(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """
+        Fold stored measurement rows into the index, keeping the newest row per key.
+
+        Rows need device_id, device_name, name, value, type, unit, timestamp_ms and
+        utc_offset, plus type_id and unit_id when the index is persisted.
+        """
+        values, dirty, persist = self._values, self._dirty, self.engine is not None
+        with self._condition:
+            for row in rows:
+                key = (row['device_id'], row['name'])
+                current = values.get(key)
+                if current is None or row['timestamp_ms'] >= current['timestamp_ms']:
+                    values[key] = row
+                    if persist:
+                        dirty.add(key)
+        if self.store is not None:
+            self._share(rows)
+
+    def get(self, metric_type: Optional[str] = None, device_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """The newest row of every (device, metric name), optionally for one metric type or device."""
+        rows = None
+        if self.store is not None:
+            try:
+                rows = self._read_shared(metric_type)
+            except Exception as e:
+                logger.error(f"Shared latest values unavailable, serving this worker's: {str(e)}")
+        if rows is None:
+            with self._condition:
+                rows = list(self._values.values())
+        return [
+            {field: row[field] for field in _SERVED_FIELDS}
+            for row in rows
+            if (metric_type is None or row['type'] == metric_type)
+            and (device_id is None or row['device_id'] == device_id)
+        ]
+
+    def load(self) -> int:
+        """
+        Restore the index from latest_values, keeping any newer entry already in memory.
+
+        Returns:
+            int: The number of rows read.
+        """
+        if self.engine is None:
+            return 0
+        latest = LatestValue.__table__
+        query = (
+            sa.select(
+                latest.c.device_id,
+                DeviceDetails.device_name,
+                latest.c.name,
+                latest.c.value,
+                MetricType.name.label('type'),
+                Unit.unit_name.label('unit'),
+                latest.c.timestamp_ms,
+                latest.c.utc_offset,
+                latest.c.type_id,
+                latest.c.unit_id,
+            )
+            .join(MetricType, MetricType.id == latest.c.type_id)
+            .join(Unit, Unit.id == latest.c.unit_id)
+            .outerjoin(DeviceDetails, DeviceDetails.device_id == latest.c.device_id)
+        )
+        with self.engine.connect() as conn:
+            rows = [dict(row) for row in conn.execute(query).mappings()]
+        with self._condition:
+            for row in rows:
+                key = (row['device_id'], row['name'])
+                current = self._values.get(key)
+                if current is None or row['timestamp_ms'] > current['timestamp_ms']:
+                    self._values[key] = row
+        if self.store is not None:
+            self._share(rows)
+        logger.info(f"Loaded {len(rows)} latest values")
+        return len(rows)
+
+    def _share(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """Fold rows into the shared index, keeping the newest row per key, one update per metric type."""
+        rows_by_type = {}
+        for row in rows:
+            rows_by_type.setdefault(row['type'], {})[f"{row['device_id']}\t{row['name']}"] = {
+                field: row[field] for field in _SERVED_FIELDS
+            }
+        for metric_type, type_rows in rows_by_type.items():
+            def fold(payload, type_rows=type_rows):
+                values = json.loads(payload) if payload is not None else {}
+                for key, row in type_rows.items():
+                    current = values.get(key)
+                    if current is None or row['timestamp_ms'] >= current['timestamp_ms']:
+                        values[key] = row
+                return json.dumps(values).encode()
+            self.store.update(self._shared_key(metric_type), fold)
+
+            if metric_type not in self._shared_types:
+                self.store.update(self._types_key(), lambda payload, metric_type=metric_type: json.dumps(
+                    sorted(set(json.loads(payload) if payload is not None else []) | {metric_type})
+                ).encode())
+                self._shared_types.add(metric_type)
+
+    def _read_shared(self, metric_type: Optional[str]) -> List[Dict[str, Any]]:
+        if metric_type is None:
+            payload = self.store.get(self._types_key())
+            metric_types = json.loads(payload) if payload is not None else []
+        else:
+            metric_types = [metric_type]
+        rows = []
+        for each_type in metric_types:
+            payload = self.store.get(self._shared_key(each_type))
+            if payload is not None:
+                rows.extend(json.loads(payload).values())
+        return rows
+
+    def _shared_key(self, metric_type: str) -> str:
+        return f"{self.key_prefix}latest_values:{metric_type}"
+
+    def _types_key(self) -> str:
+        return f"{self.key_prefix}latest_value_types"
+
+    def start(self) -> None:
+        """Start the background flusher; a no-op when the index is not persisted."""
+        if self.engine is None:
+            return
+        self._thread = Thread(target=self._run, name='LatestValueFlusher', daemon=True)
+        self._thread.start()
+        logger.info(f"Latest value flusher started (flush_interval={self.flush_interval_seconds}s)")
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop the flusher after it has written the remaining changes."""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def flush(self) -> int:
+        """
+        Upsert the entries changed since the last flush.
+
+        Returns:
+            int: The number of entries written.
+        """
+        with self._condition:
+            if not self._dirty:
+                return 0
+            dirty, self._dirty = self._dirty, set()
+            rows = [{field: self._values[key][field] for field in _PERSISTED_FIELDS} for key in sorted(dirty)]
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(self._upsert(self.engine.dialect.name), rows)
+        except SQLAlchemyError:
+            with self._condition:
+                self._dirty.update(dirty)  # Retried with the next flush
+            raise
+        return len(rows)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                if not self._closed:
+                    self._condition.wait(self.flush_interval_seconds)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing latest values: {str(e)}")
+                logger.debug(traceback.format_exc())
+                if not closed:
+                    time.sleep(self.flush_interval_seconds)
+            if closed:
+                return
+
+    @staticmethod
+    def _upsert(dialect_name: str):
+        table = LatestValue.__table__
+        if dialect_name == 'mysql':
+            insert = mysql.insert(table)
+            new = insert.inserted
+            newer = new.timestamp_ms >= table.c.timestamp_ms
+            # MySQL applies the assignments in order, so timestamp_ms is compared before it is replaced
+            return insert.on_duplicate_key_update(
+                [(column, sa.case((newer, new[column]), else_=table.c[column]))
+                 for column in ('type_id', 'unit_id', 'value', 'utc_offset')]
+                + [('timestamp_ms', sa.func.greatest(table.c.timestamp_ms, new.timestamp_ms))]
+            )
+        insert = (sqlite if dialect_name == 'sqlite' else postgresql).insert(table)
+        new = insert.excluded
+        # A concurrent writer may already have stored a newer value, so only ever move forward
+        return insert.on_conflict_do_update(
+            index_elements=['device_id', 'name'],
+            set_={column: new[column] for column in ('type_id', 'unit_id', 'value', 'timestamp_ms', 'utc_offset')},
+            where=new.timestamp_ms >= table.c.timestamp_ms
+        )
@@ -0,0 +1,75 @@
+"""
+Query plans of the dashboard read queries.
+
+Prints the plans of the latest-metrics and keyset page queries, and whether they are
+answered from idx_type_timestamp_ms_covering. Run it from the backend directory:
+    python -m services.query_plan --metric-type system
+"""
+import argparse
+from typing import Any, Dict, List
+import sqlalchemy as sa
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+COVERING_INDEX = 'idx_type_timestamp_ms_covering'
+
+_EXPLAIN_PREFIXES = {
+    'mysql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+}
+
+
+def explain(conn, statement) -> List[Dict[str, Any]]:
+    """
+    Run the dialect's EXPLAIN for a Core statement.
+
+    The statement is rendered with its parameters inlined, so the plan is the one the
+    database picks for these exact values.
+
+    Returns:
+        list: One dict per plan row, with the columns the dialect's EXPLAIN returns.
+    """
+    prefix = _EXPLAIN_PREFIXES.get(conn.dialect.name)
+    if prefix is None:
+        raise ValueError(f"EXPLAIN is not supported on {conn.dialect.name}")
+    sql = str(statement.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+    return [dict(row) for row in conn.exec_driver_sql(prefix + sql).mappings()]
+
+
+def uses_index(plan: List[Dict[str, Any]], index_name: str) -> bool:
+    """Whether any row of an EXPLAIN result names the index."""
+    return any(index_name in str(value) for row in plan for value in row.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--metric-type', default='system', help='Metric type to explain the queries for')
+    parser.add_argument('--database-url', default=None, help='Defaults to the database in config.json')
+    args = parser.parse_args()
+
+    from config.config import load_config
+    from .reporter import AFTER, BEFORE, MetricsReporter
+
+    config = load_config()
+    reporter = MetricsReporter(args.database_url or config.SQLALCHEMY_DATABASE_URI)
+    with reporter.engine.connect() as conn:
+        queries = {
+            'latest metrics': reporter.build_latest_metrics_query(conn, args.metric_type),
+            'first page': reporter._build_page_query(conn, args.metric_type, 11, None, BEFORE),
+            'older page': reporter._build_page_query(conn, args.metric_type, 11, (0, 0), BEFORE),
+            'newer page': reporter._build_page_query(conn, args.metric_type, 11, (0, 0), AFTER),
+        }
+        for label, query in queries.items():
+            if query is None:
+                print(f"Metric type {args.metric_type} does not exist")
+                return
+            plan = explain(conn, query)
+            print(f"{label}: {'uses' if uses_index(plan, COVERING_INDEX) else 'does NOT use'} {COVERING_INDEX}")
+            for row in plan:
+                print(f"    {row}")
+
+
+if __name__ == '__main__':
+    main()
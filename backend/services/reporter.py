@@ -1,18 +1,93 @@
+import base64
+import heapq
+import json
+from itertools import islice
 from datetime import datetime, timedelta, timezone
 from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
-from collector_agent.metrics_sdk.dto import MeasurementDTO
 from services.db_models import MetricMeasurement
-from services.db_models import Device
-from sqlalchemy.orm import sessionmaker, scoped_session, joinedload
+from services.db_models import DeviceDetails, MetricRollup, MetricType, Unit
+from sqlalchemy.orm import sessionmaker, scoped_session
 from utils.logger import get_logger
 import sqlalchemy as sa
 from utils.timer import Timer  # Import Timer utility
+from utils.timestamp import datetime_to_epoch_ms
 
 logger = get_logger(__name__)
 
+# Upper bound on raw rows returned by a history query over a short range
+MAX_RAW_HISTORY_ROWS = 10000
+
+# Rows in the window served by get_all_latest_metrics
+LATEST_METRICS_LIMIT = 120
+LATEST_METRICS_WINDOW = timedelta(days=3)
+
+# Keyset page directions: BEFORE pages towards older rows, AFTER towards newer rows
+BEFORE = 'before'
+AFTER = 'after'
+
+
+# Fields of a latest metrics row, as get_all_latest_metrics returns them
+LATEST_METRICS_FIELDS = ('device_id', 'device_name', 'name', 'value', 'type', 'unit', 'timestamp_ms', 'utc_offset')
+
+
+def merge_latest_metrics(data, rows, limit=LATEST_METRICS_LIMIT):
+    """
+    Merge newly stored rows into a get_all_latest_metrics result, as a window of at most limit rows.
+
+    The window stays ordered newest first and its oldest rows are evicted. Rows the window
+    already holds, e.g. because it was reloaded after they were committed, are not added again.
+
+    Args:
+        data (tuple): The (metrics, count) result to merge into.
+        rows (list): Stored rows with at least the LATEST_METRICS_FIELDS.
+        limit (int): The size of the window.
+
+    Returns:
+        tuple: The merged (metrics, count).
+    """
+    metrics = data[0]
+    new_rows = sorted(
+        ({field: row[field] for field in LATEST_METRICS_FIELDS} for row in rows),
+        key=lambda row: row['timestamp_ms'], reverse=True
+    )
+    if not new_rows:
+        return data
+    oldest_new = new_rows[-1]['timestamp_ms']
+    present = set()
+    for metric in metrics:
+        if metric['timestamp_ms'] < oldest_new:
+            break
+        present.add((metric['device_id'], metric['name'], metric['timestamp_ms']))
+    new_rows = [row for row in new_rows if (row['device_id'], row['name'], row['timestamp_ms']) not in present]
+
+    merged = list(islice(heapq.merge(metrics, new_rows, key=lambda row: -row['timestamp_ms']), limit))
+    return merged, len(merged)
+
+
+class InvalidCursorError(ValueError):
+    """Raised for a page cursor that was not produced by encode_cursor."""
+
+
+def encode_cursor(timestamp_ms, row_id):
+    """Opaque page cursor for the (timestamp_ms, id) keyset position of a row."""
+    return base64.urlsafe_b64encode(json.dumps([timestamp_ms, row_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp_ms, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return int(timestamp_ms), int(row_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(f"Invalid page cursor: {cursor}") from e
+
+
 class MetricsReporter:
-    def __init__(self, connection_string):
+    def __init__(self, connection_string, rollup_resolutions=None):
+        # Rollup resolutions in seconds, finest first; empty when rollups are disabled
+        self.rollup_resolutions = sorted(rollup_resolutions or [])
+        # Metric type name -> id; types are never deleted, so found ids stay valid
+        self._type_ids = {}
         try:
             logger.info("Initializing database connection...")
             self.engine = create_engine(connection_string, pool_recycle=280, pool_size=5, max_overflow=10)  # Add pool_recycle and pool_size
@@ -64,51 +139,267 @@ class MetricsReporter:
 
         Returns:
             tuple: A tuple containing the list of retrieved metrics and a count of the total number of metrics retrieved.
+            Each metric carries its timestamp as integer epoch milliseconds in timestamp_ms;
+            rendering it as ISO is left to the API layer.
 
         Raises:
             SQLAlchemyError: If an error occurs while fetching the metrics.
         """
-        with Timer("get_all_latest_metrics"), self as session:  # Add Timer context manager
+        with Timer("get_all_latest_metrics"), self.engine.connect() as conn:  # Add Timer context manager
             try:
-                three_days_ago = datetime.now(timezone.utc) - timedelta(days=3)
-
-                query = self._build_base_query(session, metric_type)
-                query = query.filter(MetricMeasurement.timestamp_utc >= three_days_ago)
-                query = query.limit(120) 
-                metrics = query.all()
-                
-                measurements = self._convert_to_domain_models(metrics)
+                query = self.build_latest_metrics_query(conn, metric_type)
+                measurements = [] if query is None else [dict(row) for row in conn.execute(query).mappings()]
                 total_count = len(measurements)
                 logger.info(f"Retrieved the latest {total_count} metrics")
                 return measurements, total_count
-            
+
             except SQLAlchemyError as e:
-                session.rollback()
                 logger.error(f"Error fetching metrics: {str(e)}")
                 raise
 
-    def _build_base_query(self, session, metric_type):
-        query = session.query(MetricMeasurement)
-        query = query.options(joinedload(MetricMeasurement.device).joinedload(Device.details))
-        query = query.order_by(MetricMeasurement.timestamp_utc.desc())
-        if metric_type:
-            query = query.filter(MetricMeasurement.type.has(name=metric_type))
+    def build_latest_metrics_query(self, conn, metric_type=None):
+        """
+        Build the select behind get_all_latest_metrics, or None when the metric type does not exist.
+
+        The type id is resolved up front, so the measurements are read with an equality on
+        type_id and a range on timestamp_ms that idx_type_timestamp_ms_covering answers
+        on its own, and only the few matching rows are joined to units and device details.
+        """
+        since_ms = datetime_to_epoch_ms(datetime.now(timezone.utc) - LATEST_METRICS_WINDOW)
+        query = self._measurement_select(conn, metric_type)
+        if query is None:
+            return None
+        timestamp_ms = MetricMeasurement.__table__.c.timestamp_ms
+        return (
+            query.where(timestamp_ms >= since_ms)
+            .order_by(timestamp_ms.desc(), MetricMeasurement.__table__.c.id.desc())
+            .limit(LATEST_METRICS_LIMIT)
+        )
+
+    def get_metrics_page(self, metric_type, page_size, cursor=None, direction=BEFORE):
+        """
+        Retrieve one page of metrics, newest first, with keyset pagination on (timestamp_ms, id).
+
+        Every page is a range scan of idx_type_timestamp_ms_covering from the cursor position,
+        so a page deep in the history costs the same as the first one.
+
+        Args:
+            metric_type (str): The type of metric to retrieve.
+            page_size (int): The number of metrics per page.
+            cursor (str, optional): Position to page from, as returned with an earlier page. None for the newest page.
+            direction (str): BEFORE for the rows older than the cursor, AFTER for the rows newer than it.
+
+        Returns:
+            tuple: The metrics of the page, newest first, the cursor of the next older page
+            and the cursor of the next newer page. A cursor is None when no such page exists.
+
+        Raises:
+            InvalidCursorError: If the cursor cannot be decoded.
+            SQLAlchemyError: If an error occurs while fetching the metrics.
+        """
+        position = decode_cursor(cursor) if cursor else None
+        with Timer("get_metrics_page"), self.engine.connect() as conn:
+            try:
+                query = self._build_page_query(conn, metric_type, page_size + 1, position, direction)
+                rows = [] if query is None else [dict(row) for row in conn.execute(query).mappings()]
+            except SQLAlchemyError as e:
+                logger.error(f"Error fetching metrics page: {str(e)}")
+                raise
+
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if direction == AFTER:
+            rows.reverse()  # Fetched oldest first to page towards newer rows
+        older_exists = has_more if direction == BEFORE else position is not None
+        newer_exists = has_more if direction == AFTER else position is not None
+
+        older_cursor = newer_cursor = None
+        if rows:
+            if older_exists:
+                older_cursor = encode_cursor(rows[-1]['timestamp_ms'], rows[-1]['id'])
+            if newer_exists:
+                newer_cursor = encode_cursor(rows[0]['timestamp_ms'], rows[0]['id'])
+        elif position is not None:
+            # Paged past the end; the cursor itself leads back the other way
+            older_cursor = cursor if direction == AFTER else None
+            newer_cursor = cursor if direction == BEFORE else None
+
+        for row in rows:
+            del row['id']
+        logger.info(f"Retrieved a page of {len(rows)} {metric_type} metrics")
+        return rows, older_cursor, newer_cursor
+
+    def _build_page_query(self, conn, metric_type, limit, position, direction):
+        query = self._measurement_select(conn, metric_type, with_id=True)
+        if query is None:
+            return None
+        query = query.limit(limit)
+        measurement = MetricMeasurement.__table__
+        timestamp, row_id = measurement.c.timestamp_ms, measurement.c.id
+        if direction == AFTER:
+            if position is not None:
+                # Expanded row comparison, which MySQL can turn into an index range
+                query = query.where(sa.or_(timestamp > position[0], sa.and_(timestamp == position[0], row_id > position[1])))
+            return query.order_by(timestamp.asc(), row_id.asc())
+        if position is not None:
+            query = query.where(sa.or_(timestamp < position[0], sa.and_(timestamp == position[0], row_id < position[1])))
+        return query.order_by(timestamp.desc(), row_id.desc())
+
+    def pick_resolution(self, start_ms, end_ms, max_points):
+        """
+        Choose the finest resolution that returns at most max_points buckets per series.
+
+        Returns 0 for raw measurements, which are used while the range spans no more than
+        max_points seconds, about one point per second at the fastest collection interval.
+        """
+        span_seconds = max(0, end_ms - start_ms) / 1000
+        if span_seconds <= max_points or not self.rollup_resolutions:
+            return 0
+        for resolution in self.rollup_resolutions:
+            if span_seconds / resolution <= max_points:
+                return resolution
+        return self.rollup_resolutions[-1]
+
+    def get_metric_history(self, metric_type, start_ms, end_ms, max_points=500, device_id=None, name=None):
+        """
+        Retrieve a time series of the given type over [start_ms, end_ms) at a resolution suited to its length.
+
+        Args:
+            metric_type (str): The type of metric to retrieve.
+            start_ms (int): Start of the range in epoch milliseconds, inclusive.
+            end_ms (int): End of the range in epoch milliseconds, exclusive.
+            max_points (int): Upper bound on points per device and metric name, used to pick the resolution.
+            device_id (str, optional): Only return this device.
+            name (str, optional): Only return this metric name.
+
+        Returns:
+            tuple: The resolution in seconds (0 for raw measurements) and the points ordered by time.
+            Each point has min, max, avg, count and last for its bucket, and timestamp_ms at the bucket start.
+
+        Raises:
+            SQLAlchemyError: If an error occurs while fetching the metrics.
+        """
+        resolution = self.pick_resolution(start_ms, end_ms, max_points)
+        with Timer("get_metric_history"), self.engine.connect() as conn:
+            try:
+                if resolution:
+                    query = self._build_rollup_query(metric_type, resolution, start_ms, end_ms, device_id, name)
+                else:
+                    query = self._build_raw_history_query(metric_type, start_ms, end_ms, device_id, name)
+                points = [dict(row) for row in conn.execute(query).mappings()]
+                logger.info(f"Retrieved {len(points)} {metric_type} history points at resolution {resolution}s")
+                return resolution, points
+            except SQLAlchemyError as e:
+                logger.error(f"Error fetching metric history: {str(e)}")
+                raise
+
+    def _build_rollup_query(self, metric_type, resolution, start_ms, end_ms, device_id, name):
+        rollup = MetricRollup.__table__
+        query = (
+            sa.select(
+                rollup.c.device_id,
+                DeviceDetails.device_name,
+                rollup.c.name,
+                MetricType.name.label('type'),
+                Unit.unit_name.label('unit'),
+                rollup.c.bucket_start_ms.label('timestamp_ms'),
+                rollup.c.min_value.label('min'),
+                rollup.c.max_value.label('max'),
+                (rollup.c.sum_value / rollup.c.count).label('avg'),
+                rollup.c.count,
+                rollup.c.last_value.label('last'),
+            )
+            .join(MetricType, MetricType.id == rollup.c.type_id)
+            .join(Unit, Unit.id == rollup.c.unit_id)
+            .outerjoin(DeviceDetails, DeviceDetails.device_id == rollup.c.device_id)
+            .where(
+                rollup.c.resolution_seconds == resolution,
+                MetricType.name == metric_type,
+                rollup.c.bucket_start_ms >= start_ms - start_ms % (resolution * 1000),
+                rollup.c.bucket_start_ms < end_ms,
+            )
+            .order_by(rollup.c.bucket_start_ms)
+        )
+        if device_id:
+            query = query.where(rollup.c.device_id == device_id)
+        if name:
+            query = query.where(rollup.c.name == name)
         return query
 
-    def _has_metrics(self, session, query):
-        return session.query(query.limit(1)).first() is not None
-    
-    def _convert_to_domain_models(self, metrics):
-        return [
-            MeasurementDTO(
-                device_id=metric.device.device_id,
-                device_name=metric.device.details.device_name,
-                name=metric.name,
-                value=metric.value,
-                type=metric.type.name,
-                unit=metric.unit.unit_name,
-                timestamp_utc=metric.timestamp_utc.isoformat(),
-                utc_offset=metric.utc_offset,
-            ).serialize()
-            for metric in metrics
-        ]
\ No newline at end of file
+    def _build_raw_history_query(self, metric_type, start_ms, end_ms, device_id, name):
+        # Raw measurements in the same shape as a rollup bucket holding one value
+        measurement = MetricMeasurement.__table__
+        query = (
+            sa.select(
+                measurement.c.device_id,
+                DeviceDetails.device_name,
+                measurement.c.name,
+                MetricType.name.label('type'),
+                Unit.unit_name.label('unit'),
+                measurement.c.timestamp_ms,
+                measurement.c.value.label('min'),
+                measurement.c.value.label('max'),
+                measurement.c.value.label('avg'),
+                sa.literal(1).label('count'),
+                measurement.c.value.label('last'),
+            )
+            .join(MetricType, MetricType.id == measurement.c.type_id)
+            .join(Unit, Unit.id == measurement.c.unit_id)
+            .outerjoin(DeviceDetails, DeviceDetails.device_id == measurement.c.device_id)
+            .where(
+                MetricType.name == metric_type,
+                measurement.c.timestamp_ms >= start_ms,
+                measurement.c.timestamp_ms < end_ms,
+            )
+            .order_by(measurement.c.timestamp_ms)
+            .limit(MAX_RAW_HISTORY_ROWS)
+        )
+        if device_id:
+            query = query.where(measurement.c.device_id == device_id)
+        if name:
+            query = query.where(measurement.c.name == name)
+        return query
+
+    def _resolve_type_id(self, conn, metric_type):
+        type_id = self._type_ids.get(metric_type)
+        if type_id is None:
+            type_id = conn.execute(sa.select(MetricType.id).where(MetricType.name == metric_type)).scalar()
+            if type_id is not None:
+                self._type_ids[metric_type] = type_id
+        return type_id
+
+    def _measurement_select(self, conn, metric_type, with_id=False):
+        """
+        Column-projected select of measurements in the row shape the API serves.
+
+        With a metric type its id is resolved first and the rows are filtered on type_id
+        directly; an unknown type returns None instead of a query. Without one every type
+        is read and its name joined in.
+        """
+        measurement = MetricMeasurement.__table__
+        columns = [
+            measurement.c.device_id,
+            DeviceDetails.device_name,
+            measurement.c.name,
+            measurement.c.value,
+            sa.literal(metric_type).label('type') if metric_type else MetricType.name.label('type'),
+            Unit.unit_name.label('unit'),
+            measurement.c.timestamp_ms,
+            measurement.c.utc_offset,
+        ]
+        if with_id:
+            columns.insert(0, measurement.c.id)
+
+        # Outer join so measurements of a device without details are still returned, as before
+        source = (
+            measurement
+            .join(Unit.__table__, Unit.id == measurement.c.unit_id)
+            .outerjoin(DeviceDetails.__table__, DeviceDetails.device_id == measurement.c.device_id)
+        )
+        if not metric_type:
+            return sa.select(*columns).select_from(source.join(MetricType.__table__, MetricType.id == measurement.c.type_id))
+
+        type_id = self._resolve_type_id(conn, metric_type)
+        if type_id is None:
+            return None
+        return sa.select(*columns).select_from(source).where(measurement.c.type_id == type_id)
\ No newline at end of file
@@ -0,0 +1,204 @@
+"""
+Downsampled rollups of metric_measurements.
+
+Rollups are maintained incrementally by DatabaseAggregator.store_metrics. Rows that
+were stored before rollups existed, or while they were disabled, are filled in with
+the catch-up job. Run it from the backend directory:
+    python -m services.rollups --hours 72
+"""
+import argparse
+import math
+from typing import Any, Dict, Iterable, List, Sequence
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
+from utils.logger import get_logger
+from utils.timestamp import get_utc_timestamp_ms
+from .db_models import MetricMeasurement, MetricRollup
+
+logger = get_logger(__name__)
+
+DEFAULT_RESOLUTIONS = (60, 300, 3600)
+_BUCKET_KEY = ('resolution_seconds', 'device_id', 'name', 'bucket_start_ms')
+_UPSERT_DIALECTS = ('mysql', 'sqlite', 'postgresql')
+
+
+class RollupMaintainer:
+    """Folds measurement rows into min/max/sum/count/last rollups at several resolutions.
+
+    A batch is first summarized in memory, so each bucket it touches costs one upsert
+    no matter how many rows fall into it. The upsert merges the summary into the stored
+    bucket with INSERT ... ON DUPLICATE KEY UPDATE on MySQL and INSERT ... ON CONFLICT
+    on SQLite and PostgreSQL, so concurrent writers never overwrite each other.
+    """
+
+    def __init__(self, resolutions: Sequence[int] = DEFAULT_RESOLUTIONS, chunk_size: int = 1000):
+        self.resolutions = tuple(sorted(set(int(resolution) for resolution in resolutions)))
+        self.chunk_size = max(1, chunk_size)
+
+    @staticmethod
+    def supports(dialect_name: str) -> bool:
+        return dialect_name in _UPSERT_DIALECTS
+
+    def summarize(self, rows: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Summarize measurement rows into one dict per (resolution, device, name, bucket).
+
+        Rows need device_id, name, value, type_id, unit_id and timestamp_ms. The result is
+        sorted by bucket key so concurrent upserts lock rows in the same order.
+        """
+        buckets = {}
+        for row in rows:
+            timestamp_ms = row['timestamp_ms']
+            value = row['value']
+            for resolution in self.resolutions:
+                width_ms = resolution * 1000
+                key = (resolution, row['device_id'], row['name'], timestamp_ms - timestamp_ms % width_ms)
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = {
+                        'resolution_seconds': resolution,
+                        'device_id': row['device_id'],
+                        'name': row['name'],
+                        'bucket_start_ms': key[3],
+                        'type_id': row['type_id'],
+                        'unit_id': row['unit_id'],
+                        'min_value': value,
+                        'max_value': value,
+                        'sum_value': value,
+                        'count': 1,
+                        'last_value': value,
+                        'last_timestamp_ms': timestamp_ms,
+                    }
+                    continue
+                if value < bucket['min_value']:
+                    bucket['min_value'] = value
+                if value > bucket['max_value']:
+                    bucket['max_value'] = value
+                bucket['sum_value'] += value
+                bucket['count'] += 1
+                if timestamp_ms >= bucket['last_timestamp_ms']:
+                    bucket['last_value'] = value
+                    bucket['last_timestamp_ms'] = timestamp_ms
+        return [buckets[key] for key in sorted(buckets)]
+
+    def apply(self, connection, rows: Iterable[Dict[str, Any]]) -> int:
+        """
+        Merge measurement rows into the rollups within the caller's transaction.
+
+        Args:
+            connection: A Session or Connection with an open transaction.
+            rows: Measurement rows as summarize() takes them.
+
+        Returns:
+            int: The number of buckets touched.
+        """
+        summaries = self.summarize(rows)
+        if summaries:
+            dialect = connection.get_bind().dialect if isinstance(connection, Session) else connection.dialect
+            upsert = self._upsert(dialect.name)
+            for start in range(0, len(summaries), self.chunk_size):
+                connection.execute(upsert, summaries[start:start + self.chunk_size])
+        return len(summaries)
+
+    def rebuild(self, engine, start_ms: int, end_ms: int, window_seconds: int = 86400) -> int:
+        """
+        Recompute the rollups of [start_ms, end_ms) from the raw measurements.
+
+        The range is widened to whole buckets of every resolution and processed one window
+        per transaction, deleting the window's rollups and re-aggregating its rows. Buckets
+        still receiving measurements while they are rebuilt can end up double counted, so
+        rebuild ranges that are no longer being ingested.
+
+        Returns:
+            int: The number of measurements re-aggregated.
+        """
+        alignment_ms = math.lcm(*self.resolutions) * 1000
+        window_ms = max(1, math.ceil(window_seconds * 1000 / alignment_ms)) * alignment_ms
+        start_ms -= start_ms % alignment_ms
+        end_ms += -end_ms % alignment_ms
+
+        table = MetricMeasurement.__table__
+        processed = 0
+        for window_start in range(start_ms, end_ms, window_ms):
+            window_end = min(window_start + window_ms, end_ms)
+            with engine.begin() as conn:
+                conn.execute(sa.delete(MetricRollup.__table__).where(
+                    MetricRollup.bucket_start_ms >= window_start,
+                    MetricRollup.bucket_start_ms < window_end
+                ))
+                last_id = 0
+                while True:
+                    # Keyset pagination on id, so later chunks do not re-read skipped rows like OFFSET would
+                    rows = conn.execute(
+                        sa.select(table.c.id, table.c.device_id, table.c.name, table.c.value,
+                                  table.c.type_id, table.c.unit_id, table.c.timestamp_ms)
+                        .where(table.c.timestamp_ms >= window_start, table.c.timestamp_ms < window_end,
+                               table.c.id > last_id)
+                        .order_by(table.c.id)
+                        .limit(self.chunk_size)
+                    ).mappings().all()
+                    if not rows:
+                        break
+                    self.apply(conn, rows)
+                    processed += len(rows)
+                    last_id = rows[-1]['id']
+        logger.info(f"Rebuilt rollups from {processed} measurements between {start_ms} and {end_ms}")
+        return processed
+
+    @staticmethod
+    def _upsert(dialect_name: str):
+        table = MetricRollup.__table__
+        if dialect_name == 'mysql':
+            insert = mysql.insert(table)
+            new = insert.inserted
+            # MySQL applies the assignments in order, so last_value is chosen while
+            # last_timestamp_ms still holds the stored value
+            return insert.on_duplicate_key_update([
+                ('min_value', sa.func.least(table.c.min_value, new.min_value)),
+                ('max_value', sa.func.greatest(table.c.max_value, new.max_value)),
+                ('sum_value', table.c.sum_value + new.sum_value),
+                ('count', table.c.count + new.count),
+                ('last_value', sa.case((new.last_timestamp_ms >= table.c.last_timestamp_ms, new.last_value),
+                                       else_=table.c.last_value)),
+                ('last_timestamp_ms', sa.func.greatest(table.c.last_timestamp_ms, new.last_timestamp_ms)),
+            ])
+        if dialect_name in ('sqlite', 'postgresql'):
+            insert = (sqlite if dialect_name == 'sqlite' else postgresql).insert(table)
+            new = insert.excluded
+            # SQLite's two-argument min() and max() are scalar functions
+            least, greatest = (sa.func.min, sa.func.max) if dialect_name == 'sqlite' else (sa.func.least, sa.func.greatest)
+            return insert.on_conflict_do_update(
+                index_elements=list(_BUCKET_KEY),
+                set_={
+                    'min_value': least(table.c.min_value, new.min_value),
+                    'max_value': greatest(table.c.max_value, new.max_value),
+                    'sum_value': table.c.sum_value + new.sum_value,
+                    'count': table.c.count + new.count,
+                    'last_value': sa.case((new.last_timestamp_ms >= table.c.last_timestamp_ms, new.last_value),
+                                          else_=table.c.last_value),
+                    'last_timestamp_ms': greatest(table.c.last_timestamp_ms, new.last_timestamp_ms),
+                }
+            )
+        raise ValueError(f"Rollup upserts are not supported on {dialect_name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hours', type=float, default=72, help='Rebuild rollups for this many hours before now')
+    parser.add_argument('--database-url', default=None, help='Defaults to the database in config.json')
+    args = parser.parse_args()
+
+    from config.config import load_config
+    from .schema import ensure_schema
+
+    config = load_config()
+    engine = sa.create_engine(args.database_url or config.SQLALCHEMY_DATABASE_URI, pool_recycle=280)
+    ensure_schema(engine)
+    end_ms = get_utc_timestamp_ms()
+    maintainer = RollupMaintainer(config.rollups.resolutions, chunk_size=config.ingest.insert_chunk_size)
+    maintainer.rebuild(engine, end_ms - int(args.hours * 3600 * 1000), end_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Bring the database schema up to the models.
+
+Every process calls ensure_schema() at startup, which is a no-op once the schema is
+current. To upgrade a large existing database ahead of a deploy, run the migration
+once from the backend directory instead:
+    python -m services.schema
+"""
+import argparse
+import hashlib
+from contextlib import contextmanager
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import MetaData
+from utils.logger import get_logger
+from .db_models import Base
+
+logger = get_logger(__name__)
+
+# Name of the database lock that serializes migrations between processes
+MIGRATION_LOCK_NAME = 'metrics_schema_migration'
+# How long a process waits for another one to finish migrating
+MIGRATION_LOCK_TIMEOUT_SECONDS = 600
+# Rows per backfill transaction, so a large table is never updated in one transaction
+BACKFILL_CHUNK_ROWS = 10000
+
+# Expressions that fill a newly added column from existing data, per dialect: (table, column) -> {dialect: SQL}
+_BACKFILLS = {
+    ('metric_measurements', 'timestamp_ms'): {
+        # TIMESTAMPDIFF does not depend on the session time zone, unlike UNIX_TIMESTAMP
+        'mysql': "TIMESTAMPDIFF(MICROSECOND, '1970-01-01 00:00:00', timestamp_utc) DIV 1000",
+        'sqlite': "CAST(ROUND((julianday(timestamp_utc) - 2440587.5) * 86400000) AS INTEGER)",
+        'postgresql': "CAST(EXTRACT(EPOCH FROM timestamp_utc) * 1000 AS BIGINT)",
+    },
+}
+
+
+def ensure_schema(engine: Engine, metadata: MetaData = Base.metadata) -> None:
+    """
+    Bring the database up to the models without dropping anything.
+
+    Missing tables are created, and existing tables get any missing columns and
+    indexes. Added columns are created nullable, and are backfilled from existing data
+    in chunks where a backfill is defined for them, so rows written before the upgrade
+    are not left out of queries on the new column.
+
+    Several workers start at once, so the changes are made under a database lock
+    (GET_LOCK on MySQL, an advisory lock on PostgreSQL) and the schema is inspected
+    again once it is held: the workers that waited find nothing left to do.
+    """
+    if not _pending_changes(engine, metadata):
+        return
+    with _migration_lock(engine):
+        for change in _pending_changes(engine, metadata):
+            try:
+                _apply(engine, metadata, *change)
+            except SQLAlchemyError:
+                # Without a lock (SQLite) another process may have made the same change first
+                if _change_key(change) in {_change_key(pending) for pending in _pending_changes(engine, metadata)}:
+                    raise
+                logger.info(f"Schema change on {change[1].name} was already made by another process")
+
+
+def _change_key(change) -> tuple:
+    kind, table, item = change
+    return kind, table.name, item.name if item is not None else None
+
+
+def _apply(engine: Engine, metadata: MetaData, kind: str, table, item) -> None:
+    if kind == 'table':
+        metadata.create_all(engine, tables=[table], checkfirst=True)
+        logger.info(f"Created table {table.name}")
+    elif kind == 'column':
+        _add_column(engine, table.name, item)
+    else:
+        item.create(engine, checkfirst=True)
+        logger.info(f"Created index {item.name} on {table.name}")
+
+
+def _pending_changes(engine: Engine, metadata: MetaData) -> list:
+    """The (kind, table, column or index) changes that ensure_schema still has to make."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    changes = []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            changes.append(('table', table, None))
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        changes.extend(('column', table, column) for column in table.columns if column.name not in existing_columns)
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        changes.extend(('index', table, index) for index in table.indexes if index.name not in existing_indexes)
+    return changes
+
+
+@contextmanager
+def _migration_lock(engine: Engine):
+    """
+    Hold a lock that serializes migrations across processes, on its own connection.
+    SQLite has no such lock; it is only used for development, with a single process.
+    """
+    dialect_name = engine.dialect.name
+    if dialect_name not in ('mysql', 'postgresql'):
+        yield
+        return
+    with engine.connect() as conn:
+        if dialect_name == 'mysql':
+            acquired = conn.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                                    {'name': MIGRATION_LOCK_NAME, 'timeout': MIGRATION_LOCK_TIMEOUT_SECONDS}).scalar()
+            if acquired != 1:
+                raise SQLAlchemyError(f"Timed out waiting for the {MIGRATION_LOCK_NAME} lock")
+        else:
+            conn.execute(text(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT_SECONDS}s'"))
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': _advisory_lock_key()})
+            conn.commit()
+        logger.info("Acquired the schema migration lock")
+        try:
+            yield
+        finally:
+            if dialect_name == 'mysql':
+                conn.execute(text("SELECT RELEASE_LOCK(:name)"), {'name': MIGRATION_LOCK_NAME})
+            else:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': _advisory_lock_key()})
+                conn.commit()
+
+
+def _advisory_lock_key() -> int:
+    # pg_advisory_lock takes a signed 64-bit key
+    return int.from_bytes(hashlib.sha1(MIGRATION_LOCK_NAME.encode()).digest()[:8], 'big', signed=True)
+
+
+def _add_column(engine: Engine, table_name: str, column) -> None:
+    column_type = column.type.compile(dialect=engine.dialect)
+    if not column.nullable:
+        logger.warning(f"Adding NOT NULL column {table_name}.{column.name} as nullable so existing rows stay valid")
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {preparer.quote(column.name)} {column_type}"
+        ))
+    logger.info(f"Added column {table_name}.{column.name}")
+    backfill(engine, table_name, column.name)
+
+
+def backfill(engine: Engine, table_name: str, column_name: str, chunk_rows: int = BACKFILL_CHUNK_ROWS) -> int:
+    """
+    Fill the NULLs of a column that has a backfill defined, one id range of chunk_rows per transaction.
+    Safe to run again, e.g. after an interrupted upgrade, as it only touches rows still NULL.
+
+    Returns:
+        int: The number of rows updated.
+    """
+    expression = _BACKFILLS.get((table_name, column_name), {}).get(engine.dialect.name)
+    if expression is None:
+        if (table_name, column_name) in _BACKFILLS:
+            logger.warning(f"No backfill for {table_name}.{column_name} on {engine.dialect.name}, existing rows stay NULL")
+        return 0
+
+    preparer = engine.dialect.identifier_preparer
+    table, column = preparer.quote(table_name), preparer.quote(column_name)
+    with engine.connect() as conn:
+        low, high = conn.execute(text(f"SELECT MIN(id), MAX(id) FROM {table} WHERE {column} IS NULL")).one()
+    if low is None:
+        return 0
+
+    statement = text(f"UPDATE {table} SET {column} = {expression} "
+                     f"WHERE id >= :start AND id < :end AND {column} IS NULL")
+    updated = 0
+    for start in range(low, high + 1, chunk_rows):
+        with engine.begin() as conn:
+            updated += conn.execute(statement, {'start': start, 'end': start + chunk_rows}).rowcount
+    logger.info(f"Backfilled {table_name}.{column_name} for {updated} existing rows")
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=None, help='Defaults to the database in config.json')
+    args = parser.parse_args()
+
+    from config.config import load_config
+
+    engine = create_engine(args.database_url or load_config().SQLALCHEMY_DATABASE_URI, pool_recycle=280)
+    ensure_schema(engine)
+    # Also completes a backfill that an earlier, interrupted upgrade left unfinished
+    with _migration_lock(engine):
+        for table_name, column_name in _BACKFILLS:
+            backfill(engine, table_name, column_name)
+    logger.info("Database schema is up to date")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+import json
+import os
+import secrets
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import deque
+from threading import Lock
+from typing import Any, Callable, Dict, Optional
+from utils.logger import get_logger
+
+try:
+    import redis  # Only needed for the redis backend
+    from redis.exceptions import WatchError
+except ImportError:
+    redis = None
+
+    class WatchError(Exception):
+        """Stand-in for redis' WatchError, for injected clients when the redis package is missing."""
+
+logger = get_logger(__name__)
+
+LOCAL = 'local'
+FILE = 'file'
+REDIS = 'redis'
+
+
+class LocalStore:
+    """In-process store: state is only shared by the threads of one worker."""
+    shared = False
+
+    def __init__(self):
+        self._values: Dict[str, Any] = {}  # key -> (value, expires_at monotonic or None)
+        self._lists: Dict[str, deque] = {}
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._live(key)
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None) -> None:
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + ttl_seconds if ttl_seconds else None)
+
+    def set_if_absent(self, key: str, value: bytes, ttl_seconds: float) -> bool:
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._values[key] = (value, time.monotonic() + ttl_seconds)
+            return True
+
+    def delete_if_equals(self, key: str, value: bytes) -> bool:
+        with self._lock:
+            if self._live(key) != value:
+                return False
+            del self._values[key]
+            return True
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]],
+               ttl_seconds: Optional[float] = None) -> bool:
+        """Atomically replace the value of key with func(value); func returns None to leave it as it is."""
+        with self._lock:
+            value = func(self._live(key))
+            if value is None:
+                return False
+            self._values[key] = (value, time.monotonic() + ttl_seconds if ttl_seconds else None)
+            return True
+
+    def increment(self, key: str) -> int:
+        """Atomically add one to the integer value of key, starting from 0, and return the result."""
+        with self._lock:
+            value = int(self._live(key) or 0) + 1
+            self._values[key] = (str(value).encode(), None)
+            return value
+
+    def push(self, key: str, value: bytes, max_length: int) -> None:
+        with self._lock:
+            self._lists.setdefault(key, deque(maxlen=max_length)).append(value)
+
+    def pop(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            items = self._lists.get(key)
+            return items.popleft() if items else None
+
+    def _live(self, key: str) -> Optional[bytes]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self._values[key]
+            return None
+        return value
+
+
+class FileStore:
+    """Store in a SQLite file, shared by every worker process on one host.
+
+    SQLite's own file locking makes each operation atomic across processes, and it works
+    the same on every platform, so it stands in for Redis on a single machine.
+    """
+    shared = True
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(tempfile.gettempdir(), 'metrics_shared_state.db')
+        def create_tables(conn):
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS lists (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "key TEXT NOT NULL, value BLOB NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_lists_key ON lists (key, id)")
+        self._transaction(create_tables)
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None so each BEGIN IMMEDIATE below is an explicit write transaction
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _transaction(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[bytes]:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                               (key, time.time())).fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl_seconds if ttl_seconds else None
+        self._transaction(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at)))
+
+    def set_if_absent(self, key: str, value: bytes, ttl_seconds: float) -> bool:
+        def claim(conn):
+            now = time.time()
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at <= ?", (key, now))
+            return conn.execute("INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                                (key, value, now + ttl_seconds)).rowcount == 1
+        return self._transaction(claim)
+
+    def delete_if_equals(self, key: str, value: bytes) -> bool:
+        return self._transaction(lambda conn: conn.execute(
+            "DELETE FROM kv WHERE key = ? AND value = ?", (key, value)).rowcount == 1)
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]],
+               ttl_seconds: Optional[float] = None) -> bool:
+        def replace(conn):
+            now = time.time()
+            row = conn.execute("SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                               (key, now)).fetchone()
+            value = func(row[0] if row else None)
+            if value is None:
+                return False
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, value, now + ttl_seconds if ttl_seconds else None))
+            return True
+        return self._transaction(replace)
+
+    def increment(self, key: str) -> int:
+        def add_one(conn):
+            row = conn.execute("SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                               (key, time.time())).fetchone()
+            value = int(row[0] if row else 0) + 1
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, NULL)",
+                         (key, str(value).encode()))
+            return value
+        return self._transaction(add_one)
+
+    def push(self, key: str, value: bytes, max_length: int) -> None:
+        def append(conn):
+            conn.execute("INSERT INTO lists (key, value) VALUES (?, ?)", (key, value))
+            conn.execute("DELETE FROM lists WHERE key = ? AND id NOT IN "
+                         "(SELECT id FROM lists WHERE key = ? ORDER BY id DESC LIMIT ?)", (key, key, max_length))
+        self._transaction(append)
+
+    def pop(self, key: str) -> Optional[bytes]:
+        def take(conn):
+            row = conn.execute("SELECT id, value FROM lists WHERE key = ? ORDER BY id LIMIT 1", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM lists WHERE id = ?", (row[0],))
+            return row[1]
+        return self._transaction(take)
+
+
+class RedisStore:
+    """Store in Redis, shared by every worker on every host.
+
+    Pass client to use an existing client, e.g. a fakeredis.FakeRedis() in-process
+    substitute, instead of connecting to url.
+    """
+    shared = True
+
+    def __init__(self, url: str = 'redis://localhost:6379/0', client=None):
+        if client is None:
+            if redis is None:
+                raise ValueError("The redis package is required for the redis shared state backend")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self._watch_error = _watch_error_class(client)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None) -> None:
+        self.client.set(key, value, px=int(ttl_seconds * 1000) if ttl_seconds else None)
+
+    def set_if_absent(self, key: str, value: bytes, ttl_seconds: float) -> bool:
+        return bool(self.client.set(key, value, nx=True, px=int(ttl_seconds * 1000)))
+
+    def delete_if_equals(self, key: str, value: bytes) -> bool:
+        # WATCH/MULTI rather than a Lua script, so in-process substitutes without scripting work too
+        with self.client.pipeline() as pipeline:
+            try:
+                pipeline.watch(key)
+                if pipeline.get(key) != value:
+                    pipeline.unwatch()
+                    return False
+                pipeline.multi()
+                pipeline.delete(key)
+                pipeline.execute()
+                return True
+            except self._watch_error:
+                return False  # Changed meanwhile, e.g. expired and claimed by another worker
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]],
+               ttl_seconds: Optional[float] = None, max_attempts: int = 10) -> bool:
+        # Optimistic read-modify-write, retried when another worker changes the key in between
+        with self.client.pipeline() as pipeline:
+            for _ in range(max_attempts):
+                try:
+                    pipeline.watch(key)
+                    value = func(pipeline.get(key))
+                    if value is None:
+                        pipeline.unwatch()
+                        return False
+                    pipeline.multi()
+                    pipeline.set(key, value, px=int(ttl_seconds * 1000) if ttl_seconds else None)
+                    pipeline.execute()
+                    return True
+                except self._watch_error:
+                    continue
+        logger.warning(f"Gave up updating {key} after {max_attempts} conflicting writes")
+        return False
+
+    def increment(self, key: str) -> int:
+        return int(self.client.incr(key))
+
+    def push(self, key: str, value: bytes, max_length: int) -> None:
+        pipeline = self.client.pipeline()
+        pipeline.rpush(key, value)
+        pipeline.ltrim(key, -max_length, -1)
+        pipeline.execute()
+
+    def pop(self, key: str) -> Optional[bytes]:
+        return self.client.lpop(key)
+
+
+def _digest(value: Any) -> str:
+    # Key order and tuples versus lists do not matter, as they do not survive a trip through the store
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def _watch_error_class(client) -> type:
+    """The WatchError of the client's own package, so a substitute client's conflicts are recognised too."""
+    package = sys.modules.get(type(client).__module__.partition('.')[0])
+    for namespace in (package, getattr(package, 'exceptions', None)):
+        error = getattr(namespace, 'WatchError', None)
+        if isinstance(error, type) and issubclass(error, Exception):
+            return error
+    return WatchError
+
+
+def create_store(backend: str = LOCAL, redis_url: Optional[str] = None, file_path: Optional[str] = None):
+    """Build the store for a shared_state backend name: 'local', 'file' or 'redis'."""
+    if backend == LOCAL:
+        return LocalStore()
+    if backend == FILE:
+        return FileStore(file_path)
+    if backend == REDIS:
+        return RedisStore(redis_url or 'redis://localhost:6379/0')
+    raise ValueError(f"Unknown shared state backend: {backend}")
+
+
+class SingleFlightLoader:
+    """Loader that shares one cached value between workers and refreshes it once for all of them.
+
+    The value is kept in the store as JSON with the time it was loaded. A value younger
+    than ttl_seconds is returned as it is. Otherwise the worker that claims the refresh
+    lock runs the loader and publishes the result, while the others return the stale
+    value, or poll for the new one for up to wait_seconds when there is none. If the
+    store is unreachable the loader is run directly, so the dashboard degrades to
+    per-worker refreshes instead of failing.
+
+    Workers merge into the shared value while a refresh runs. The value counts its
+    merges, and when the count changed during the load the result is combined with the
+    merged value through reconcile(loaded, current) before it is published. Without
+    reconcile the load replaces those merges, until the next one. on_change is called
+    after a load that published a value different from the one it replaced.
+
+    Meant as the loader of a per-worker CachedData with a short TTL, which keeps request
+    threads from touching the store at all.
+    """
+
+    def __init__(self, store, key: str, loader: Callable[[], Any], ttl_seconds: float,
+                 stale_seconds: float = 300.0, lock_ttl_seconds: float = 10.0, wait_seconds: float = 5.0,
+                 poll_seconds: float = 0.05, reconcile: Optional[Callable[[Any, Any], Any]] = None,
+                 on_change: Optional[Callable[[], None]] = None):
+        self.store = store
+        self.key = key
+        self.lock_key = f"{key}:refresh"
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.lock_ttl_seconds = lock_ttl_seconds
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self.reconcile = reconcile
+        self.on_change = on_change
+
+    def __call__(self) -> Any:
+        try:
+            cached = self._read()
+        except Exception as e:
+            logger.error(f"Shared state unavailable for {self.key}, loading directly: {str(e)}")
+            return self.loader()
+        if cached is not None and time.time() - cached['loaded_at'] < self.ttl_seconds:
+            return cached['data']
+
+        token = secrets.token_hex(8).encode()
+        if self.store.set_if_absent(self.lock_key, token, self.lock_ttl_seconds):
+            try:
+                return self._publish(self.loader(), cached['merges'] if cached is not None else 0)
+            finally:
+                self.store.delete_if_equals(self.lock_key, token)
+
+        # Another worker is refreshing
+        if cached is not None:
+            return cached['data']
+        deadline = time.monotonic() + self.wait_seconds
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_seconds)
+            cached = self._read()
+            if cached is not None:
+                return cached['data']
+        logger.warning(f"Timed out waiting for another worker to load {self.key}, loading directly")
+        return self.loader()
+
+    def merge(self, func: Callable[[Any], Any]) -> bool:
+        """
+        Replace the shared value with func(value) without changing when it was loaded,
+        so every worker picks the change up on its next read and the TTL reload still happens.
+        """
+        def apply(payload):
+            if payload is None:
+                return None  # Not loaded yet; the first load will include the change
+            cached = json.loads(payload)
+            cached['data'] = func(cached['data'])
+            cached['merges'] = cached.get('merges', 0) + 1
+            return json.dumps(cached).encode()
+        return self.store.update(self.key, apply, ttl_seconds=self.ttl_seconds + self.stale_seconds)
+
+    def _publish(self, data: Any, merges_at_start: int) -> Any:
+        """Store a loaded value, reconciled with the merges made since the load started, and return it."""
+        published = [data, True]  # Value, and whether it differs from the one it replaces
+
+        def apply(payload):
+            current = json.loads(payload) if payload is not None else None
+            merges = current.get('merges', 0) if current is not None else 0
+            value = data
+            if merges != merges_at_start and self.reconcile is not None:
+                value = self.reconcile(data, current['data'])
+            published[:] = [value, current is None or _digest(value) != _digest(current['data'])]
+            return json.dumps({'loaded_at': time.time(), 'merges': merges, 'data': value}).encode()
+
+        if not self.store.update(self.key, apply, ttl_seconds=self.ttl_seconds + self.stale_seconds):
+            return data
+        value, changed = published
+        if changed and self.on_change is not None:
+            try:
+                self.on_change()
+            except Exception as e:
+                logger.error(f"on_change callback of {self.key} failed: {str(e)}")
+        return value
+
+    def _read(self) -> Optional[Dict[str, Any]]:
+        payload = self.store.get(self.key)
+        if payload is None:
+            return None
+        cached = json.loads(payload)
+        cached.setdefault('merges', 0)  # Values published before merges were counted
+        return cached
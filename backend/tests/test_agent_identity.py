@@ -0,0 +1,33 @@
+"""
+Tests of the agent id and batch sequence numbers sent with idempotent uploads.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import json
+
+from collector_agent.agent_identity import AgentIdentity
+
+
+def test_instances_without_state_have_distinct_ids():
+    first, second = AgentIdentity(), AgentIdentity()
+    assert first.agent_id != second.agent_id
+    assert [first.next_seq() for _ in range(3)] == [0, 1, 2]
+
+
+def test_id_and_sequence_survive_a_restart(tmp_path):
+    identity = AgentIdentity(str(tmp_path), block_size=4)
+    used = [identity.next_seq() for _ in range(6)]
+    assert used == list(range(6))
+
+    restarted = AgentIdentity(str(tmp_path), block_size=4)
+    assert restarted.agent_id == identity.agent_id
+    # Never reuses a number handed out before the restart
+    assert restarted.next_seq() > max(used)
+
+
+def test_unreadable_state_starts_a_new_agent(tmp_path):
+    (tmp_path / 'agent.json').write_text('{not json')
+    identity = AgentIdentity(str(tmp_path))
+    assert identity.next_seq() == 0
+    assert json.loads((tmp_path / 'agent.json').read_text())['agent_id'] == identity.agent_id
@@ -0,0 +1,149 @@
+"""
+Tests of CryptoCollector's concurrent ticker polling against a local mock exchange.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from collector_agent.collectors import crypto_collector
+from collector_agent.collectors.crypto_collector import CryptoCollector
+from utils.timestamp import iso_to_epoch_ms
+
+PAIRS = ['BTC-USD', 'ETH-USD']
+
+
+class MockExchange(ThreadingHTTPServer):
+    """Serves /<pair>/ticker like the Coinbase ticker endpoint, with an ETag per price."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _TickerHandler)
+        self.prices = {'BTC-USD': 50000.0, 'ETH-USD': 3000.0}
+        self.failing = False
+        self.requests = []  # (pair, If-None-Match)
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class _TickerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        pair = self.path.strip('/').split('/')[0]
+        with server.lock:
+            server.requests.append((pair, self.headers.get('If-None-Match')))
+            failing, price = server.failing, server.prices.get(pair)
+        if failing or price is None:
+            self.send_response(503)
+            self.end_headers()
+            return
+        etag = f'"{pair}-{price}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = json.dumps({'price': str(price), 'bid': str(price - 1), 'ask': str(price + 1)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def exchange():
+    server = MockExchange()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def collector(exchange, monkeypatch):
+    settings = crypto_collector.config.crypto_collector
+    monkeypatch.setattr(settings, 'base_url', exchange.base_url)
+    monkeypatch.setattr(settings, 'currency_pairs', PAIRS)
+    monkeypatch.setattr(settings, 'mode', 'poll')
+    monkeypatch.setattr(settings, 'request_timeout', 2)
+    monkeypatch.setattr(settings, 'cache_ttl_seconds', 0)
+    monkeypatch.setattr(settings, 'stale_max_age_seconds', 60)
+    collector = CryptoCollector()
+    yield collector
+    collector.executor.shutdown(wait=True)
+    collector.session.close()
+
+
+def _by_pair(metrics):
+    return {metric['currency_pair']: metric for metric in metrics}
+
+
+def test_fetches_every_pair(collector, exchange):
+    metrics = _by_pair(collector.collect_metrics())
+    assert set(metrics) == set(PAIRS)
+    assert metrics['BTC-USD']['price'] == 50000.0
+    assert metrics['BTC-USD']['bid'] == 49999.0
+    assert metrics['ETH-USD']['ask'] == 3001.0
+    # A fresh value carries no timestamp of its own and is stamped with the collection cycle
+    assert 'timestamp_utc' not in metrics['BTC-USD']
+
+
+def test_cached_value_is_not_fetched_again_within_ttl(collector, exchange):
+    collector.cache_ttl_seconds = 60
+    collector.collect_metrics()
+    collector.collect_metrics()
+    assert len(exchange.requests) == len(PAIRS)
+
+
+def test_expired_value_is_revalidated_with_its_etag(collector, exchange):
+    first = _by_pair(collector.collect_metrics())
+    second = _by_pair(collector.collect_metrics())
+    assert second == first
+    revalidations = exchange.requests[len(PAIRS):]
+    assert sorted(etag for _, etag in revalidations) == sorted(f'"{pair}-{exchange.prices[pair]}"' for pair in PAIRS)
+
+
+def test_stale_value_keeps_the_timestamp_of_its_fetch(collector, exchange):
+    collector.collect_metrics()
+    fetched_at_ms = iso_to_epoch_ms(collector._cache['BTC-USD'].fetched_at_utc)
+
+    exchange.failing = True
+    metrics = _by_pair(collector.collect_metrics())
+    assert metrics['BTC-USD']['price'] == 50000.0
+    assert iso_to_epoch_ms(metrics['BTC-USD']['timestamp_utc']) == fetched_at_ms
+    # The cached entry itself is left without a timestamp
+    assert 'timestamp_utc' not in collector._cache['BTC-USD'].metric
+
+
+def test_stale_value_is_dropped_after_stale_max_age(collector, exchange):
+    collector.collect_metrics()
+    exchange.failing = True
+    collector.stale_max_age_seconds = 0
+    assert collector.collect_metrics() == []
+
+
+def test_stale_value_is_reported_once_per_fetch(collector, exchange):
+    collector.collect_metrics()
+    exchange.failing = True
+    assert len(collector.collect_metrics()) == len(PAIRS)
+    # The outage goes on: the same rows are not sent again
+    assert collector.collect_metrics() == []
+
+    exchange.failing = False
+    exchange.prices['BTC-USD'] = 51000.0
+    assert _by_pair(collector.collect_metrics())['BTC-USD']['price'] == 51000.0
+    exchange.failing = True
+    assert sorted(metric['currency_pair'] for metric in collector.collect_metrics()) == PAIRS
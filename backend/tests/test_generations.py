@@ -0,0 +1,27 @@
+"""
+Tests of the GenerationCounter behind the ETags of the latest metrics endpoint.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+from services.generations import GenerationCounter
+
+
+def test_reload_with_the_same_window_keeps_the_etag():
+    generations = GenerationCounter()
+    window = ([{'device_id': 'd1', 'name': 'cpu', 'timestamp_ms': 1000}], 1)
+    assert generations.bump_if_changed('system', window)
+    etag = generations.etag('system')
+
+    # A reload returns an equal window, e.g. as a list instead of a tuple after a trip through the shared store
+    assert not generations.bump_if_changed('system', [list(window[0]), 1])
+    assert generations.etag('system') == etag
+
+    assert generations.bump_if_changed('system', ([{'device_id': 'd1', 'name': 'cpu', 'timestamp_ms': 2000}], 1))
+    assert generations.etag('system') != etag
+
+
+def test_types_are_tracked_separately():
+    generations = GenerationCounter()
+    generations.bump_rows([{'type': 'system'}, {'type': 'system'}, {'type': 'crypto'}])
+    assert (generations.get('system'), generations.get('crypto'), generations.get('other')) == (1, 1, 0)
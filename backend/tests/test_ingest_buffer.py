@@ -0,0 +1,128 @@
+"""
+Tests of the write-behind IngestBuffer.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import threading
+import time
+
+from services.ingest_buffer import IngestBuffer
+
+
+class RecordingStore:
+    """store_func stand-in that records each flushed batch."""
+
+    def __init__(self):
+        self.batches = []
+        self.flushed = threading.Event()
+
+    def __call__(self, rows):
+        self.batches.append(list(rows))
+        self.flushed.set()
+
+
+def test_small_offer_is_flushed_within_flush_interval():
+    store = RecordingStore()
+    buffer = IngestBuffer(store, flush_rows=2000, flush_interval_seconds=0.2)
+    buffer.start()
+    try:
+        started = time.monotonic()
+        assert buffer.offer([{'value': i} for i in range(10)])
+        assert store.flushed.wait(2.0), "rows below flush_rows were never flushed"
+        assert time.monotonic() - started < 1.0
+        assert store.batches == [[{'value': i} for i in range(10)]]
+        assert len(buffer) == 0
+    finally:
+        buffer.close(timeout=5)
+
+
+def test_flush_rows_triggers_flush_before_interval():
+    store = RecordingStore()
+    buffer = IngestBuffer(store, flush_rows=5, flush_interval_seconds=60)
+    buffer.start()
+    try:
+        assert buffer.offer([{'value': i} for i in range(5)])
+        assert store.flushed.wait(2.0)
+        assert len(store.batches[0]) == 5
+    finally:
+        buffer.close(timeout=5)
+
+
+def test_close_drains_buffered_rows():
+    store = RecordingStore()
+    buffer = IngestBuffer(store, flush_rows=2000, flush_interval_seconds=60)
+    buffer.start()
+    assert buffer.offer([{'value': 1}, {'value': 2}])
+    buffer.close(timeout=5)
+    assert store.batches == [[{'value': 1}, {'value': 2}]]
+    assert not buffer.offer([{'value': 3}])
+
+
+def test_on_stored_reports_each_offer_after_its_flush():
+    store = RecordingStore()
+    buffer = IngestBuffer(store, flush_rows=3, flush_interval_seconds=60)
+    results = []
+    buffer.start()
+    try:
+        assert buffer.offer([{'value': 1}, {'value': 2}], on_stored=lambda ok: results.append(('a', ok)))
+        assert results == []  # Accepted, not stored yet
+        assert buffer.offer([{'value': 3}, {'value': 4}], on_stored=lambda ok: results.append(('b', ok)))
+        assert store.flushed.wait(2.0)
+    finally:
+        buffer.close(timeout=5)
+    # Both offers went into one batch, never split across two
+    assert store.batches == [[{'value': 1}, {'value': 2}, {'value': 3}, {'value': 4}]]
+    assert results == [('a', True), ('b', True)]
+
+
+def test_on_stored_reports_dropped_offers():
+    def failing_store(rows):
+        raise RuntimeError("database down")
+
+    results = []
+    buffer = IngestBuffer(failing_store, flush_rows=1, flush_interval_seconds=60,
+                          max_flush_attempts=2, retry_backoff_seconds=0)
+    buffer.start()
+    assert buffer.offer([{'value': 1}], on_stored=results.append)
+    buffer.close(timeout=5)
+    assert results == [False]
+
+
+def test_failed_batch_is_split_so_only_the_failing_offer_is_dropped():
+    stored = []
+
+    def store(rows):
+        if any(row.get('bad') for row in rows):
+            raise KeyError('name')
+        stored.extend(rows)
+
+    results = {}
+    buffer = IngestBuffer(store, flush_rows=2000, flush_interval_seconds=60,
+                          max_flush_attempts=2, retry_backoff_seconds=0)
+    buffer.start()
+    for name, rows in (('a', [{'value': 1}]), ('b', [{'value': 2, 'bad': True}]),
+                       ('c', [{'value': 3}, {'value': 4}]), ('d', [{'value': 5}])):
+        assert buffer.offer(rows, on_stored=lambda ok, name=name: results.__setitem__(name, ok))
+    buffer.close(timeout=5)
+    assert sorted(row['value'] for row in stored) == [1, 3, 4, 5]
+    assert results == {'a': True, 'b': False, 'c': True, 'd': True}
+
+
+def test_leftover_offers_keep_their_enqueue_time():
+    store = RecordingStore()
+    buffer = IngestBuffer(store, flush_rows=2, flush_interval_seconds=0.5)
+    assert buffer.offer([{'value': 1}, {'value': 2}])
+    assert buffer.offer([{'value': 3}])
+    time.sleep(0.4)
+    buffer.start()
+    try:
+        # The first batch is flushed at once; the leftover offer is then 0.4s into its interval, not at 0
+        assert store.flushed.wait(2.0)
+        store.flushed.clear()
+        started = time.monotonic()
+        assert store.flushed.wait(2.0)
+        assert time.monotonic() - started < 0.35
+        assert store.batches == [[{'value': 1}, {'value': 2}], [{'value': 3}]]
+    finally:
+        buffer.close(timeout=5)
@@ -0,0 +1,111 @@
+"""
+Tests of the latest metrics read cache when ingest merges land while it is being reloaded.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import threading
+
+from services.reporter import merge_latest_metrics
+from services.shared_state import LocalStore, SingleFlightLoader
+from utils.cache import CachedData
+
+
+def _row(device_id, timestamp_ms, value=1.0):
+    return {'device_id': device_id, 'device_name': f'device-{device_id}', 'name': 'cpu', 'value': value,
+            'type': 'system', 'unit': '%', 'timestamp_ms': timestamp_ms, 'utc_offset': 0}
+
+
+def _window(*rows):
+    rows = sorted(rows, key=lambda row: row['timestamp_ms'], reverse=True)
+    return rows, len(rows)
+
+
+class BlockingLoader:
+    """Returns the snapshot it was given, but only once released, like a slow database read."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        assert self.release.wait(5)
+        return self.snapshot
+
+
+def _timestamps(data):
+    return [row['timestamp_ms'] for row in data[0]]
+
+
+def _refresh_and_wait(cache):
+    with cache.lock:
+        cache._start_refresh()
+    cache.loader.started.wait(5)
+
+
+def _wait_until_installed(cache):
+    with cache.lock:
+        assert cache.refreshed.wait_for(lambda: not cache._refreshing, timeout=5)
+
+
+def test_merge_during_a_refresh_survives_the_install():
+    cache = CachedData(cache_duration_seconds=60, loader=BlockingLoader(_window(_row(1, 1000))))
+    with cache.lock:
+        cache.update(_window(_row(1, 1000)))
+
+    # The reload reads the database (T0), then a batch is stored and merged (T1) before it installs
+    _refresh_and_wait(cache)
+    assert cache.merge(lambda data: merge_latest_metrics(data, [_row(2, 2000)]))
+    assert _timestamps(cache.data) == [2000, 1000]
+    cache.loader.release.set()
+    _wait_until_installed(cache)
+
+    assert _timestamps(cache.data) == [2000, 1000]
+
+
+def test_merge_into_a_cold_cache_during_its_first_load_is_kept():
+    cache = CachedData(cache_duration_seconds=60, loader=BlockingLoader(_window(_row(1, 1000))))
+    _refresh_and_wait(cache)
+    assert cache.merge(lambda data: merge_latest_metrics(data, [_row(2, 2000)]))
+    assert cache.data is None
+    cache.loader.release.set()
+    _wait_until_installed(cache)
+
+    assert _timestamps(cache.data) == [2000, 1000]
+
+
+def test_merged_rows_the_reload_already_read_are_not_duplicated():
+    # The batch was committed before the reload read the database, but merged after the read started
+    cache = CachedData(cache_duration_seconds=60, loader=BlockingLoader(_window(_row(1, 1000), _row(2, 2000))))
+    _refresh_and_wait(cache)
+    cache.merge(lambda data: merge_latest_metrics(data, [_row(2, 2000)]))
+    cache.loader.release.set()
+    _wait_until_installed(cache)
+
+    assert _timestamps(cache.data) == [2000, 1000]
+
+
+def test_shared_load_is_reconciled_with_merges_from_other_workers():
+    store = LocalStore()
+    database = BlockingLoader(_window(_row(1, 1000)))
+    shared = SingleFlightLoader(store, 'latest:system', database, ttl_seconds=0,
+                                reconcile=lambda loaded, current: merge_latest_metrics(loaded, current[0]))
+    database.release.set()
+    shared()  # First load, published to the store
+    database.started.clear()
+    database.release.clear()
+
+    result = []
+    refresher = threading.Thread(target=lambda: result.append(shared()))
+    refresher.start()
+    assert database.started.wait(5)
+    # Another worker stores a batch and merges it into the shared window during the load
+    other_worker = SingleFlightLoader(store, 'latest:system', database, ttl_seconds=0)
+    assert other_worker.merge(lambda data: merge_latest_metrics(data, [_row(2, 2000)]))
+    database.release.set()
+    refresher.join(5)
+
+    assert _timestamps(result[0]) == [2000, 1000]
+    assert _timestamps(shared._read()['data']) == [2000, 1000]
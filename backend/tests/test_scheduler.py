@@ -0,0 +1,42 @@
+"""
+Tests of the CollectorScheduler's timer heap.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import heapq
+import time
+
+import pytest
+
+from collector_agent.collectors.base_collector import BaseCollector
+from collector_agent.collectors.collector_registry import CollectorRegistry, CollectorSchedule
+from collector_agent.scheduler import CollectorScheduler
+
+
+class IdleCollector(BaseCollector):
+    def __init__(self):
+        super().__init__()
+
+    def collect_metrics(self):
+        return []
+
+    def get_latest_metrics(self):
+        return self.latest_metrics
+
+
+def test_jitter_does_not_accumulate():
+    registry = CollectorRegistry()
+    registry.register('crypto', IdleCollector(), schedule=CollectorSchedule(interval=10, jitter=0.5))
+    scheduler = CollectorScheduler(registry, on_metrics=lambda metrics: None, default_interval=10)
+
+    start = time.monotonic() + 3600  # Far enough ahead that no run counts as missed
+    due = start
+    for run in range(1000):
+        scheduler._schedule('crypto', due)
+        dispatch_at, due, _ = heapq.heappop(scheduler._heap)
+        assert due == pytest.approx(start + run * 10)
+        assert due <= dispatch_at <= due + 0.5
+        due = scheduler._next_due('crypto', due)
+    # 1000 runs later the schedule is still exactly on its interval, not about 250s behind
+    assert due == pytest.approx(start + 1000 * 10)
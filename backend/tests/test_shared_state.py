@@ -0,0 +1,121 @@
+"""
+Tests of the shared state stores and the SingleFlightLoader, against a SQLite file and an in-process Redis.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import sys
+import threading
+import time
+import types
+
+import fakeredis
+import pytest
+
+from services.shared_state import FileStore, LocalStore, RedisStore, SingleFlightLoader, _watch_error_class
+
+
+@pytest.fixture(params=['local', 'file', 'redis'])
+def store(request, tmp_path):
+    if request.param == 'local':
+        return LocalStore()
+    if request.param == 'file':
+        return FileStore(str(tmp_path / 'shared_state.db'))
+    return RedisStore(client=fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+
+
+def test_set_if_absent_claims_a_key_once_until_it_expires(store):
+    assert store.set_if_absent('lock', b'a', ttl_seconds=0.2)
+    assert not store.set_if_absent('lock', b'b', ttl_seconds=0.2)
+    assert store.get('lock') == b'a'
+    time.sleep(0.3)
+    assert store.get('lock') is None
+    assert store.set_if_absent('lock', b'b', ttl_seconds=0.2)
+
+
+def test_delete_if_equals_only_deletes_the_owners_value(store):
+    store.set('lock', b'owner')
+    assert not store.delete_if_equals('lock', b'other')
+    assert store.get('lock') == b'owner'
+    assert store.delete_if_equals('lock', b'owner')
+    assert store.get('lock') is None
+    assert not store.delete_if_equals('lock', b'owner')
+
+
+def test_update_is_atomic_across_concurrent_writers(store):
+    def increment(value):
+        return str(int(value or b'0') + 1).encode()
+
+    def worker():
+        for _ in range(20):
+            assert store.update('counter', increment)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert store.get('counter') == b'80'
+
+
+def test_update_returning_none_leaves_the_value(store):
+    assert not store.update('missing', lambda value: None)
+    assert store.get('missing') is None
+    store.set('key', b'kept')
+    assert not store.update('key', lambda value: None)
+    assert store.get('key') == b'kept'
+
+
+def test_push_keeps_the_newest_max_length_values_in_order(store):
+    for value in (b'1', b'2', b'3'):
+        store.push('queue', value, max_length=2)
+    assert [store.pop('queue'), store.pop('queue'), store.pop('queue')] == [b'2', b'3', None]
+
+
+def test_single_flight_across_two_loaders(store):
+    calls = []
+    release = threading.Event()
+
+    def load():
+        calls.append(1)
+        assert release.wait(5)
+        return {'rows': [1, 2, 3]}
+
+    # Two workers, each with its own loader over the same store and key
+    loaders = [SingleFlightLoader(store, 'latest:system', load, ttl_seconds=60, wait_seconds=5, poll_seconds=0.01)
+               for _ in range(2)]
+    results = []
+    threads = [threading.Thread(target=lambda loader=loader: results.append(loader())) for loader in loaders]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(calls) == 1
+    assert results == [{'rows': [1, 2, 3]}] * 2
+    assert store.get('latest:system:refresh') is None  # The refresh lock was released
+
+
+def test_watch_error_of_a_substitute_client_is_recognised():
+    substitute = types.ModuleType('substitute_redis')
+
+    class WatchError(Exception):
+        pass
+
+    class Client:
+        pass
+
+    substitute.WatchError = WatchError
+    Client.__module__ = 'substitute_redis'
+    sys.modules['substitute_redis'] = substitute
+    try:
+        assert _watch_error_class(Client()) is WatchError
+    finally:
+        del sys.modules['substitute_redis']
+
+
+def test_increment_counts_from_zero(store):
+    assert [store.increment('seq') for _ in range(3)] == [1, 2, 3]
+    assert store.get('seq') == b'3'
@@ -0,0 +1,92 @@
+"""
+Tests of the per-worker state that is kept in the shared store, with two instances standing in
+for two workers over one in-process Redis.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import fakeredis
+import pytest
+
+from services import batch_dedup
+from services.batch_dedup import BatchDeduplicator
+from services.event_broker import EventBroker
+from services.generations import GenerationCounter
+from services.latest_values import LatestValueIndex
+from services.shared_state import RedisStore, SingleFlightLoader
+
+
+@pytest.fixture
+def store():
+    return RedisStore(client=fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+
+
+def _row(device_id, name, timestamp_ms, value=1.0, metric_type='system'):
+    return {'device_id': device_id, 'device_name': f'device-{device_id}', 'name': name, 'value': value,
+            'type': metric_type, 'unit': '%', 'timestamp_ms': timestamp_ms, 'utc_offset': 0}
+
+
+def test_workers_issue_the_same_etags(store):
+    first, second = GenerationCounter(store, 'm:'), GenerationCounter(store, 'm:')
+    assert first.etag('system') == second.etag('system')
+    first.bump_rows([{'type': 'system'}])
+    assert second.get('system') == 1
+    assert first.etag('system') == second.etag('system')
+
+
+def test_replay_on_another_worker_is_recognised(store):
+    first, second = BatchDeduplicator(store=store, key_prefix='m:'), BatchDeduplicator(store=store, key_prefix='m:')
+    assert first.reserve('agent', 7) == batch_dedup.NEW
+    assert second.reserve('agent', 7) == batch_dedup.IN_FLIGHT
+    first.commit('agent', 7)
+    assert second.reserve('agent', 7) == batch_dedup.DUPLICATE
+
+    assert second.reserve('agent', 8) == batch_dedup.NEW
+    second.release('agent', 8)
+    assert first.reserve('agent', 8) == batch_dedup.NEW
+
+
+def test_reservation_of_a_dead_worker_expires(store):
+    dead = BatchDeduplicator(store=store, key_prefix='m:', in_flight_timeout_seconds=0)
+    assert dead.reserve('agent', 1) == batch_dedup.NEW
+    # Never committed nor released
+    assert BatchDeduplicator(store=store, key_prefix='m:', in_flight_timeout_seconds=0).reserve('agent', 1) == batch_dedup.NEW
+
+
+def test_latest_values_are_served_by_every_worker(store):
+    first, second = LatestValueIndex(store=store, key_prefix='m:'), LatestValueIndex(store=store, key_prefix='m:')
+    first.update([_row('d1', 'cpu', 2000, value=2.0), _row('d1', 'btc', 1000, metric_type='crypto')])
+    second.update([_row('d1', 'cpu', 1000, value=1.0), _row('d2', 'cpu', 1500)])
+
+    assert {(row['device_id'], row['value']) for row in first.get('system')} == {('d1', 2.0), ('d2', 1.0)}
+    assert sorted(row['name'] for row in second.get()) == ['btc', 'cpu', 'cpu']
+    assert [row['device_id'] for row in second.get('system', device_id='d2')] == ['d2']
+
+
+def test_stream_subscribers_get_batches_stored_by_other_workers(store):
+    publisher = EventBroker(store=store, key_prefix='m:', poll_seconds=0.01)
+    subscriber = EventBroker(store=store, key_prefix='m:', poll_seconds=0.01)
+    subscriber.start()
+    try:
+        publisher.publish([_row('d1', 'cpu', 1000)])  # Before anyone subscribed: not delivered
+        subscription = subscriber.subscribe(metric_type='system')
+        publisher.publish([_row('d1', 'cpu', 2000), _row('d1', 'btc', 2000, metric_type='crypto')])
+        publisher.publish([_row('d2', 'cpu', 3000)])
+
+        assert [row['timestamp_ms'] for row in subscription.get(timeout=2)] == [2000]
+        assert [row['device_id'] for row in subscription.get(timeout=2)] == ['d2']
+        assert subscription.get(timeout=0.1) is None
+    finally:
+        subscriber.close()
+
+
+def test_reload_that_changes_the_shared_window_reports_it(store):
+    windows = iter([{'rows': [1]}, {'rows': [1]}, {'rows': [1, 2]}])
+    changes = []
+    loader = SingleFlightLoader(store, 'latest:system', lambda: next(windows), ttl_seconds=0,
+                                on_change=lambda: changes.append(1))
+    loader()
+    loader()
+    assert len(changes) == 1  # The first load, not the identical reload
+    loader()
+    assert len(changes) == 2
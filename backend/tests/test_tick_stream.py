@@ -0,0 +1,144 @@
+"""
+Tests of the streaming ticker feed against a local stand-in feed serving newline-delimited JSON.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from collector_agent.collectors.tick_stream import BarAggregator, TickStream
+
+# Epoch seconds inside one 60s bar
+BAR_START = 1700000040
+
+
+class StandInFeed(ThreadingHTTPServer):
+    """Each connection streams the next batch of ticks, then closes, as a dropped feed would."""
+    daemon_threads = True
+
+    def __init__(self, batches):
+        super().__init__(('127.0.0.1', 0), _FeedHandler)
+        self.batches = list(batches)
+        self.connections = []  # product_ids requested per connection
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/feed'
+
+
+class _FeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.connections.append(parse_qs(urlparse(self.path).query).get('product_ids', [''])[0])
+        ticks = server.batches.pop(0) if server.batches else []
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for tick in ticks:
+            line = tick if isinstance(tick, str) else json.dumps(tick)
+            self.wfile.write(line.encode() + b'\n')
+            self.wfile.flush()
+        if not ticks:
+            time.sleep(0.2)  # Keep an idle connection open briefly instead of reconnecting in a tight loop
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _ticker(pair, price, size, second):
+    iso = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(BAR_START + second)) + '.000000Z'
+    return {'type': 'ticker', 'product_id': pair, 'price': str(price), 'last_size': str(size), 'time': iso}
+
+
+@pytest.fixture
+def feed_factory():
+    servers = []
+
+    def start(batches):
+        server = StandInFeed(batches)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_connects_and_receives_ticks(feed_factory):
+    feed = feed_factory([[_ticker('BTC-USD', 100.0, 0.5, 1), _ticker('ETH-USD', 10.0, 2.0, 2)]])
+    ticks = []
+    stream = TickStream(feed.url, ['BTC-USD', 'ETH-USD'], lambda *tick: ticks.append(tick), reconnect_seconds=0.05)
+    stream.start()
+    try:
+        assert _wait_for(lambda: len(ticks) == 2)
+    finally:
+        stream.stop()
+    assert feed.connections[0] == 'BTC-USD,ETH-USD'
+    assert ticks == [('BTC-USD', 100.0, 0.5, BAR_START + 1.0), ('ETH-USD', 10.0, 2.0, BAR_START + 2.0)]
+
+
+def test_reconnects_after_the_feed_drops(feed_factory):
+    feed = feed_factory([
+        [_ticker('BTC-USD', 100.0, 1.0, 1)],
+        ['{not json', {'type': 'heartbeat'}, _ticker('BTC-USD', 101.0, 1.0, 2)],
+    ])
+    ticks = []
+    stream = TickStream(feed.url, ['BTC-USD'], lambda *tick: ticks.append(tick), reconnect_seconds=0.05)
+    stream.start()
+    try:
+        assert _wait_for(lambda: len(ticks) == 2)
+    finally:
+        stream.stop()
+    assert len(feed.connections) >= 2
+    # Malformed and non-ticker messages are skipped without dropping the connection
+    assert [tick[1] for tick in ticks] == [100.0, 101.0]
+
+
+def test_ticks_from_the_feed_fold_into_bars(feed_factory):
+    feed = feed_factory([[
+        _ticker('BTC-USD', 100.0, 1.0, 1),
+        _ticker('BTC-USD', 105.0, 2.0, 5),
+        _ticker('BTC-USD', 95.0, 1.0, 30),
+        _ticker('BTC-USD', 98.0, 0.5, 59),
+    ]])
+    bars = BarAggregator(60)
+    stream = TickStream(feed.url, ['BTC-USD'], bars.add_tick, reconnect_seconds=0.05)
+    stream.start()
+    try:
+        assert _wait_for(lambda: bars._open.get('BTC-USD') is not None and bars._open['BTC-USD'].ticks == 4)
+    finally:
+        stream.stop()
+    [bar] = bars.drain_closed(now=BAR_START + 60)
+    assert (bar.start, bar.open, bar.high, bar.low, bar.close, bar.volume) == (BAR_START, 100.0, 105.0, 95.0, 98.0, 4.5)
+
+
+def test_late_tick_after_a_wall_clock_close_is_dropped():
+    bars = BarAggregator(60)
+    bars.add_tick('BTC-USD', 100.0, 1.0, BAR_START + 1)
+    [bar] = bars.drain_closed(now=BAR_START + 60)
+    assert (bar.start, bar.open, bar.close) == (BAR_START, 100.0, 100.0)
+
+    bars.add_tick('BTC-USD', 101.0, 1.0, BAR_START + 59)  # Same interval, arriving after it closed
+    assert bars.drain_closed(now=BAR_START + 120) == []
+    assert bars.late_ticks == 1
+
+    bars.add_tick('BTC-USD', 102.0, 1.0, BAR_START + 61)  # The next interval still opens a bar
+    [bar] = bars.drain_closed(now=BAR_START + 120)
+    assert (bar.start, bar.open) == (BAR_START + 60, 102.0)
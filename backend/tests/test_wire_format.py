@@ -0,0 +1,60 @@
+"""
+Tests of the upload wire formats: the decompression limit, MCB2 payloads and batch JSON bodies.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import json
+import struct
+from array import array
+
+import pytest
+
+from collector_agent.metrics_sdk import wire_format
+from collector_agent.metrics_sdk.measurement_batch import EPOCH_MS, ISO, MeasurementBatch
+
+
+def test_payload_within_the_limit_is_decompressed():
+    payload = b'[{"name": "cpu", "value": 1.0}]' * 100
+    body = wire_format.compress(payload, wire_format.GZIP)
+    assert wire_format.decompress(body, wire_format.GZIP, max_size=len(payload)) == payload
+
+
+def test_payload_expanding_beyond_the_limit_is_rejected():
+    # About 100 KiB on the wire, 100 MiB once decompressed
+    body = wire_format.compress(b'\0' * (100 * 1024 * 1024), wire_format.GZIP)
+    with pytest.raises(wire_format.PayloadTooLargeError):
+        wire_format.decompress(body, wire_format.GZIP, max_size=1024 * 1024)
+
+
+def test_corrupt_payload_is_a_wire_format_error():
+    with pytest.raises(wire_format.WireFormatError) as error:
+        wire_format.decompress(b'not gzip', wire_format.GZIP, max_size=1024)
+    assert not isinstance(error.value, wire_format.PayloadTooLargeError)
+
+
+def _batch():
+    batch = MeasurementBatch()
+    batch.append('host-"1"', 'caf\u00e9', 'CPU Load', 12.5, 'system', '%', 1700000000123, 330)
+    batch.append('host-2', 'host-2', 'Temperature', float('nan'), 'system', 'C', 1700000000123, -240.6)
+    return batch
+
+
+@pytest.mark.parametrize('timestamp_format', [ISO, EPOCH_MS])
+def test_batch_json_body_matches_its_rows(timestamp_format):
+    batch = _batch()
+    assert json.dumps(json.loads(batch.to_json(timestamp_format))) == json.dumps(batch.serialize(timestamp_format))
+    assert [row['utc_offset'] for row in batch.serialize()] == [330, -241]
+
+
+def test_float_offset_payload_is_decoded_in_whole_minutes():
+    # An MCB2 payload: the same layout as MCB1 with float64 UTC offsets
+    strings = json.dumps(['d1', 'host', 'cpu', 'system', '%']).encode('utf-8')
+    payload = b''.join([
+        struct.pack('<4sII', b'MCB2', 1, len(strings)), strings,
+        array('I', [0]).tobytes(), array('I', [1]).tobytes(), array('I', [2]).tobytes(),
+        array('I', [3]).tobytes(), array('I', [4]).tobytes(),
+        struct.pack('<d', 1.5), struct.pack('<q', 1700000000123), struct.pack('<d', 329.7),
+    ])
+    row, = wire_format.decode_measurements(payload)
+    assert (row['name'], row['value'], row['timestamp_ms'], row['utc_offset']) == ('cpu', 1.5, 1700000000123, 330)
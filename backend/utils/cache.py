@@ -1,11 +1,28 @@
 import logging
 import time
-from threading import Lock
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Dict, Optional
 
 class CachedData:
+    """Cached value with a time-to-live.
+
+    With a loader the cache runs stale-while-revalidate through get_or_refresh(): a
+    single background thread reloads the value while requests keep being served the
+    previous one, and a read within refresh_ahead_seconds of expiry already starts that
+    reload, so under steady traffic no request ever waits for the loader. Only a cache
+    that has never been loaded makes readers wait, on a Condition that the refresher
+    notifies, for at most cold_wait_seconds. Values merged in while a reload is running
+    are merged into its result again before it is installed, so a reload that read the
+    source before the merge does not take the merged data back out.
+
+    Without a loader the lock-based is_expired() / update() / get_data() API is used.
+    """
     _logger = logging.getLogger(__name__)
 
-    def __init__(self, cache_duration_seconds: int = 10):  # Changed from 30 to 10 seconds
+    def __init__(self, cache_duration_seconds: int = 10,  # Changed from 30 to 10 seconds
+                 loader: Optional[Callable[[], Any]] = None, refresh_ahead_seconds: float = 0.0,
+                 cold_wait_seconds: float = 5.0, failure_backoff_seconds: float = 1.0,
+                 on_refresh: Optional[Callable[[Any], None]] = None, name: str = 'cache'):
         self.data = None
         self.cache_duration_seconds = cache_duration_seconds
         self.last_updated = time.monotonic() - self.cache_duration_seconds
@@ -13,6 +30,27 @@ class CachedData:
         self.lock = Lock()
         self.cache_status = 'VALID'  # Add cache status field
 
+        self.loader = loader
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self.cold_wait_seconds = cold_wait_seconds
+        self.failure_backoff_seconds = failure_backoff_seconds
+        self.on_refresh = on_refresh
+        self.name = name
+        self.refreshed = Condition(self.lock)
+        self._refreshing = False
+        self._retry_at = 0.0
+        self._last_error = None
+        self._merges_during_refresh = []
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.last_refresh_seconds = 0.0
+        self.max_refresh_seconds = 0.0
+        self._total_refresh_seconds = 0.0
+
     def __enter__(self):
         self.lock.acquire()
         return self 
@@ -22,6 +60,119 @@ class CachedData:
         assert(self.lock.locked())
         self.lock.release()
 
+    def get_or_refresh(self) -> Any:
+        """
+        Return the cached value, reloading it in the background when it is due.
+
+        A fresh value is a hit, and starts a refresh once it is within refresh_ahead_seconds
+        of expiry. An expired value is still returned (stale_served) while it is reloaded.
+        With no value yet (a miss) the caller waits for the first load.
+
+        Raises:
+            Exception: The loader's error, when a cold cache could not be loaded.
+        """
+        with self.lock:
+            if self.data is not None:
+                age = time.monotonic() - self.last_updated
+                if age < self.cache_duration_seconds:
+                    self.hits += 1
+                    if age >= self.cache_duration_seconds - self.refresh_ahead_seconds:
+                        self._start_refresh()
+                else:
+                    self.stale_served += 1
+                    self._start_refresh()
+                return self.data
+
+            self.misses += 1
+            self._start_refresh()
+            self.refreshed.wait_for(lambda: not self._refreshing, timeout=self.cold_wait_seconds)
+            if self.data is None and self._last_error is not None:
+                raise self._last_error
+            return self.data
+
+    def _start_refresh(self) -> None:
+        assert(self.lock.locked())
+        if self._refreshing or time.monotonic() < self._retry_at:
+            return
+        self._refreshing = True
+        self._merges_during_refresh = []
+        Thread(target=self._refresh, name=f'CacheRefresh-{self.name}', daemon=True).start()
+
+    def _refresh(self) -> None:
+        started = time.monotonic()
+        try:
+            data = self.loader()
+        except Exception as e:
+            CachedData._logger.error(f"Refreshing {self.name} failed: {str(e)}")
+            with self.lock:
+                self.refresh_failures += 1
+                self._last_error = e
+                self._retry_at = time.monotonic() + self.failure_backoff_seconds
+                self._refreshing = False
+                self._merges_during_refresh = []
+                self.refreshed.notify_all()
+            return
+
+        elapsed = time.monotonic() - started
+        with self.lock:
+            for func in self._merges_during_refresh:
+                try:
+                    data = func(data)
+                except Exception as e:
+                    CachedData._logger.error(f"Reapplying a merge to {self.name} failed: {str(e)}")
+            self._merges_during_refresh = []
+            self.update(data)
+            self.refreshes += 1
+            self.last_refresh_seconds = elapsed
+            self.max_refresh_seconds = max(self.max_refresh_seconds, elapsed)
+            self._total_refresh_seconds += elapsed
+            self._refreshing = False
+            self.refreshed.notify_all()
+        CachedData._logger.debug(f"Refreshed {self.name} in {elapsed:.3f}s")
+
+        if self.on_refresh is not None:
+            try:
+                self.on_refresh(data)
+            except Exception as e:
+                CachedData._logger.error(f"on_refresh callback of {self.name} failed: {str(e)}")
+
+    def merge(self, func: Callable[[Any], Any]) -> bool:
+        """
+        Replace the cached value with func(value), for write-through of data the loader would also return.
+
+        The age of the value is left alone, so the loader still runs once the TTL expires and
+        corrects anything a merge missed. While a refresh is running, func is also kept and
+        applied to the value it loads, which may or may not already hold the data, so func
+        must not add it twice. Nothing happens while the cache holds no value and is not
+        being loaded, as its first load will include the data.
+
+        Returns:
+            bool: True if a value was merged into, or will be when the running refresh completes.
+        """
+        with self.lock:
+            if self._refreshing:
+                self._merges_during_refresh.append(func)
+            if self.data is None:
+                return self._refreshing
+            self.data = func(self.data)
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters of get_or_refresh() reads and background refreshes."""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_served': self.stale_served,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+                'refreshing': self._refreshing,
+                'last_refresh_seconds': round(self.last_refresh_seconds, 6),
+                'max_refresh_seconds': round(self.max_refresh_seconds, 6),
+                'avg_refresh_seconds': round(self._total_refresh_seconds / self.refreshes, 6) if self.refreshes else 0.0,
+                'age_seconds': round(time.monotonic() - self.last_updated, 3) if self.data is not None else None,
+            }
+
     def is_expired(self) -> bool:
         """Determine if the cache is expired, with thread-safe update handling.
 
@@ -89,50 +240,3 @@ class CachedData:
         """ Dynamically adjust cache expiration duration """
         self.cache_duration_seconds = new_duration
         CachedData._logger.debug(f"Cache duration adjusted to {new_duration} seconds.")
-
-
-class CacheUpdateManager:
-    def __init__(self, cached_data: CachedData):
-        self.cached_data = cached_data
-        self.update_already_started = False
-
-    def __enter__(self):
-        """Ensure lock is held when entering context"""
-        if not self.cached_data.lock.locked():
-            self.cached_data.lock.acquire()
-        self.update_already_started = self.cached_data.active_update_start_time != 0
-        if self.cached_data.active_update_start_time == 0:
-            self.cached_data.active_update_start_time = time.monotonic()
-        self.cached_data.lock.release()
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        """Ensure proper lock handling on exit"""
-        if not self.cached_data.lock.locked():
-            self.cached_data.lock.acquire()
-        self.cached_data.active_update_start_time = 0
-
-    def update_started_elsewhere(self) -> bool:
-        return self.update_already_started
-    
-    def spin_wait_for_update_to_complete(self):
-        """ New feature: introduces a maximum wait timeout """
-        max_wait_time = 5  # Seconds
-        elapsed_time = 0
-        assert(self.update_started_elsewhere())
-        
-        while True:
-            update_still_in_progress = False
-            self.cached_data.lock.acquire()
-            update_still_in_progress = self.cached_data.active_update_start_time != 0
-            self.cached_data.lock.release()
-            
-            if not update_still_in_progress:
-                break
-
-            if elapsed_time >= max_wait_time:
-                CachedData._logger.warning("Maximum wait time exceeded while waiting for update to complete.")
-                break
-
-            time.sleep(0.1)
-            elapsed_time += 0.1
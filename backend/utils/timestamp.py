@@ -1,10 +1,17 @@
-from datetime import datetime, timezone
+import time
+from datetime import datetime, timedelta, timezone
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 def get_utc_timestamp():
     """Return the current local time in ISO format with timezone offset."""
     
     return  datetime.now(timezone.utc).isoformat()
 
+def get_utc_timestamp_ms():
+    """Return the current time as integer epoch milliseconds."""
+    return time.time_ns() // 1_000_000
+
 def get_utc_offset():
     """Return the current UTC offset in minutes."""
     # Get local timezone
@@ -12,5 +19,20 @@ def get_utc_offset():
     offset = local_time.utcoffset().total_seconds() / 60
     return offset
 
-print(get_utc_offset())
+def iso_to_epoch_ms(timestamp: str) -> int:
+    """Convert an ISO timestamp to integer epoch milliseconds, treating naive values as UTC."""
+    return datetime_to_epoch_ms(datetime.fromisoformat(timestamp))
+
+def epoch_ms_to_datetime(epoch_ms: int) -> datetime:
+    """Convert integer epoch milliseconds to an aware UTC datetime."""
+    return _EPOCH + timedelta(milliseconds=epoch_ms)
+
+def datetime_to_epoch_ms(value: datetime) -> int:
+    """Convert a datetime to integer epoch milliseconds, treating naive values as UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - _EPOCH) // timedelta(milliseconds=1)
 
+def epoch_ms_to_iso(epoch_ms: int) -> str:
+    """Render epoch milliseconds as a naive UTC ISO string, the format the read API has always returned."""
+    return (datetime(1970, 1, 1) + timedelta(milliseconds=epoch_ms)).isoformat()